@@ -0,0 +1,210 @@
+# This file contains the HTTP API. Optimisations can be submitted for a team or clinician and date, polled until they
+# finish, and their routes fetched as GeoJSON. Requests are served asynchronously. Solves and route exports are run in
+# separate pools of worker processes and database lookups in threads, so that long optimisations never block polling,
+# submitting or fetching routes.
+import asyncio
+import datetime
+import functools
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from aiohttp import web
+import classes.person
+import classes.visits
+import classes.team
+import geolocation
+import jobs
+import route_export
+
+# Keys under which the process pools and running solves are stored on the application
+EXECUTOR = web.AppKey("executor", ProcessPoolExecutor)
+EXPORTER = web.AppKey("exporter", ProcessPoolExecutor)
+SOLVES = web.AppKey("solves", set)
+
+# Responses may contain dates and times, which are returned as strings
+dumps = functools.partial(json.dumps, default=str)
+
+_obj_types = {"team": "Team", "clinician": "Clinician"}
+
+
+def parse_date(value):
+    """
+    Parses a date from a request in the format YYYY-MM-DD.
+    :param value: Date string
+    :return: Date
+    :raises web.HTTPBadRequest: If the date is invalid
+    """
+    try:
+        return datetime.date.fromisoformat(str(value))
+
+    except ValueError:
+        raise web.HTTPBadRequest(text='{"error": "Dates must be in the format YYYY-MM-DD."}',
+                                 content_type="application/json")
+
+
+def parse_obj_type(value):
+    """Converts "team" or "clinician" from a request path or body to its class name."""
+    if value not in _obj_types:
+        raise web.HTTPNotFound(text='{"error": "Routes are only available for a team or clinician."}',
+                               content_type="application/json")
+
+    return _obj_types[value]
+
+
+def load_routes(obj_type, obj_id, val_date):
+    """
+    Loads the GeoJSON export of a team or clinician's route. This is run in the export pool.
+    :param obj_type: "Team" or "Clinician"
+    :param obj_id: ID of the team or clinician
+    :param val_date: Date of the route
+    :return: GeoJSON FeatureCollection as a dictionary, or None if there is no optimized route
+    """
+    cls = classes.team.Team if obj_type == "Team" else classes.person.Clinician
+
+    with cls.class_session_scope() as session:
+        obj = session.get(cls, obj_id)
+
+        if not obj:
+            return None
+
+        clins = obj.clins if obj_type == "Team" else [obj]
+
+        return route_export.export_routes(clins, geolocation.route_visits(clins, val_date), val_date)
+
+
+def run_job(job_id, worker):
+    """
+    Runs a job in a worker process. Defined here rather than passing jobs.execute_job to the pool directly, so that
+    each worker imports this module and its classes in the same order as main.py.
+    """
+    return jobs.execute_job(job_id, worker)
+
+
+async def run_in_pool(request, func, *args, pool=EXECUTOR):
+    """Runs a function in one of the process pools without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(request.app[pool], func, *args)
+
+
+async def run_in_thread(func, *args):
+    """Runs a database call in a thread, so that it is not queued behind the solves in the process pool."""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def submit_optimize(request):
+    """
+    POST /optimize
+    Body: {"team_id" or "clinician_id": int, "date": "YYYY-MM-DD", "mode": "driving", "provider": "google"}
+    Queues an optimisation, starts it in the process pool and returns the job to poll. If no mode is given, each
+    clinician's travel mode is used. A mode that is given is also used for the map and exports rendered after the
+    solve.
+    """
+    try:
+        body = await request.json()
+
+    except ValueError:
+        return web.json_response({"error": "Request body must be JSON."}, status=400)
+
+    if not isinstance(body, dict):
+        return web.json_response({"error": "Request body must be a JSON object."}, status=400)
+
+    if "team_id" in body:
+        obj_type, obj_id = "Team", body["team_id"]
+
+    elif "clinician_id" in body:
+        obj_type, obj_id = "Clinician", body["clinician_id"]
+
+    else:
+        return web.json_response({"error": "A team_id or clinician_id is required."}, status=400)
+
+    if body.get("mode") not in (None, "driving", "walking", "bicycling", "transit") or \
+            body.get("provider", "google") not in ("google", "local", "hybrid", "estimate"):
+        return web.json_response({"error": "Invalid mode or provider."}, status=400)
+
+    # Only ASCII digits are accepted. isnumeric would also accept characters such as "½" that int cannot parse.
+    if not (str(obj_id).isascii() and str(obj_id).isdecimal()):
+        return web.json_response({"error": "IDs must be whole numbers."}, status=400)
+
+    val_date = parse_date(body.get("date"))
+    job_id = await run_in_thread(functools.partial(jobs.submit, "optimize", obj_type, int(obj_id), val_date,
+                                                   mode=body.get("mode"), provider=body.get("provider", "google")))
+
+    # Run the job in the pool. It is claimed first, so a queue worker that picks it up sooner runs it instead.
+    # A reference is kept until it finishes so the task is not garbage collected.
+    solve = asyncio.ensure_future(run_in_pool(request, run_job, job_id, f"api:{os.getpid()}"))
+    request.app[SOLVES].add(solve)
+    solve.add_done_callback(request.app[SOLVES].discard)
+
+    return web.json_response(await run_in_thread(jobs.poll, job_id), status=202, dumps=dumps)
+
+
+async def get_job(request):
+    """
+    GET /jobs/{job_id}
+    Returns the status of a job, with its result once finished.
+    """
+    job = await run_in_thread(jobs.poll, int(request.match_info["job_id"]))
+
+    if not job:
+        return web.json_response({"error": "Job not found."}, status=404)
+
+    return web.json_response(job, dumps=dumps)
+
+
+async def get_routes(request):
+    """
+    GET /routes/{team|clinician}/{obj_id}/{date}
+    Returns the GeoJSON route for a team or clinician on a date. Legs are routed on each clinician's own travel mode,
+    even if the route was optimized with a mode given for everyone.
+    """
+    obj_type = parse_obj_type(request.match_info["obj_type"])
+    val_date = parse_date(request.match_info["date"])
+    routes = await run_in_pool(request, load_routes, obj_type, int(request.match_info["obj_id"]), val_date,
+                               pool=EXPORTER)
+
+    if not routes:
+        return web.json_response({"error": "No optimized route found."}, status=404)
+
+    return web.json_response(routes, content_type="application/geo+json", dumps=dumps)
+
+
+def create_app(num_workers=None):
+    """
+    Creates the application and its process pools. Route exports have their own pool, a quarter of the size of the
+    solve pool, so that fetching a route is not queued behind running solves.
+    :param num_workers: Number of solve worker processes. Defaults to the number of cores.
+    :return: Application
+    """
+    app = web.Application()
+    app.add_routes([
+        web.post("/optimize", submit_optimize),
+        web.get("/jobs/{job_id:\\d+}", get_job),
+        web.get("/routes/{obj_type}/{obj_id:\\d+}/{date}", get_routes),
+    ])
+
+    async def pool_context(app):
+        # Workers are spawned rather than forked so they do not inherit the event loop or database connections
+        workers = num_workers or os.cpu_count()
+        app[EXECUTOR] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        app[EXPORTER] = ProcessPoolExecutor(max_workers=max(1, workers // 4),
+                                            mp_context=multiprocessing.get_context("spawn"))
+        app[SOLVES] = set()
+        yield
+        app[EXECUTOR].shutdown(wait=False, cancel_futures=True)
+        app[EXPORTER].shutdown(wait=False, cancel_futures=True)
+
+    app.cleanup_ctx.append(pool_context)
+
+    return app
+
+
+def run_api(port=8080, host="127.0.0.1", num_workers=None):
+    """
+    Serves the API until interrupted.
+    :param port: Port to listen on
+    :param host: Host to listen on
+    :param num_workers: Number of solve worker processes. Defaults to the number of cores.
+    :return: None
+    """
+    jobs.fail_stale_jobs()
+    web.run_app(create_app(num_workers), host=host, port=port)
@@ -0,0 +1,152 @@
+# This file contains the nightly batch jobs. These run without prompting the user and can be scheduled from main.py.
+import datetime
+from time import sleep
+import numpy as np
+import validate
+import road_graph
+import geolocation
+import map_cache
+import route_export
+import jobs
+import travel_slices
+from classes.visits import Visit
+from classes.team import Team
+
+
+def run_nightly():
+    """
+    Runs each nightly batch job in turn and reports the outcome of each.
+    :return: Dictionary of job name to number of records affected
+    """
+    results = {}
+
+    # Expire any visits that have passed their expected date
+    results["expired_visits"] = Visit.evaluate_requests()
+    print(f"{datetime.datetime.now():%d/%m/%Y %H:%M} Expired visits: {results['expired_visits']}")
+
+    # Rebuild any stale road graphs so that route display does not wait on OpenStreetMaps
+    results["refreshed_graphs"] = road_graph.refresh_graphs()
+    print(f"{datetime.datetime.now():%d/%m/%Y %H:%M} Refreshed road graphs: {results['refreshed_graphs']}")
+
+    # Build today's travel time slices so that optimizing a team reads them from the cache, then remove old slices
+    results["travel_slices"] = build_travel_slices(datetime.date.today())
+    results["pruned_slices"] = travel_slices.prune_slices()
+    print(f"{datetime.datetime.now():%d/%m/%Y %H:%M} Built travel time slices: {results['travel_slices']} "
+          f"(removed {results['pruned_slices']})")
+
+    # Pre-render today's route maps so that viewing a route is a file read, then remove maps no longer in use
+    results["rendered_maps"] = render_maps(datetime.date.today())
+    results["pruned_maps"] = map_cache.prune_maps()
+    print(f"{datetime.datetime.now():%d/%m/%Y %H:%M} Rendered route maps: {results['rendered_maps']} "
+          f"(removed {results['pruned_maps']})")
+
+    # Fail any jobs whose worker has died, then report the state of the job queue
+    results["stale_jobs"] = jobs.fail_stale_jobs()
+    counts = jobs.queue_counts()
+    print(f"{datetime.datetime.now():%d/%m/%Y %H:%M} Job queue: "
+          f"{', '.join(f'{status} {count}' for status, count in counts.items())} "
+          f"(timed out {results['stale_jobs']})")
+
+    return results
+
+
+def build_travel_slices(val_date, mode=None, provider="google"):
+    """
+    Builds the travel time matrix for each travel mode and departure hour of each team's clinicians on a date. Slices
+    that are already cached are not rebuilt unless they are older than the provider's maximum age, so Google traffic
+    for each weekday is resampled once a week. Teams with nothing to optimize are skipped.
+    :param val_date: Date to build slices for
+    :param mode: Transportation mode for every clinician. If not passed through, each clinician's travel mode is used.
+    :param provider: Matrix provider
+    :return: Number of teams with slices available
+    """
+    built = 0
+
+    with Team.class_session_scope() as session:
+        for team in session.query(Team).all():
+            try:
+                clins, visits = geolocation.day_problem(team, val_date)
+
+            except ValueError:
+                continue
+
+            try:
+                data_dict = geolocation.generate_data(visits, clins, mode=mode)
+                dist_matrix = geolocation.create_dist_matrix(data_dict["plus_code_list"], data_dict["coord_list"],
+                                                             provider=provider, slices=data_dict["slices"],
+                                                             val_date=val_date)
+
+            except Exception as err:
+                print(f"Unable to build travel time slices for {team._name}: {err}")
+                continue
+
+            if isinstance(dist_matrix, np.ndarray):
+                built += 1
+
+    return built
+
+
+def render_maps(val_date):
+    """
+    Renders the full route map for each team and each of its clinicians on a date, along with the GeoJSON export of
+    each clinician's route. Routes that are already in the map cache, or that have visits without an optimized order,
+    are skipped.
+    :param val_date: Date of the routes
+    :return: Number of maps rendered
+    """
+    rendered = 0
+
+    with Team.class_session_scope() as session:
+        for team in session.query(Team).all():
+            clins = [clin for clin in team.clins if str(clin._status) == "1"]
+            routes = [(clins, geolocation.route_visits(clins, val_date))] + \
+                     [([clin], geolocation.route_visits([clin], val_date)) for clin in clins]
+
+            for route_clins, visits in routes:
+                # Skip routes with nothing to show or that have not been optimized
+                all_visits = [visit for visit_group in visits for visit in visit_group]
+
+                if not all_visits or any(visit._order is None for visit in all_visits):
+                    continue
+
+                try:
+                    # Exports are read from the cache when they already exist, so this is cheap for unchanged routes
+                    if len(route_clins) == 1:
+                        route_export.export_route(route_clins[0], visits[0], val_date)
+
+                    if map_cache.load_map(map_cache.route_key(route_clins, visits, val_date, "route")):
+                        continue
+
+                    geolocation.render_route_map(route_clins, visits, val_date)
+                    rendered += 1
+
+                except Exception as err:
+                    print(f"Unable to render route map for {', '.join(clin.name for clin in route_clins)}: {err}")
+
+    return rendered
+
+
+def schedule_nightly(run_time="0200"):
+    """
+    Runs the nightly batch every day at the requested time. This blocks until interrupted.
+    :param run_time: Time of day to run the batch in the format HHMM
+    :return: 0 if the run time is invalid
+    """
+    run_time = validate.valid_time(run_time)
+
+    if isinstance(run_time, Exception):
+        print("Please enter a valid time in the format HHMM.")
+        return 0
+
+    while True:
+        # Find the next occurrence of the run time, then sleep until it arrives
+        now = datetime.datetime.now()
+        next_run = datetime.datetime.combine(now.date(), run_time)
+
+        if next_run <= now:
+            next_run += datetime.timedelta(days=1)
+
+        print(f"Next nightly batch scheduled for {next_run:%d/%m/%Y %H:%M}.")
+        sleep((next_run - now).total_seconds())
+
+        run_nightly()
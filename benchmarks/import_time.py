@@ -0,0 +1,75 @@
+# This file contains the import time benchmark. Each entry module is imported in a fresh interpreter and its cumulative
+# import time is compared with a budget, and heavy dependencies that should only be imported on first use are checked
+# to be absent. Run from the project root with: python benchmarks/import_time.py
+import argparse
+import pathlib
+import subprocess
+import sys
+
+ROOT_DIR = pathlib.Path(__file__).absolute().parent.parent
+
+# Cumulative import time budget in milliseconds for each entry module. main covers the full startup path of launching
+# main.py, up to parsing its arguments.
+BUDGETS = {
+    "main": 1000,
+    "navigation": 1000,
+    "batch": 1000,
+}
+
+# Modules that must not be imported just by importing an entry module
+LAZY_MODULES = ("pandas", "folium", "osmnx", "networkx", "scipy", "ortools", "boto3", "requests")
+
+
+def import_time(module, runs=5):
+    """
+    Imports a module in a fresh interpreter several times and returns the fastest cumulative import time.
+    :param module: Name of the module to import
+    :param runs: Number of interpreters to start
+    :return: Tuple of (import time in milliseconds, list of heavy modules that were imported)
+    """
+    best = None
+    loaded = []
+
+    # Arguments are cleared so the module sees a plain launch. main.py only parses them when run as a script, so
+    # importing it stops short of starting the TUI.
+    check = f"import sys; sys.argv = [{module + '.py'!r}]; import {module}; " \
+            f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", check], cwd=ROOT_DIR,
+                                capture_output=True, text=True)
+
+        if result.returncode:
+            raise RuntimeError(f"Unable to import {module}:\n{result.stderr}")
+
+        # The last line of the import time report is the module itself, with its cumulative time in microseconds
+        lines = [line for line in result.stderr.splitlines() if line.startswith("import time:")]
+        total = int(lines[-1].split("|")[1]) / 1000
+        best = total if best is None else min(best, total)
+        loaded = [name for name in result.stdout.strip().split(",") if name]
+
+    return best, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the import time of each entry module against its budget.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of interpreters to start per module")
+    args = parser.parse_args()
+
+    failed = 0
+
+    for module, budget in BUDGETS.items():
+        total, loaded = import_time(module, runs=args.runs)
+        status = "OK" if total <= budget and not loaded else "FAIL"
+        failed += status == "FAIL"
+
+        print(f"{status:4} {module:12} {total:8.1f} ms (budget {budget} ms)")
+
+        if loaded:
+            print(f"     eagerly imported: {', '.join(loaded)}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
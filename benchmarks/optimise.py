@@ -0,0 +1,440 @@
+# This file contains the end-to-end optimisation benchmark. A synthetic team of clinicians and visits is generated at
+# each requested scale, and every stage of optimising and mapping a day is timed against a scratch database. Google's
+# APIs are replaced with a local fake and the road network with a synthetic grid, so the benchmark runs offline and
+# without API quota. Results are written to JSON so that runs can be compared over time.
+# Run from the project root with: python benchmarks/optimise.py --sizes 10 100 500
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import math
+import os
+import pathlib
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import unquote
+
+ROOT_DIR = pathlib.Path(__file__).absolute().parent.parent
+RESULTS_DIR = ROOT_DIR / "benchmarks" / "results"
+
+# Centre of the synthetic service area and the radius in km that patients live within
+CENTRE = (40.7306, -73.9352)
+RADIUS_KM = 12
+
+# Average visits per clinician per day, used to size the team
+VISITS_PER_CLINICIAN = 8
+
+# Spacing in degrees of the synthetic road grid (~500m) and the speed used for its travel times
+GRID_SPACING = 0.005
+GRID_SPEED_KPH = 30
+
+# Driving speed and detour factor used by the fake Distance Matrix API
+FAKE_SPEED_KPH = 35
+FAKE_DETOUR = 1.3
+
+
+def haversine_km(coord_1, coord_2):
+    """Returns the great-circle distance between two coordinates in km."""
+    lat_1, lng_1, lat_2, lng_2 = map(math.radians, (*coord_1, *coord_2))
+    a = math.sin((lat_2 - lat_1) / 2) ** 2 + math.cos(lat_1) * math.cos(lat_2) * math.sin((lng_2 - lng_1) / 2) ** 2
+
+    return 2 * 6371.0088 * math.asin(math.sqrt(a))
+
+
+def random_coord(rng):
+    """Returns a random coordinate within the service area, denser towards the centre."""
+    distance = RADIUS_KM * math.sqrt(rng.random()) / 111.32
+    bearing = rng.uniform(0, 2 * math.pi)
+
+    return (CENTRE[0] + distance * math.cos(bearing),
+            CENTRE[1] + distance * math.sin(bearing) / math.cos(math.radians(CENTRE[0])))
+
+
+class FakeResponse:
+    """Stands in for a requests response from the Distance Matrix API."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeGoogle:
+    """
+    Answers Distance Matrix API queries from straight-line distance, and stands in for the AWS SSM client used to fetch
+    the API key. Each plus code is looked up in a table of the synthetic coordinates.
+    """
+
+    def __init__(self):
+        self.coords = {}
+        self.queries = 0
+
+    def client(self, name):
+        return self
+
+    def get_parameter(self, Name, WithDecryption=False):
+        return {"Parameter": {"Value": "benchmark"}}
+
+    def query_dist_matrix(self, url):
+        """Builds a Distance Matrix API response for the origins and destinations in the query url."""
+        self.queries += 1
+        params = dict(param.split("=", 1) for param in url.split("?", 1)[1].split("&"))
+        origins = [unquote(code) for code in params["origins"].split("|")]
+        destinations = [unquote(code) for code in params["destinations"].split("|")]
+
+        # Requests with a departure time are answered in traffic, slowed by the congestion factor for the hour
+        traffic = None
+        if "departure_time" in params:
+            import travel_slices
+            hour = datetime.datetime.fromtimestamp(int(params["departure_time"])).hour
+            traffic = travel_slices.congestion_factor(params["mode"], hour)
+
+        rows = [
+            {"elements": [
+                {"duration": {"value": seconds},
+                 **({"duration_in_traffic": {"value": int(seconds * traffic)}} if traffic else {})}
+                for seconds in (int(haversine_km(self.coords[origin], self.coords[destination])
+                                    * FAKE_DETOUR / FAKE_SPEED_KPH * 3600) for destination in destinations)
+            ]}
+            for origin in origins
+        ]
+
+        return FakeResponse({"destination_addresses": destinations, "origin_addresses": origins, "rows": rows})
+
+
+def grid_graph(north, south, east, west):
+    """
+    Builds a synthetic grid road network covering a bounding box, in the form produced by the road graph store.
+    :return: NetworkX MultiDiGraph
+    """
+    import networkx as nx
+
+    graph = nx.MultiDiGraph()
+    lats = [south + i * GRID_SPACING for i in range(int((north - south) / GRID_SPACING) + 2)]
+    lngs = [west + j * GRID_SPACING for j in range(int((east - west) / GRID_SPACING) + 2)]
+
+    for i, lat in enumerate(lats):
+        for j, lng in enumerate(lngs):
+            graph.add_node(i * len(lngs) + j, y=lat, x=lng)
+
+    for i, j in itertools.product(range(len(lats)), range(len(lngs))):
+        for di, dj in ((0, 1), (1, 0)):
+            if i + di < len(lats) and j + dj < len(lngs):
+                u, v = i * len(lngs) + j, (i + di) * len(lngs) + j + dj
+                length = haversine_km((lats[i], lngs[j]), (lats[i + di], lngs[j + dj])) * 1000
+                travel_time = length / (GRID_SPEED_KPH / 3.6)
+                graph.add_edge(u, v, length=length, travel_time=travel_time)
+                graph.add_edge(v, u, length=length, travel_time=travel_time)
+
+    return graph
+
+
+def new_obj(cls, session, **columns):
+    """
+    Creates a record without calling its constructor, whose setters would geocode addresses through Google.
+    :param cls: Class of the record
+    :param session: Session the record is added to
+    :param columns: Column values
+    :return: Record
+    """
+    obj = cls._sa_class_manager.new_instance()
+
+    for column, value in columns.items():
+        setattr(obj, column, value)
+
+    session.add(obj)
+    obj.session = session
+
+    return obj
+
+
+def synthetic_day(session, num_visits, val_date, rng, ids, fake_google):
+    """
+    Generates a team with enough clinicians for the visits, and one visit per patient on the date.
+    :return: Tuple of (team, list of clinicians, list of visits)
+    """
+    from classes.person import Patient, Clinician
+    from classes.visits import Visit
+    from classes.team import Team
+
+    team = new_obj(Team, session, _id=next(ids), _name=f"Benchmark {num_visits}", _status="1")
+
+    clins = []
+    for index in range(max(1, math.ceil(num_visits / VISITS_PER_CLINICIAN))):
+        coord = random_coord(rng)
+        plus_code = f"BENCH+C{len(fake_google.coords)}"
+        fake_google.coords[plus_code] = coord
+        start_hour = rng.choice((7, 8, 8, 9))
+
+        clins.append(new_obj(
+            Clinician, session, _id=next(ids), _name=f"CLINICIAN, {index}", _status="1", _team_id=team._id,
+            _address=f"{index} Benchmark St", _start_address=f"{index} Benchmark St",
+            _end_address=f"{index} Benchmark St", _lat=coord[0], _lng=coord[1], _plus_code=plus_code,
+            _start_lat=coord[0], _start_lng=coord[1], _start_plus_code=plus_code,
+            _end_lat=coord[0], _end_lng=coord[1], _end_plus_code=plus_code,
+            _start_time=datetime.time(start_hour), _end_time=datetime.time(start_hour + 8, 30),
+            _discipline=rng.choice(("nurse", "nurse", "nurse", "physical therapist")),
+            _skill_list=rng.sample(Clinician._c_skill_list, rng.randint(1, 4))
+        ))
+
+    visits = []
+    for index in range(num_visits):
+        coord = random_coord(rng)
+        plus_code = f"BENCH+P{len(fake_google.coords)}"
+        fake_google.coords[plus_code] = coord
+
+        pat = new_obj(Patient, session, _id=next(ids), _name=f"PATIENT, {index}", _status="1", _team_id=team._id,
+                      _address=f"{index} Patient Ave", _lat=coord[0], _lng=coord[1], _plus_code=plus_code)
+
+        # Most visits can be seen any time in a few hours, with some fixed appointments
+        earliest = rng.randint(8 * 4, 15 * 4) * 15
+        width = rng.choice((60, 120, 120, 180, 240))
+        latest = min(earliest + width, 17 * 60 + 45)
+
+        visits.append(new_obj(
+            Visit, session, _id=next(ids), _status=1, _pat_id=pat._id, _exp_date=val_date,
+            _time_earliest=datetime.time(earliest // 60, earliest % 60),
+            _time_latest=datetime.time(latest // 60, latest % 60),
+            _visit_priority=rng.choices(Visit._c_visit_priority, weights=(6, 3, 1))[0],
+            _visit_complexity=rng.choices(Visit._c_visit_complexity, weights=(4, 4, 2))[0],
+            _skill_list=rng.sample(Clinician._c_skill_list, rng.choice((0, 0, 1))),
+            _discipline=rng.choice(("any", "any", "nurse")),
+            _sched_status="unassigned"
+        ))
+        visits[-1].pat = pat
+
+    session.flush()
+
+    return team, clins, visits
+
+
+@contextlib.contextmanager
+def stage(timings, errors, name):
+    """Times a stage, recording any error rather than stopping the run."""
+    start = time.perf_counter()
+
+    try:
+        yield
+
+    except Exception as err:
+        errors[name] = f"{type(err).__name__}: {err}"
+
+    finally:
+        timings[name] = round(time.perf_counter() - start, 4)
+
+
+def run_scale(num_visits, seed, skip_maps, fake_google):
+    """
+    Generates a synthetic day with the given number of visits and times each stage of optimising and mapping it.
+    :return: Dictionary of results
+    """
+    import numpy as np
+    import geolocation
+    import problem_snapshot
+    import road_graph
+    import route_solution
+    import search_trace
+    import solution_analysis
+    import validate
+    from data_manager import DataManagerMixin
+
+    rng = random.Random(seed + num_visits)
+    val_date = datetime.date.today() + datetime.timedelta(days=1)
+    timings, errors = {}, {}
+
+    session = DataManagerMixin.Session()
+    ids = itertools.count(10000 + num_visits * 10)
+    team, clins, visits = synthetic_day(session, num_visits, val_date, rng, ids, fake_google)
+    session.commit()
+
+    with stage(timings, errors, "generate_data"):
+        data_dict = geolocation.generate_data(visits, clins)
+
+    # Fall back to the estimate provider if the Google path fails, so that later stages are still measured
+    dist_matrix = None
+    queries = fake_google.queries
+
+    with stage(timings, errors, "create_dist_matrix"):
+        dist_matrix = geolocation.create_dist_matrix(data_dict["plus_code_list"], data_dict["coord_list"],
+                                                     provider="google", slices=data_dict["slices"],
+                                                     val_date=val_date)
+
+    if not isinstance(dist_matrix, np.ndarray):
+        dist_matrix = geolocation.create_dist_matrix(data_dict["plus_code_list"], data_dict["coord_list"],
+                                                     provider="estimate", slices=data_dict["slices"],
+                                                     val_date=val_date)
+
+    problem_snapshot.snapshot_problem(dist_matrix, data_dict, benchmark="optimise", visits=num_visits, seed=seed)
+
+    # Left unset if the solver raises, so the error is reported instead of stopping the run
+    manager = routing = solution = None
+
+    with stage(timings, errors, "route_optimizer"):
+        manager, routing, solution = geolocation.route_optimizer(
+            dist_matrix, len(clins), data_dict["start_list"], data_dict["end_list"], data_dict["time_windows"],
+            data_dict["capacities"], data_dict["weights"], data_dict["priorities"], data_dict["skills"],
+            data_dict["disc"], vehicle_slices=data_dict["vehicle_slices"])
+
+    result = {
+        "visits": num_visits,
+        "clinicians": len(clins),
+        "matrix_queries": fake_google.queries - queries,
+        "solved": bool(solution),
+        "stages": timings,
+        "errors": errors
+    }
+
+    if not solution:
+        session.close()
+        return result
+
+    result["objective"] = solution.ObjectiveValue()
+
+    # Summarise how the search converged from the trace saved by route_optimizer
+    trace = search_trace.load_traces()[-1]
+    result["search"] = {key: trace[key] for key in ("solutions", "improving_solutions", "first_objective",
+                                                     "best_objective", "time_to_first", "time_to_best")}
+    plan = None
+
+    with stage(timings, errors, "extract_solution"):
+        dropped = solution_analysis.dropped_visits(manager, routing, solution, dist_matrix, data_dict)
+        plan = route_solution.RouteSolution.from_solver(manager, routing, solution, len(clins), len(visits),
+                                                        dropped)
+
+    if not plan:
+        session.close()
+        return result
+
+    result["dropped"] = len(plan.dropped)
+    result["dropped_reasons"] = solution_analysis.reason_counts(plan.dropped)
+
+    # Answer the output prompt with the table view and discard the printed table
+    qu_input = validate.qu_input
+    validate.qu_input = lambda prompt: "2"
+
+    try:
+        with stage(timings, errors, "return_solution"), contextlib.redirect_stdout(io.StringIO()):
+            geolocation.return_solution(clins, visits, plan)
+            session.commit()
+
+    finally:
+        validate.qu_input = qu_input
+
+    if not skip_maps:
+        route_visits = geolocation.route_visits(clins, val_date)
+
+        with stage(timings, errors, "map_markers_only"), contextlib.redirect_stdout(io.StringIO()):
+            geolocation.map_markers_only(clins, route_visits).get_root().render()
+
+        # Serve the full route map from a synthetic road graph covering every stop
+        coords = list(fake_google.coords.values())
+        north, south = max(c[0] for c in coords), min(c[0] for c in coords)
+        east, west = max(c[1] for c in coords), min(c[1] for c in coords)
+        region = road_graph.register_region(f"benchmark_{num_visits}", north + 0.01, south - 0.01, east + 0.01,
+                                            west - 0.01)
+        graph = grid_graph(north + 0.01, south - 0.01, east + 0.01, west - 0.01)
+        graph.graph["region"], graph.graph["mode"] = region, "drive"
+        road_graph._graphs[(region, "drive")] = graph
+
+        with stage(timings, errors, "map_markers_and_polyline"), contextlib.redirect_stdout(io.StringIO()):
+            geolocation.map_markers_and_polyline(clins, route_visits).get_root().render()
+
+    session.close()
+    return result
+
+
+def git_commit():
+    """Returns the current git commit, or None outside a repository."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times each stage of optimising a synthetic day.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 100, 250, 500, 1000, 2000],
+                        help="Numbers of visits to benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic caseload")
+    parser.add_argument("--skip-maps", action="store_true", help="Skip the map building stages")
+    parser.add_argument("--output", help="JSON file to write results to")
+    parser.add_argument("--snapshots", help="Directory to save a snapshot of each problem to, for benchmarks/replay.py")
+    args = parser.parse_args()
+
+    output = pathlib.Path(args.output).absolute() if args.output else \
+        RESULTS_DIR / f"optimise_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    snapshot_dir = pathlib.Path(args.snapshots).absolute() if args.snapshots else None
+
+    # Run against a scratch database, graph store and map cache. These are located relative to the working directory
+    # when the project is imported, so change directory first.
+    scratch_dir = tempfile.mkdtemp(prefix="route_benchmark_")
+    os.makedirs(os.path.join(scratch_dir, "data"))
+    os.chdir(scratch_dir)
+    sys.path.insert(0, str(ROOT_DIR))
+
+    import geolocation
+    import problem_snapshot
+    from classes.person import Patient, Clinician
+    from classes.visits import Visit
+    from classes.team import Team
+    from data_manager import DataManagerMixin
+
+    from sqlalchemy.orm import configure_mappers
+
+    # Records are created without their constructors, so the mappers must be configured up front
+    configure_mappers()
+    DataManagerMixin.create_tables()
+
+    # Load the libraries that are otherwise imported on first use, so the first scale does not pay for them
+    for module in (geolocation.pd, geolocation.folium, geolocation.plugins, geolocation.pywrapcp):
+        dir(module)
+
+    # Replace Google's APIs with the local fake
+    fake_google = FakeGoogle()
+
+    if snapshot_dir:
+        problem_snapshot.enable(snapshot_dir)
+    geolocation.boto3 = fake_google
+    geolocation.query_dist_matrix = fake_google.query_dist_matrix
+
+    results = []
+    for num_visits in args.sizes:
+        with contextlib.redirect_stderr(io.StringIO()):
+            result = run_scale(num_visits, args.seed, args.skip_maps, fake_google)
+
+        results.append(result)
+
+        stages = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in result["stages"].items())
+        print(f"{num_visits:>5} visits, {result['clinicians']:>4} clinicians: {stages}")
+
+        for name, error in result["errors"].items():
+            print(f"      {name} failed: {error}")
+
+    report = {
+        "benchmark": "optimise",
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "results": results
+    }
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
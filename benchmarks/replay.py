@@ -0,0 +1,131 @@
+# This file contains the snapshot replay tool. Problem snapshots saved by problem_snapshot are re-solved offline under
+# every combination of the requested solver parameters, in parallel, so that time limits and search strategies can be
+# tuned without the database or any API calls. Snapshots are saved by running main.py with --snapshots.
+# Run from the project root with: python benchmarks/replay.py data/snapshots/*.npz --time-limits 1 5 10
+import argparse
+import concurrent.futures
+import datetime
+import itertools
+import json
+import os
+import pathlib
+import sys
+import tempfile
+
+ROOT_DIR = pathlib.Path(__file__).absolute().parent.parent
+RESULTS_DIR = ROOT_DIR / "benchmarks" / "results"
+sys.path.insert(0, str(ROOT_DIR))
+
+# Traces from replays are kept apart from the traces of real solves
+TRACE_DIR = pathlib.Path(tempfile.mkdtemp(prefix="route_replay_"))
+
+
+def replay(path, time_limit, first_solution_strategy, metaheuristic):
+    """
+    Solves a snapshot with the given parameters. This is run in a worker process.
+    :param path: Path of the snapshot
+    :param time_limit: Seconds the solver may search for
+    :param first_solution_strategy: Name of the OR tools first solution strategy
+    :param metaheuristic: Name of the OR tools local search metaheuristic
+    :return: Dictionary describing the run
+    """
+    import geolocation
+    import problem_snapshot
+    import route_solution
+    import search_trace
+    import solution_analysis
+
+    search_trace.TRACE_PATH = TRACE_DIR / f"{os.getpid()}.jsonl"
+
+    dist_matrix, data_dict, details = problem_snapshot.load_snapshot(path)
+    manager, routing, solution = geolocation.route_optimizer(
+        dist_matrix, len(data_dict["start_list"]), data_dict["start_list"], data_dict["end_list"],
+        data_dict["time_windows"], data_dict["capacities"], data_dict["weights"], data_dict["priorities"],
+        data_dict["skills"], data_dict["disc"], time_limit=time_limit,
+        first_solution_strategy=first_solution_strategy, metaheuristic=metaheuristic,
+        vehicle_slices=data_dict.get("vehicle_slices"))
+
+    trace = search_trace.load_traces()[-1]
+    plan = route_solution.RouteSolution.from_solver(
+        manager, routing, solution, len(data_dict["start_list"]),
+        dist_matrix.shape[-1] - len(data_dict["start_list"]) - len(data_dict["end_list"]),
+        solution_analysis.dropped_visits(manager, routing, solution, dist_matrix, data_dict)) if solution else None
+
+    return {
+        "snapshot": pathlib.Path(path).name,
+        "fingerprint": details["fingerprint"],
+        "nodes": dist_matrix.shape[-1],
+        "slices": 1 if dist_matrix.ndim == 2 else len(dist_matrix),
+        "time_limit": time_limit,
+        "first_solution_strategy": first_solution_strategy,
+        "metaheuristic": metaheuristic,
+        "objective": plan.objective if plan else None,
+        "dropped": len(plan.dropped) if plan else None,
+        "time_to_best": trace["time_to_best"],
+        "improving_solutions": trace["improving_solutions"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-solves problem snapshots under different solver parameters.")
+    parser.add_argument("snapshots", nargs="+", type=pathlib.Path, help="Snapshot files (.npz)")
+    parser.add_argument("--time-limits", type=float, nargs="+", default=[1], help="Solver time limits in seconds")
+    parser.add_argument("--first-solution-strategies", nargs="+", default=["PATH_CHEAPEST_ARC"],
+                        help="OR tools first solution strategies, "
+                             "eg PATH_CHEAPEST_ARC SAVINGS PARALLEL_CHEAPEST_INSERTION")
+    parser.add_argument("--metaheuristics", nargs="+", default=["GUIDED_LOCAL_SEARCH"],
+                        help="OR tools local search metaheuristics, eg GUIDED_LOCAL_SEARCH TABU_SEARCH")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of solves to run at once")
+    parser.add_argument("--output", help="JSON file to write results to")
+    args = parser.parse_args()
+
+    output = pathlib.Path(args.output) if args.output else \
+        RESULTS_DIR / f"replay_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+
+    runs = list(itertools.product(args.snapshots, args.time_limits, args.first_solution_strategies,
+                                  args.metaheuristics))
+
+    # Each solve is single threaded, so solves are spread over processes. Workers must not share the time limit
+    # with each other, so do not run more workers than cores.
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(args.workers, len(runs))) as executor:
+        futures = {executor.submit(replay, *run): run for run in runs}
+
+        for future in concurrent.futures.as_completed(futures):
+            path, time_limit, strategy, metaheuristic = futures[future]
+
+            try:
+                result = future.result()
+
+            except Exception as err:
+                result = {"snapshot": path.name, "time_limit": time_limit, "first_solution_strategy": strategy,
+                          "metaheuristic": metaheuristic, "error": str(err)}
+
+            results.append(result)
+
+    results.sort(key=lambda result: (result["snapshot"], result["time_limit"], result["first_solution_strategy"],
+                                     result["metaheuristic"]))
+
+    print(f"{'Snapshot':<45} {'Limit':>6} {'First solution':<28} {'Metaheuristic':<22} {'Objective':>10} "
+          f"{'Dropped':>7} {'Best at':>8}")
+
+    for result in results:
+        if "error" in result:
+            print(f"{result['snapshot']:<45} {result['time_limit']:>6} {result['first_solution_strategy']:<28} "
+                  f"{result['metaheuristic']:<22} failed: {result['error']}")
+            continue
+
+        print(f"{result['snapshot']:<45} {result['time_limit']:>6} {result['first_solution_strategy']:<28} "
+              f"{result['metaheuristic']:<22} {str(result['objective']):>10} {str(result['dropped']):>7} "
+              f"{str(result['time_to_best']):>8}")
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as file:
+        json.dump({"benchmark": "replay", "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "results": results}, file, indent=2)
+
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# This file contains the solver convergence report. It reads the search traces saved by each optimisation and, for each
+# problem size, shows how long the search took to reach its best solution and how much of the time limit was spent
+# without improving it. Run from the project root with: python benchmarks/solver_traces.py
+import argparse
+import pathlib
+import sys
+
+import numpy as np
+
+ROOT_DIR = pathlib.Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+import search_trace
+
+# Upper bounds of the problem size buckets, in nodes
+SIZE_BUCKETS = (25, 50, 100, 250, 500, 1000, 2000, 5000)
+
+
+def size_bucket(nodes):
+    """Returns the label of the size bucket a problem falls into."""
+    lower = 0
+
+    for upper in SIZE_BUCKETS:
+        if nodes <= upper:
+            return f"{lower + 1}-{upper}"
+        lower = upper
+
+    return f">{SIZE_BUCKETS[-1]}"
+
+
+def summarise(traces, tolerance=0.01):
+    """
+    Summarises traces by problem size.
+    :param traces: List of trace dictionaries
+    :param tolerance: Proportion of the best objective a run must reach to count as converged
+    :return: Dictionary of size bucket to summary
+    """
+    buckets = {}
+
+    for trace in traces:
+        if trace["trace"]:
+            buckets.setdefault(size_bucket(trace["nodes"]), []).append(trace)
+
+    summary = {}
+    for bucket, bucket_traces in buckets.items():
+        converged = np.array([search_trace.time_to_quality(trace, tolerance) for trace in bucket_traces])
+        best = np.array([trace["time_to_best"] for trace in bucket_traces])
+        elapsed = np.array([trace["elapsed"] for trace in bucket_traces])
+
+        summary[bucket] = {
+            "runs": len(bucket_traces),
+            "median_time_to_best": float(np.median(best)),
+            "p90_time_to_converge": float(np.percentile(converged, 90)),
+            "wasted_share": float(np.mean((elapsed - best) / elapsed)),
+            "improving_solutions": float(np.mean([trace["improving_solutions"] for trace in bucket_traces]))
+        }
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarises solver convergence from saved search traces.")
+    parser.add_argument("--path", type=pathlib.Path, default=search_trace.TRACE_PATH, help="Trace file to read")
+    parser.add_argument("--fingerprint", help="Only include runs of this problem")
+    parser.add_argument("--tolerance", type=float, default=0.01,
+                        help="Proportion of the best objective a run must reach to count as converged")
+    args = parser.parse_args()
+
+    traces = search_trace.load_traces(args.path, fingerprint=args.fingerprint)
+
+    if not traces:
+        print(f"No traces found in {args.path}.")
+        return 1
+
+    print(f"{'Nodes':>10} {'Runs':>5} {'Median best (s)':>16} {'P90 within tol (s)':>19} {'Wasted':>7} "
+          f"{'Improvements':>13}")
+
+    summary = summarise(traces, args.tolerance)
+    for bucket in sorted(summary, key=lambda label: int(label.strip(">").split("-")[0])):
+        row = summary[bucket]
+        print(f"{bucket:>10} {row['runs']:>5} {row['median_time_to_best']:>16.3f} "
+              f"{row['p90_time_to_converge']:>19.3f} {row['wasted_share']:>7.0%} {row['improving_solutions']:>13.1f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,7 @@ import geolocation
 import navigation
 import validate
 import classes
+import search_index
 from data_manager import DataManagerMixin
 from sqlalchemy import Column, String, Date, Time, DateTime, Integer, PickleType, ForeignKey, func
 from sqlalchemy.orm import relationship
@@ -655,6 +656,7 @@ class Clinician(Human, DataManagerMixin.Base):
     team = relationship("Team", back_populates="clins")
     _discipline = Column(String, nullable=True)
     _skill_list = Column(MutableList.as_mutable(PickleType), nullable=True)
+    _travel_mode = Column(String, nullable=True)
     visits = relationship("Visit", back_populates="clin")
     _inactive_reason = Column(String, nullable=True)
     created_instant = Column(DateTime, server_default=func.now())
@@ -665,10 +667,11 @@ class Clinician(Human, DataManagerMixin.Base):
     _c_inactive_reason = ("no longer works here", "switched roles", "added in error")
     _c_skill_list = ("med administration", "specimen collection", "domestic tasks", "physical assessment")
     _c_discipline = ("doctor", "nurse", "physical therapist", "occupational Therapist", "medical assistant")
+    _c_travel_mode = ("driving", "walking", "bicycling", "transit")
 
     def __init__(self, id=None, status=1, name="", dob="", sex="", address="",
                  team="", start_time="800", end_time="1700", discipline=None,
-                 skill_list=[], **kwargs):
+                 skill_list=[], travel_mode="driving", **kwargs):
         """Initiates and writes-to-file a clinician with the following attributes:
         id, first name, last name, middle name, date of birth, sex, and address
         Assumes standard shift time for start and end time, and inherits address for start/end address.
@@ -684,6 +687,7 @@ class Clinician(Human, DataManagerMixin.Base):
         self.team_id = team
         self.discipline = discipline
         self.skill_list = skill_list
+        self.travel_mode = travel_mode
         self._inactive_reason = None
 
         # Update all attributes from passed dict if provided
@@ -898,6 +902,26 @@ class Clinician(Human, DataManagerMixin.Base):
 
             self._skill_list = skill_list
 
+    @property
+    def travel_mode(self):
+        """Mode the clinician travels between visits by. Clinicians created before modes were recorded drive."""
+        return (self._travel_mode or self._c_travel_mode[0]).capitalize()
+
+    @travel_mode.setter
+    def travel_mode(self, value):
+        if not value:
+            self._travel_mode = self._c_travel_mode[0]
+
+        else:
+            travel_mode = validate.valid_cat_list(value, self._c_travel_mode)
+
+            # Invalid selections are returned as the ValueError class rather than raised
+            if travel_mode in self._c_travel_mode:
+                self._travel_mode = travel_mode
+
+            else:
+                raise ValueError(f"{str(value).capitalize()} is not a valid travel mode.")
+
     @property
     def inactive_reason(self):
         return self._inactive_reason
@@ -931,10 +955,11 @@ class Clinician(Human, DataManagerMixin.Base):
                                           "     3. Modify Personal Address\n"
                                           "     4. Modify Discipline\n"
                                           "     5. Modify Skills\n"
-                                          "     6. Assign Team\n"
-                                          "     7. Optimize Route\n"
-                                          "     8. Display Route\n"
-                                          "     9. Inactivate Record\n"
+                                          "     6. Modify Travel Mode\n"
+                                          "     7. Assign Team\n"
+                                          "     8. Optimize Route\n"
+                                          "     9. Display Route\n"
+                                          "     10. Inactivate Record\n"
                                           "\n"
                                           "Selection: ")
 
@@ -966,21 +991,26 @@ class Clinician(Human, DataManagerMixin.Base):
                 with self.session_scope():
                     self.modify_skills()
 
-            # Assign team
+            # Modify travel mode
             elif selection == "6":
+                with self.session_scope():
+                    self.modify_travel_mode()
+
+            # Assign team
+            elif selection == "7":
                 with self.session_scope():
                     self.assign_team()
 
             # Optimize route
-            elif selection == "7":
+            elif selection == "8":
                 self.optimize_route()
 
             # display route
-            elif selection == "8":
+            elif selection == "9":
                 self.display_route()
 
             # Inactivate record
-            elif selection == "9":
+            elif selection == "10":
                 with self.session_scope():
                     self.inactivate_self()
                     return 0
@@ -1125,6 +1155,37 @@ class Clinician(Human, DataManagerMixin.Base):
         self.write_obj(self.session)
         return 1
 
+    def modify_travel_mode(self):
+        """
+        Updates the mode the clinician travels between visits by. Used to calculate travel times when optimizing and
+        to draw the clinician's route.
+        :return: 1 if successful
+        """
+        attr_list = [
+            {
+                "term": f"Travel Mode. Previous: {self.travel_mode}",
+                "attr": "travel_mode",
+                "cat_list": self._c_travel_mode,
+            },
+        ]
+
+        # Update all attributes from above. Quit if user quits during any attribute
+        if not validate.get_info(self, attr_list):
+            self.refresh_self(self.session)
+            return 0
+
+        detail_dict = {
+            "Travel Mode": self.travel_mode,
+        }
+
+        # If user does not confirm info, changes will be reverted.
+        if not validate.confirm_info(detail_dict):
+            self.refresh_self(self.session)
+            return 0
+
+        self.write_obj(self.session)
+        return 1
+
     def optimize_route(self):
         """
         Calculates the estimated trip route for the clinician.
@@ -1225,3 +1286,8 @@ class Clinician(Human, DataManagerMixin.Base):
             print("Record successfully inactivated.")
 
             return 1
+
+
+# Keep the name search index in sync with patient and clinician records
+search_index.register(Patient)
+search_index.register(Clinician)
@@ -4,6 +4,7 @@ from sqlalchemy import Column, String, Integer, DateTime, func
 from sqlalchemy.orm import relationship
 from data_manager import DataManagerMixin
 import geolocation
+import search_index
 import validate
 import navigation
 
@@ -326,3 +327,7 @@ class Team(DataManagerMixin, DataManagerMixin.Base):
         with self.session_scope():
             geolocation.display_route(self)
     # TODO: Add a class method to reactivate a record
+
+
+# Keep the name search index in sync with team records
+search_index.register(Team)
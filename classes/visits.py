@@ -7,7 +7,7 @@ from sqlalchemy import Column, String, Date, Time, Integer, PickleType, ForeignK
 from sqlalchemy.ext.mutable import MutableList
 from sqlalchemy.orm import relationship
 from data_manager import DataManagerMixin
-from datetime import datetime, date
+from datetime import date
 
 
 class Visit(DataManagerMixin, DataManagerMixin.Base):
@@ -728,15 +728,18 @@ class Visit(DataManagerMixin, DataManagerMixin.Base):
 
     @classmethod
     def evaluate_requests(cls):
-        """Evaluates all Visits and marks them as no shows if they are past their expected date"""
+        """
+        Expires all active visits whose expected date is before today. This is issued as a single set-based UPDATE so
+        the database does the filtering, rather than loading and merging every visit in the table.
+        :return: Number of visits expired
+        """
         with cls.class_session_scope() as session:
-            for visit in session.query(Visit).distinct().all():
-                # Evaluate date against current date and mark as expired if due before current date
-                if datetime.strptime(visit.exp_date, '%d-%m-%Y').date() < date.today():
-                    visit.status = 0
-                    visit.cancel_reason = cls._c_cancel_reason[3]
+            # Mark visits as inactive with a cancel reason of expired if due before current date
+            expired = session.query(cls) \
+                .filter(cls._exp_date < date.today(), cls._status == 1) \
+                .update({cls._status: 0, cls._cancel_reason: cls._c_cancel_reason[3]}, synchronize_session=False)
 
-                    visit.write_obj(session)
+        return expired
 
     # TODO: Add a class method to reactivate a record
     # TODO: Add a method to find all visits today without a clinician
@@ -1,12 +1,15 @@
 import pathlib
 import validate
 from sqlalchemy.orm import sessionmaker, declarative_base, reconstructor
-from sqlalchemy import create_engine, desc
+from sqlalchemy import create_engine, desc, event, inspect, text
 from contextlib import contextmanager
-import pandas as pd
+from lazy_import import lazy_import
 import time
 import itertools
 
+# Pandas is only needed for csv import and export, so it is imported when first used
+pd = lazy_import("pandas")
+
 class DataManagerMixin:
     """
     Manages data for each class as a SQLite database using SQL Alchemy's ORM module.
@@ -73,11 +76,23 @@ class DataManagerMixin:
     @classmethod
     def create_tables(cls):
         """
-        Creates tables based on metadata provided. This will convert the __table__ attribute
+        Creates tables based on metadata provided. This will convert the __table__ attribute. Nullable columns added to
+        a class since its table was created are added to the existing table, and are empty for existing rows.
         :return: None
         """
         cls.Base.metadata.create_all(cls.engine)
 
+        inspector = inspect(cls.engine)
+
+        with cls.engine.begin() as connection:
+            for table in cls.Base.metadata.sorted_tables:
+                existing = {column["name"] for column in inspector.get_columns(table.name)}
+
+                for column in table.columns:
+                    if column.name not in existing and column.nullable:
+                        connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" '
+                                                f'{column.type.compile(cls.engine.dialect)}'))
+
     def write_obj(self, session, override=1):
         """
         Creates a new row in a table. Corresponding table is specified in the class of the object passed to this function.
@@ -281,3 +296,15 @@ class DataManagerMixin:
 
         cls._id_iter = itertools.count(max_id+1)
         return 1
+
+
+@event.listens_for(DataManagerMixin.engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """
+    Enables write-ahead logging so that background job workers can write while other processes read, and waits for
+    locks to clear rather than failing immediately.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
@@ -1,19 +1,38 @@
 # Contains functions related to geolocation using Google OR tools and map APIs. Folium for visualisation.
-import folium
-from folium import plugins
-import osmnx as ox
-import networkx as nx
-import pandas as pd
 import numpy as np
+from lazy_import import lazy_import
 import validate
 import navigation
+import road_graph
+import geometry
+import map_cache
+import route_export
+import leg_routing
+import matrix_providers
+import metrics
+import search_trace
+import problem_snapshot
+import route_solution
+import solution_analysis
+import travel_slices
 import classes
-import boto3
-import requests
-from ortools.constraint_solver import routing_enums_pb2
-from ortools.constraint_solver import pywrapcp
 import datetime
 from time import sleep
+from sqlalchemy.orm import object_session
+
+# Mapping, routing and data frame libraries are only imported when first used
+folium = lazy_import("folium")
+plugins = lazy_import("folium.plugins")
+pd = lazy_import("pandas")
+boto3 = lazy_import("boto3")
+requests = lazy_import("requests")
+routing_enums_pb2 = lazy_import("ortools.constraint_solver.routing_enums_pb2")
+pywrapcp = lazy_import("ortools.constraint_solver.pywrapcp")
+
+# What-if scenarios are estimates, so they stop at the first local optimum found by greedy descent instead of running
+# guided local search for the full time limit. The limit caps the descent on large scenarios.
+WHAT_IF_TIME_LIMIT = 0.25
+WHAT_IF_METAHEURISTIC = "GREEDY_DESCENT"
 
 
 def optimize_route(obj):
@@ -40,99 +59,239 @@ def optimize_route(obj):
         if val_date:
             break
 
+    # Load the clinicians and visits to optimize
+    try:
+        with metrics.span("load_problem"):
+            clins, visits = day_problem(obj, val_date)
+
+    except ValueError as err:
+        print(f"{err} Returning...")
+        sleep(1.5)
+        return 0
+
+    # Generate data for optimisation problem. Pass clinician as a list top proper handling.
+    with metrics.span("generate_data"):
+        data_dict = generate_data(visits, clins)
+
+    # Generate distance matrix for each clinician's travel mode and shift start
+    dist_matrix = create_dist_matrix(data_dict["plus_code_list"], data_dict["coord_list"],
+                                     slices=data_dict["slices"], val_date=val_date)
+
+    if not isinstance(dist_matrix, np.ndarray) or not dist_matrix.any():
+        return 0
+
+    # Save the problem for offline replay if snapshots are enabled
+    problem_snapshot.snapshot_problem(dist_matrix, data_dict, obj_type=type(obj).__name__, obj_id=obj.id,
+                                      date=val_date)
+
+    # Calculate optimal route - this returns a list of lists per clinician, so can safely assume we want index 0
+    with metrics.span("solve"):
+        manager, routing, solution = route_optimizer(dist_matrix, len(clins), data_dict["start_list"],
+                                                     data_dict["end_list"], data_dict["time_windows"],
+                                                     data_dict["capacities"], data_dict["weights"],
+                                                     data_dict["priorities"], data_dict["skills"],
+                                                     data_dict["disc"], vehicle_slices=data_dict["vehicle_slices"])
+
+    if not solution:
+        metrics.record_solver(routing, solution, len(visits), 0)
+        print("No solution found. Returning...")
+        sleep(2)
+        return 0
+
+    # Classify the visits that could not be seen and extract each route once. Displaying and saving both use this.
+    dropped = solution_analysis.dropped_visits(manager, routing, solution, dist_matrix, data_dict)
+    plan = route_solution.RouteSolution.from_solver(manager, routing, solution, len(clins), len(visits), dropped)
+    metrics.record_solver(routing, solution, len(visits), len(plan.dropped))
+
+    # Open session to commit changes before prompting route display
+    with obj.session_scope():
+        # Create optimal route order and assign to each clinician. Pass clin as list for proper handling.
+        return_solution(clins, visits, plan)
+
+    # Prompt user for which type of map to load
+    confirm = validate.yes_or_no("View route on map?: ")
+
+    if not confirm:
+        return 0
+
+    display_route(obj, val_date=val_date)
+    return 1
+
+
+def day_problem(obj, val_date):
+    """
+    Loads the clinicians and visits to optimize for a clinician or team on a date.
+    :param obj: Clinician or team to optimize
+    :param val_date: Date to optimize
+    :return: Tuple of (list of clinicians, list of visits)
+    :raises ValueError: If there is nothing to optimize
+    """
     # If team, load list of all linked clinicians
     if isinstance(obj, classes.team.Team):
         # Cancel if team is empty
         if not obj.pats:
-            print("This team does not have any patients associated with it. Returning...")
-            sleep(1.5)
-            return 0
+            raise ValueError("This team does not have any patients associated with it.")
 
         if not obj.clins:
-            print("This team does not have any clinicians associated with it. Returning...")
-            sleep(1.5)
-            return 0
+            raise ValueError("This team does not have any clinicians associated with it.")
 
         clins = obj.clins
 
-        # Grab patients linked to team
-        pats = obj.pats
-
         # Grab all visits across all patients in team, then unpack for single list of team visits
-        visits = [visit for pat in pats for visit in pat.visits if visit._exp_date == val_date]
-
-        if not visits:
-            print("There are no visits assigned on this date. Returning...")
-            sleep(1.5)
-            return 0
+        visits = [visit for pat in obj.pats for visit in pat.visits if visit._exp_date == val_date]
 
     # If clin, put clin into list for consistent handling
     elif isinstance(obj, classes.person.Clinician):
         clins = [obj]
-
         visits = [visit for visit in obj.visits if visit._exp_date == val_date]
 
-        if not visits:
-            print("There are no visits assigned on this date. Returning...")
-            sleep(1.5)
+    else:
+        raise ValueError("Invalid object.")
+
+    if not visits:
+        raise ValueError("There are no visits assigned on this date.")
+
+    return clins, visits
+
+
+def solve_day(obj, val_date, mode=None, provider="google"):
+    """
+    Optimizes a clinician or team's visits on a date and saves the route order without prompting the user. Used by
+    background workers.
+    :param obj: Clinician or team to optimize
+    :param val_date: Date to optimize
+    :param mode: Transportation mode for every clinician. If not passed through, each clinician's travel mode is used.
+    :param provider: Travel time matrix provider
+    :return: Dictionary summarising the solution
+    :raises ValueError: If there is nothing to optimize or no solution can be found
+    """
+    with metrics.span("load_problem"):
+        clins, visits = day_problem(obj, val_date)
+
+    with metrics.span("generate_data"):
+        data_dict = generate_data(visits, clins, mode=mode)
+
+    dist_matrix = create_dist_matrix(data_dict["plus_code_list"], data_dict["coord_list"], provider=provider,
+                                     slices=data_dict["slices"], val_date=val_date)
+
+    if not isinstance(dist_matrix, np.ndarray) or not dist_matrix.any():
+        raise ValueError("Unable to generate a travel time matrix.")
+
+    problem_snapshot.snapshot_problem(dist_matrix, data_dict, obj_type=type(obj).__name__, obj_id=obj.id,
+                                      date=val_date, mode=mode, provider=provider)
+
+    with metrics.span("solve", provider=provider):
+        manager, routing, solution = route_optimizer(dist_matrix, len(clins), data_dict["start_list"],
+                                                     data_dict["end_list"], data_dict["time_windows"],
+                                                     data_dict["capacities"], data_dict["weights"],
+                                                     data_dict["priorities"], data_dict["skills"],
+                                                     data_dict["disc"], vehicle_slices=data_dict["vehicle_slices"])
+
+    if not solution:
+        metrics.record_solver(routing, solution, len(visits), 0, provider=provider)
+        raise ValueError("No solution found.")
+
+    dropped = solution_analysis.dropped_visits(manager, routing, solution, dist_matrix, data_dict)
+    plan = route_solution.RouteSolution.from_solver(manager, routing, solution, len(clins), len(visits), dropped)
+    metrics.record_solver(routing, solution, len(visits), len(plan.dropped), provider=provider)
+
+    with obj.session_scope():
+        save_solution(clins, visits, plan)
+
+    return plan.summary()
+
+
+def what_if_scenario(team):
+    """
+    Solves a what-if scenario for a team on a date, optionally adding clinicians from other teams. Travel times are
+    estimated from straight-line distance and the search stops at the first local optimum, so the solve takes
+    milliseconds. Nothing is saved.
+    :param team: Team to plan
+    :return: 1 if a solution was found
+    """
+    # Get date to plan
+    while True:
+        inp_date = validate.qu_input("Please select a date to plan: ")
+
+        if not inp_date:
             return 0
 
-    # Generate data for optimisation problem. Pass clinician as a list top proper handling.
-    data_dict = generate_data(visits, clins)
+        try:
+            val_date = validate.valid_date(inp_date).date()
 
-    # Generate distance matrix
-    dist_matrix = create_dist_matrix(data_dict["plus_code_list"])
+        except AttributeError:
+            print("Invalid date format.")
+            continue
+
+        if val_date:
+            break
 
-    if not dist_matrix.any():
+    visits = [visit for pat in team.pats for visit in pat.visits if visit._exp_date == val_date]
+
+    if not visits:
+        print("There are no visits assigned on this date. Returning...")
+        sleep(1.5)
         return 0
 
-    # Calculate optimal route - this returns a list of lists per clinician, so can safely assume we want index 0
+    # Allow the user to add clinicians to the scenario
+    clins = list(team.clins)
+
+    while validate.yes_or_no(f"The scenario has {len(clins)} clinician(s). Add a clinician? "):
+        clin = classes.person.Clinician.get_obj(team.session)
+
+        if clin and clin not in clins:
+            clins.append(clin)
+
+    if not clins:
+        print("The scenario does not have any clinicians. Returning...")
+        sleep(1.5)
+        return 0
+
+    data_dict = generate_data(visits, clins)
+    dist_matrix = create_dist_matrix(data_dict["plus_code_list"], data_dict["coord_list"], provider="estimate",
+                                     slices=data_dict["slices"], val_date=val_date)
+
     manager, routing, solution = route_optimizer(dist_matrix, len(clins), data_dict["start_list"],
                                                  data_dict["end_list"], data_dict["time_windows"],
                                                  data_dict["capacities"], data_dict["weights"],
                                                  data_dict["priorities"], data_dict["skills"],
-                                                 data_dict["disc"])
+                                                 data_dict["disc"], time_limit=WHAT_IF_TIME_LIMIT,
+                                                 metaheuristic=WHAT_IF_METAHEURISTIC,
+                                                 vehicle_slices=data_dict["vehicle_slices"])
 
     if not solution:
-        print("No solution found. Returning...")
-        sleep(2)
+        print("No solution found for this scenario.")
         return 0
 
-    # Find all nodes that could not be visited and their penalties
-    dropped_nodes = {}
-
-    for node in range(routing.Size()):
-        if solution.Value(routing.NextVar(node)) == node and not routing.IsStart(node) and not routing.IsEnd(node):
-            dropped_nodes[node] = "Skill/Discipline Mismatch" if routing.GetDisjunctionMaxCardinality(
-                node) <= 1 else "Time Window Mismatch"
+    dropped = solution_analysis.dropped_visits(manager, routing, solution, dist_matrix, data_dict)
+    plan = route_solution.RouteSolution.from_solver(manager, routing, solution, len(clins), len(visits), dropped)
 
-    # Open session to commit changes before prompting route display
-    with obj.session_scope():
-        # Create optimal route order and assign to each clinician. Pass clin as list for proper handling.
-        return_solution(clins, visits, len(data_dict["start_list"]), dropped_nodes, manager, routing, solution)
-
-    # Prompt user for which type of map to load
-    confirm = validate.yes_or_no("View route on map?: ")
+    # Display the estimated routes for each clinician
+    for clin_index, clin in enumerate(clins):
+        print_to_screen(clin_index, clin, visits, plan)
 
-    if not confirm:
-        return 0
+    print(f"\nEstimated visits seen: {plan.num_assigned} of {len(visits)}")
 
-    display_route(obj, val_date=val_date)
+    validate.qu_input("Press enter to continue.")
     return 1
 
 
-def generate_data(visits, clins):
+def generate_data(visits, clins, mode=None):
     """
     Generates the relevant data for route optimization problems.
     :param visits: List of visits
     :param clins: List of clinicians
+    :param mode: Transportation mode for every clinician. If not passed through, each clinician's travel mode is used.
     :return: Dictionary with the following data:
+        - List of plus codes and coordinates for each location
         - List of starting locations for each clinician
         - List of end locations for each clinician
         - Time windows for each clinician and visit
         - Capacity for each clinician
         - Weights for each visit based on complexity
         - Priority for each visit
+        - Skills and discipline for each clinician and visit
+        - Travel time slices by mode and departure hour, and the slice each clinician uses
     """
     visit_plus_codes = [visit.plus_code for visit in visits]
 
@@ -143,6 +302,10 @@ def generate_data(visits, clins):
     # Combine clinician and patient addresses together
     plus_code_list = start_list + visit_plus_codes + end_list
 
+    # Coordinates in the same order, used by local travel time matrix providers
+    coord_list = [clin.start_coord for clin in clins] + [visit.coord for visit in visits] + \
+                 [clin.end_coord for clin in clins]
+
     # Pass through start and end list (last N indices of plus code list) as indices of distance matrix
     start_indices = [num for num in range(len(start_list))]
     end_indices = [num for num in range(len(start_list) + len(visit_plus_codes), len(plus_code_list))]
@@ -182,8 +345,13 @@ def generate_data(visits, clins):
     visit_disc = [visit._discipline for visit in visits]
     disc = clin_disc + visit_disc
 
+    # Get the travel mode and departure hour of each clinician, which select the travel time slice for their route
+    clin_modes = [mode or clin._travel_mode or clin._c_travel_mode[0] for clin in clins]
+    slices, vehicle_slices = travel_slices.vehicle_slices(clin_window, clin_modes)
+
     data_dict = {
         "plus_code_list": plus_code_list,
+        "coord_list": coord_list,
         "start_list": start_indices,
         "end_list": end_indices,
         "time_windows": time_windows,
@@ -191,7 +359,9 @@ def generate_data(visits, clins):
         "weights": weights,
         "priorities": priorities,
         "skills": skills,
-        "disc": disc
+        "disc": disc,
+        "slices": slices,
+        "vehicle_slices": vehicle_slices
     }
 
     return data_dict
@@ -199,10 +369,12 @@ def generate_data(visits, clins):
 
 def route_optimizer(dist_matrix, num_clinicians, start_list, end_list,
                     time_windows, capacities, weights, priorities,
-                    skills, discipline):
+                    skills, discipline, time_limit=1, first_solution_strategy="PATH_CHEAPEST_ARC",
+                    metaheuristic="GUIDED_LOCAL_SEARCH", vehicle_slices=None):
     """
     Passes locations through route optimizer to generate optimal route solution.
-    :param dist_matrix: A matrix outlining the amount of time required to transit to each location
+    :param dist_matrix: A matrix outlining the amount of time required to transit to each location, or an array of
+        matrices (one per departure hour) from which each clinician uses the slice given by vehicle_slices
     :param num_clinicians: Number of clinicians to consider in calculation
     :param start_list: List of starting location indexes for each clinician
     :param end_list: List of ending location indexes for each clinician
@@ -212,30 +384,55 @@ def route_optimizer(dist_matrix, num_clinicians, start_list, end_list,
     :param priorities: A numeric representation of visit priority. Determines which visits should be dropped first
     :param skills: Skills posessed by clinicians and skills required for visits
     :param discipline: The discipline of the clinician and the discipline required for visits
+    :param time_limit: Seconds the solver may search for
+    :param first_solution_strategy: Name of the OR tools strategy used to build the first solution
+    :param metaheuristic: Name of the OR tools local search metaheuristic used to improve the first solution
+    :param vehicle_slices: Index of the matrix slice used by each clinician. Ignored for a single matrix.
     :return: Optimized solution
     """
+    # Hold a single matrix as one slice shared by every clinician
+    dist_matrix = np.asarray(dist_matrix)
+    num_locations = dist_matrix.shape[-1]
+
+    if dist_matrix.ndim == 2 or vehicle_slices is None:
+        slices, vehicle_slices = dist_matrix.reshape(-1, num_locations, num_locations)[:1], [0] * num_clinicians
+    else:
+        slices = dist_matrix
+
     # Create index/routing manager - location number corresponds to index in distance matrix (0 = start, last = end)
-    manager = pywrapcp.RoutingIndexManager(len(dist_matrix), num_clinicians, start_list, end_list)
+    manager = pywrapcp.RoutingIndexManager(num_locations, num_clinicians, start_list, end_list)
     routing = pywrapcp.RoutingModel(manager)
 
-    def transit_callback(from_index, to_index):
+    def slice_callback(matrix):
         """
-        Accepts a from and to index and returns the corresponding part of the distance matrix
-        :param from_index: index of departure location
-        :param to_index: index of arrival location
-        :return: travel time between 2
+        Creates a transit callback for a slice of the distance matrix. The slice is held as lists, as the solver calls
+        the callback for every arc it evaluates.
+        :param matrix: Distance matrix slice
+        :return: Transit callback
         """
-        # Convert from routing variable Index to distance matrix NodeIndex
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return dist_matrix[from_node][to_node]
-
-    # Create a callback index using the transit time callback nested function
-    transit_callback_index = routing.RegisterTransitCallback(transit_callback)
+        matrix = matrix.tolist()
+
+        def transit_callback(from_index, to_index):
+            """
+            Accepts a from and to index and returns the corresponding part of the distance matrix
+            :param from_index: index of departure location
+            :param to_index: index of arrival location
+            :return: travel time between 2
+            """
+            # Convert from routing variable Index to distance matrix NodeIndex
+            from_node = manager.IndexToNode(from_index)
+            to_node = manager.IndexToNode(to_index)
+            return matrix[from_node][to_node]
+
+        return transit_callback
+
+    # Create a callback index for each slice, and look up the callback each clinician travels by
+    slice_callback_indices = [routing.RegisterTransitCallback(slice_callback(matrix)) for matrix in slices]
+    vehicle_callback_indices = [slice_callback_indices[slice_index] for slice_index in vehicle_slices]
 
     # Add time window constraints https://developers.google.com/optimization/routing/vrptw
-    routing.AddDimension(
-        transit_callback_index,
+    routing.AddDimensionWithVehicleTransits(
+        vehicle_callback_indices,
         1410,
         1410,
         False,
@@ -263,8 +460,9 @@ def route_optimizer(dist_matrix, num_clinicians, start_list, end_list,
         routing.AddVariableMinimizedByFinalizer(time_dimension.CumulVar(routing.Start(vehicle_id)))
         routing.AddVariableMaximizedByFinalizer(time_dimension.CumulVar(routing.End(vehicle_id)))
 
-    # Enable the routing function to use this transit time as its arc cost measurement
-    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+    # Enable the routing function to use each clinician's transit time as their arc cost measurement
+    for vehicle_id, callback_index in enumerate(vehicle_callback_indices):
+        routing.SetArcCostEvaluatorOfVehicle(callback_index, vehicle_id)
 
     # Establish counting dimension to track number of nodes visited (used for fair breakdown of visits)
     routing.AddConstantDimension(
@@ -312,72 +510,68 @@ def route_optimizer(dist_matrix, num_clinicians, start_list, end_list,
 
     # Define penalties, which will be proportional to the value of the visit priority for each index
     # Penalty cost will only be added if the disjunction is missed (ie a higher value should be less desirable to skip)
-    for node in range(len(start_list), len(dist_matrix) - len(end_list)):
+    for node in range(len(start_list), num_locations - len(end_list)):
         # Each node is made a disjunction so that it is an optional visit. "Red" visits will not be optional
         routing.AddDisjunction([manager.NodeToIndex(node)], priorities[node])
 
-    # Set up disjunction list for visits whose skills do not match with any clinicians.
-    # Each number is the number of the NODE that will be disjuncted
-    skill_disj_list = []
-
-    # Set up discipline and skill constraints. Loop over visit portion of list.
-    for location_index, visit_skill_disc in enumerate(list(zip(skills, discipline))[num_clinicians:]):
-        # Adjust index based on number of clinicians to only be visit locations. Initialize allowed vehicle list
-        location_index = location_index + num_clinicians
-        allow_list = []
-        # Loop over clinician skills and discs. If skills and disciplines match visit or are none/any, add to allow list
-        for clin_index, clin_skill_disc in enumerate(list(zip(skills, discipline))[:num_clinicians]):
-            # If the discipline or the skills are not specified in the visit, add to list
-            if not visit_skill_disc[0] and visit_skill_disc[1] == "any":
-                allow_list.append(clin_index)
-            # If the discipline matches and the clinician isn't missing any skills for the visit, add to list
-            elif visit_skill_disc[1] == clin_skill_disc[1] or visit_skill_disc[1] == "any":
-                if visit_skill_disc[0]:
-                    for skill in visit_skill_disc[0]:
-                        if skill not in clin_skill_disc[0]:
-                            break
-                        # If skill is final index of list, add to the allow list
-                        elif skill == visit_skill_disc[0][-1]:
-                            allow_list.append(clin_index)
-                else:
-                    allow_list.append(clin_index)
-        # Set the location index as allowed for anything in the allow list
-        if allow_list:
-            routing.SetAllowedVehiclesForIndex(allow_list, manager.NodeToIndex(location_index))
-        else:
-            skill_disj_list.append(location_index)
-
-    # Add a mandatory disjunctions to skip any visit that does not have matching skills or disc
-    routing.AddDisjunction([manager.NodeToIndex(node) for node in skill_disj_list], -1, 1)
+    # Set up discipline and skill constraints. Each visit may only be assigned to a clinician with its discipline (or
+    # any discipline) and all of its skills.
+    compatible = solution_analysis.compatibility_matrix(num_clinicians, skills, discipline)
 
-    # Set the search parameters and a heuristic for initial solution (prioritize cheapest arc - ie least transit time)
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+    for visit_index, allowed in enumerate(compatible):
+        index = manager.NodeToIndex(visit_index + num_clinicians)
 
-    search_parameters.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
-    search_parameters.log_search = True  # to get some logs
-    search_parameters.time_limit.seconds = 1
+        if allowed.any():
+            routing.SetAllowedVehiclesForIndex(np.flatnonzero(allowed).tolist(), index)
+        else:
+            # Remove every vehicle from any visit that does not have matching skills or disc, so it can only be
+            # dropped. Its priority disjunction above allows it to be skipped at the cost of its penalty.
+            routing.VehicleVar(index).RemoveValues(list(range(num_clinicians)))
 
-    # Solve the problem and print the solution
+    # Set the search parameters and a heuristic for initial solution (by default, prioritize cheapest arc - ie least
+    # transit time)
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.Value.Value(
+        first_solution_strategy)
+
+    search_parameters.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.Value.Value(metaheuristic)
+    search_parameters.time_limit.FromMilliseconds(int(time_limit * 1000))
+
+    # Record each solution found against time, so the trace can be saved with a fingerprint of the problem. The slice
+    # each clinician uses is only part of the problem when there is more than one.
+    trace = search_trace.SearchTrace(
+        routing,
+        search_trace.problem_fingerprint(dist_matrix, num_clinicians, start_list, end_list, time_windows,
+                                         capacities, weights, priorities, skills, discipline,
+                                         *([vehicle_slices] if dist_matrix.ndim == 3 else [])),
+        nodes=num_locations, vehicles=num_clinicians, slices=len(slices),
+        time_limit=time_limit, first_solution_strategy=first_solution_strategy, metaheuristic=metaheuristic)
+
+    # Solve the problem and save the search trace
     solution = routing.SolveWithParameters(search_parameters)
+    trace.finish(solution)
 
     return manager, routing, solution
 
 
-def create_dist_matrix(plus_code_list):
+def create_dist_matrix(plus_code_list, coord_list=None, mode=None, provider=None, slices=None, val_date=None):
     """
-    Generates a distance matrix using place_ids.
+    Generates a travel time matrix from the selected provider:
+        - google: Google's Distance Matrix API
+        - local: Shortest paths on the cached OpenStreetMaps road graph, with no API quota or network access
+        - hybrid: Local where the mode can be modelled and every pair is reachable, else Google
+        - estimate: Straight-line distance with a detour factor and average speed. Fast but approximate.
     :param plus_code_list: List of plus codes to calculate into a distance matrix
-    :return: distance matrix
+    :param coord_list: List of coordinates in the same order as the plus codes. Required for local providers.
+    :param mode: Transportation mode for every location. If neither this nor slices are passed through, user is
+        prompted.
+    :param provider: Matrix provider. If not passed through, user is prompted.
+    :param slices: List of [mode, departure hour] slices to build, as generated by generate_data
+    :param val_date: Date of the route, which sets the weekday of the traffic for time-sliced matrices
+    :return: distance matrix, or an array of one distance matrix per slice if there is more than one
     """
-    # Initiate AWS SSM integration for secrets storage
-    ssm = boto3.client('ssm')
-
-    # Grab api key from AWS and authenticate with google
-    google_api_key = ssm.get_parameter(Name="GOOGLE_CLOUD_API_KEY", WithDecryption=True)["Parameter"]["Value"]
-
     # Prompt user for desired mode of transit
-    while True:
+    while not mode and not slices:
         navigation.clear()
 
         mode_list = ["driving", "walking", "bicycling", "transit"]
@@ -389,9 +583,123 @@ def create_dist_matrix(plus_code_list):
 
         mode = validate.valid_cat_list(inp_mode, mode_list)
 
-        if mode:
+        if not isinstance(mode, str):
+            mode = None
+
+    # Prompt user for the travel time provider. Local providers need coordinates, so use Google if none are passed.
+    while not provider:
+        if not coord_list:
+            provider = "google"
             break
 
+        provider_list = ["google", "local", "hybrid", "estimate"]
+        validate.print_cat_value(provider_list, "Please select a travel time provider.")
+        inp_provider = validate.qu_input("Provider: ")
+
+        if not inp_provider:
+            return 0
+
+        provider = validate.valid_cat_list(inp_provider, provider_list)
+
+        if not isinstance(provider, str):
+            provider = None
+
+    slices = slices or [[mode, None]]
+
+    # Time the matrix once the user has made their selections
+    with metrics.span("dist_matrix", mode="+".join(dict.fromkeys(slice_mode for slice_mode, _ in slices)),
+                      provider=provider):
+        return build_slices(plus_code_list, coord_list, slices, provider, val_date)
+
+
+def build_slices(plus_code_list, coord_list, slices, provider, val_date=None):
+    """
+    Generates a travel time matrix for each slice without prompting the user. Each mode's matrices are read from or
+    saved to the slice cache together, so a mode shared by several clinicians is only built once.
+    :param plus_code_list: List of plus codes to calculate into a distance matrix
+    :param coord_list: List of coordinates in the same order as the plus codes
+    :param slices: List of [mode, departure hour] slices. The hour is None for a matrix for any time of day.
+    :param provider: Matrix provider
+    :param val_date: Date of the route, which sets the weekday of the traffic
+    :return: distance matrix, or an array of one distance matrix per slice if there is more than one
+    """
+    matrices = {}
+
+    for slice_mode in dict.fromkeys(slice_mode for slice_mode, _ in slices):
+        hours = [hour for mode, hour in slices if mode == slice_mode]
+        mode_matrices = travel_slices.time_sliced_matrix(
+            plus_code_list, slice_mode, provider, hours,
+            lambda hour: build_matrix(plus_code_list, coord_list, slice_mode, provider, hour, val_date), val_date)
+
+        if not isinstance(mode_matrices, np.ndarray):
+            return 0
+
+        matrices.update(zip(((slice_mode, hour) for hour in hours), mode_matrices))
+
+    # A single slice is returned as a plain matrix, which every clinician shares
+    if len(slices) == 1:
+        return matrices[tuple(slices[0])]
+
+    return np.stack([matrices[tuple(mode_hour)] for mode_hour in slices])
+
+
+def build_matrix(plus_code_list, coord_list, mode, provider, hour=None, val_date=None):
+    """
+    Generates a travel time matrix from a provider without prompting the user. See create_dist_matrix.
+    :param plus_code_list: List of plus codes to calculate into a distance matrix
+    :param coord_list: List of coordinates in the same order as the plus codes
+    :param mode: Transportation mode
+    :param provider: Matrix provider
+    :param hour: Departure hour. Google is asked for traffic at this time, and other providers apply the congestion
+        factor for the hour. If not passed through, travel times are for any time of day.
+    :param val_date: Date of the route, which sets the weekday of the traffic
+    :return: distance matrix
+    """
+    congestion = travel_slices.congestion_factor(mode, hour)
+
+    if provider == "estimate":
+        return matrix_providers.finalise_matrix(matrix_providers.estimate_dist_matrix(coord_list, mode) * congestion,
+                                                1410)
+
+    if provider in ("local", "hybrid"):
+        local_matrix = matrix_providers.osm_dist_matrix(coord_list, mode)
+
+        if local_matrix is not None:
+            local_matrix = local_matrix * congestion
+
+        if provider == "local":
+            if local_matrix is None:
+                print(f"Travel by {mode} cannot be calculated locally.")
+                return 0
+
+            # Unreachable pairs are given the full day so that the optimizer avoids them
+            return matrix_providers.finalise_matrix(local_matrix, 1410)
+
+        if local_matrix is not None and np.isfinite(local_matrix).all():
+            metrics.increment("hybrid_matrices", source="local")
+            return matrix_providers.finalise_matrix(local_matrix, 1410)
+
+        metrics.increment("hybrid_matrices", source="google")
+
+    return google_dist_matrix(plus_code_list, mode,
+                              travel_slices.departure_time(hour, val_date) if hour is not None else None)
+
+
+def google_dist_matrix(plus_code_list, mode, departure_time=None):
+    """
+    Generates a distance matrix using Google's Distance Matrix API.
+    :param plus_code_list: List of plus codes to calculate into a distance matrix
+    :param mode: Transportation mode
+    :param departure_time: Unix timestamp to request travel times in traffic for. If not passed through, travel times
+        do not account for traffic.
+    :return: distance matrix
+    """
+    # Initiate AWS SSM integration for secrets storage
+    ssm = boto3.client('ssm')
+
+    # Grab api key from AWS and authenticate with google
+    google_api_key = ssm.get_parameter(Name="GOOGLE_CLOUD_API_KEY", WithDecryption=True)["Parameter"]["Value"]
+
     # Define constraints for creating distance matrix - maximum 100 elements per query based on num origins and dests
     max_elements = 100
     max_cols = 25
@@ -402,6 +710,9 @@ def create_dist_matrix(plus_code_list):
     num_row_query, remaining_rows = divmod(num_addresses, rows_per_send)
     num_column_query, remaining_cols = divmod(num_addresses, max_cols)
 
+    # Request travel times in traffic when a departure time is given
+    departure = f"&departure_time={departure_time}" if departure_time else ""
+
     # Create distance matrix with Distance Matrix API - https://developers.google.com/maps/documentation/distance-matrix
     distance_matrix = np.empty((num_addresses, num_addresses), dtype="int")
 
@@ -422,7 +733,8 @@ def create_dist_matrix(plus_code_list):
             origins = "|".join(origin_addresses).replace(" ", "%20B").replace("+", "%2B")
             destinations = "|".join(destination_addresses).replace(" ", "%20B").replace("+", "%2B")
 
-            url = url + '&origins=' + origins + '&destinations=' + destinations + '&mode=' + mode + '&key=' + google_api_key
+            url = url + '&origins=' + origins + '&destinations=' + destinations + '&mode=' + mode + departure + \
+                  '&key=' + google_api_key
 
             response = query_dist_matrix(url)
 
@@ -441,7 +753,8 @@ def create_dist_matrix(plus_code_list):
             origins = "|".join(origin_addresses).replace(" ", "%20B").replace("+", "%2B")
             destinations = "|".join(destination_addresses).replace(" ", "%20B").replace("+", "%2B")
 
-            url = url + '&origins=' + origins + '&destinations=' + destinations + '&mode=' + mode + '&key=' + google_api_key
+            url = url + '&origins=' + origins + '&destinations=' + destinations + '&mode=' + mode + departure + \
+                  '&key=' + google_api_key
 
             response = query_dist_matrix(url)
 
@@ -485,7 +798,8 @@ def create_dist_matrix(plus_code_list):
             origins = "|".join(origin_addresses).replace(" ", "%20B").replace("+", "%2B")
             destinations = "|".join(destination_addresses).replace(" ", "%20B").replace("+", "%2B")
 
-            url = url + '&origins=' + origins + '&destinations=' + destinations + '&mode=' + mode + '&key=' + google_api_key
+            url = url + '&origins=' + origins + '&destinations=' + destinations + '&mode=' + mode + departure + \
+                  '&key=' + google_api_key
 
             response = query_dist_matrix(url)
 
@@ -503,7 +817,8 @@ def create_dist_matrix(plus_code_list):
             origins = "|".join(origin_addresses).replace(" ", "%20B").replace("+", "%2B")
             destinations = "|".join(destination_addresses).replace(" ", "%20B").replace("+", "%2B")
 
-            url = url + '&origins=' + origins + '&destinations=' + destinations + '&mode=' + mode + '&key=' + google_api_key
+            url = url + '&origins=' + origins + '&destinations=' + destinations + '&mode=' + mode + departure + \
+                  '&key=' + google_api_key
 
             response = query_dist_matrix(url)
 
@@ -540,16 +855,18 @@ def query_dist_matrix(url):
         response = requests.request("GET", url)
 
     except requests.exceptions.RequestException:
+        metrics.increment("google_api_requests", api="distance_matrix", result="error")
         print("Unable to validate address. Please try again.")
         return 0
 
+    metrics.increment("google_api_requests", api="distance_matrix", result=response.status_code)
     return response
 
 
 def build_dist_matrix(response):
     """
     Takes response from distance matrix API to add rows to the distance matrix. We will use travel time rather than
-    distance.
+    distance, and travel time in traffic where Google returns it.
     :param response: response from Google's distance matrix API
     :return: row for distance matrix
     """
@@ -557,7 +874,8 @@ def build_dist_matrix(response):
 
     for row in response['rows']:
         # Loop through each element in the rows of the response and populate a list of each value
-        row_list = [int(row["elements"][i]['duration']['value'] / 60) for i in range(len(row["elements"]))]
+        row_list = [int(element.get('duration_in_traffic', element['duration'])['value'] / 60)
+                    for element in row["elements"]]
 
         # Add row list to the array
         distance_matrix.append(row_list)
@@ -565,16 +883,12 @@ def build_dist_matrix(response):
     return distance_matrix
 
 
-def return_solution(clins, visits, n_start_list, dropped_nodes, manager, routing, solution):
+def return_solution(clins, visits, plan):
     """
     Prompts the user whether they want to print route solution to screen or file
     :param clins: Clinician whose route is being optimized
     :param visits: List of visits in optimisation problem
-    :param n_start_list: number of starting locations in address list
-    :param dropped_nodes: Represents all visits that could not be seen as part of the solution
-    :param manager: Index manager - parses details from distance matrix
-    :param routing: Routing Model - sets parameters for solution
-    :param solution: Solution from routing model
+    :param plan: RouteSolution extracted from the solver
     :return: None
     """
     # Prompt user about whether to print to screen or csv
@@ -590,236 +904,179 @@ def return_solution(clins, visits, n_start_list, dropped_nodes, manager, routing
         if not selection:
             return 0
 
+    # Assign each visit to its clinician in route order and save
+    save_solution(clins, visits, plan)
+
     # Print to Screen in text
     if selection == "1":
         # Print dropped nodes
         print(f"The following patients could not be seen: ")
-        for node in dropped_nodes:
-            disj_reason = dropped_nodes[node]
-            node = node - n_start_list
+        for node, disj_reason in plan.dropped_visits:
             print(
                 f"{node}) {visits[node].pat._name}: {visits[node].time_earliest} - {visits[node].time_latest}, "
                 f"Priority: {visits[node].visit_priority}, Complexity: {visits[node].visit_complexity}, "
                 f"Disjunction Reason: {disj_reason}")
 
         for clin_index, clin in enumerate(clins):
-            print_to_screen(clin_index, clin, visits, n_start_list, manager, routing, solution)
-
-            # Define route order for assignment to clinician
-            route_order = return_route(clin_index, manager, routing, solution)
-
-            # Remove the start and end locations of each address and subtract length of start index list from each index
-            clin_visits = [visits[index - n_start_list] for index in route_order[1:-1]]
-
-            # Assign clinician to visit (which assigns the visit to the clinician as well) and save
-            for index, visit in enumerate(clin_visits):
-                visit.clin_id = clin.id
-                visit._order = index
-                visit.sched_status = "assigned"
-                visit.write_obj(visit.session)
+            print_to_screen(clin_index, clin, visits, plan)
 
         return None
 
-    # Print to screen as dataframe
-    if selection == "2" or "3":
-        # Generate a dict of all visits that could not be undertaken for this team
-        dropped_nodes_dict = {}
-        for node in dropped_nodes:
-            disj_reason = dropped_nodes[node]
-            node = node - n_start_list
-            dropped_nodes_dict[visits[node].id] = {
-                "Clinician": "UNASSIGNED",
-                "Patient Name": visits[node].pat._name,
-                "Start By": visits[node].time_earliest,
-                "Leave By": visits[node].time_latest,
-                "Priority": visits[node].visit_priority,
-                "Complexity": visits[node].visit_complexity,
-                "Skills Required": visits[node].skill_list,
-                "Discipline Requested": visits[node].discipline,
-                "Address": visits[node].address,
-                "Driving Time": "N/A",
-                "Disjunction Reason": disj_reason
-            }
-        # Convert and display dropped nodes dataframe
-        dropped_nodes_df = pd.DataFrame.from_dict(dropped_nodes_dict, orient="index")
-
-        # Initialize a solutions dataframe and add dropped nodes to it
-        solution_df = pd.DataFrame(columns=["Clinician", "Patient Name", "Start By", "Leave By", "Priority",
-                                                "Complexity", "Skills Required", "Discipline Requested", "Address",
-                                                "Driving Time", "Disjunction Reason"])
-        solution_df = pd.concat([solution_df, dropped_nodes_df])
-
-        for clin_index, clin in enumerate(clins):
-            # Generate a solution dictionary for each clinician, then batch visits to assign to clinician
-            rt_detail = print_to_table(clin_index, clin, visits, n_start_list, manager, routing, solution)
-
-            # Define route order for assignment to clinician
-            route_order = return_route(clin_index, manager, routing, solution)
+    # Build the table once from the extracted routes
+    solution_df = solution_table(clins, visits, plan)
 
-            # Remove the start and end locations of each address and subtract length of start index list from each index
-            clin_visits = [visits[index - n_start_list] for index in route_order[1:-1]]
+    # Save file
+    if selection == "3":
+        while True:
+            # Get file path from user
+            path = validate.qu_input("File path to save (*.csv or *.parquet): ")
 
-            # Assign clinician to visit (which assigns the visit to the clinician as well) and save
-            for index, visit in enumerate(clin_visits):
-                visit.clin_id = clin.id
-                visit._order = index
-                visit.sched_status = "assigned"
-                visit.write_obj(visit.session)
+            # Prompt user if they want to continue if no path entered. If no, short circuit and print to screen
+            if not path:
+                cont = validate.qu_input("No file path entered. Print to screen instead? ")
+                if cont:
+                    break
 
-            # Convert rt_details to Pandas table and display
-            rt_detail = pd.DataFrame.from_dict(rt_detail, orient="index")
-            solution_df = pd.concat([solution_df, rt_detail])
+            try:
+                save_table(solution_df, path)
 
-        solution_df.index.name = "Visit ID"
+            except (FileNotFoundError, OSError):
+                print("Invalid path.")
 
-        # Save file
-        if selection == "3":
-            while True:
-                # Get file path from user
-                path = validate.qu_input("File path to save (*.csv): ")
+            except ImportError:
+                print("Saving to Parquet requires pyarrow. Save as csv instead.")
+                continue
 
-                # Prompt user if they want to continue if no path entered. If no, short circuit and print to screen
-                if not path:
-                    cont = validate.qu_input("No file path entered. Print to screen instead? ")
-                    if cont:
-                        break
+            # pyarrow raises ArrowInvalid (a ValueError) or ArrowTypeError (a TypeError) for columns it cannot convert
+            except (ValueError, TypeError) as err:
+                print(f"Unable to save as Parquet: {err}. Save as csv instead.")
+                continue
 
-                try:
-                    solution_df.to_csv(path)
+            return solution_df
 
-                except (FileNotFoundError, OSError):
-                    print("Invalid path.")
+    # Display the full solution data frame. Occurs if a user selected 2 or did not provide a path for csv
+    print(solution_df.to_markdown())
+    return solution_df
 
-                return solution_df
 
-        # Display the full solution data frame. Occurs if a user selected 2 or did not provide a path for csv
-        print(solution_df.to_markdown())
-        return solution_df
+def minutes_to_hhmm(minutes):
+    """Converts an array of minutes from midnight to HHMM strings."""
+    return np.char.zfill((minutes // 60 * 100 + minutes % 60).astype(str), 4)
 
 
-def print_to_screen(clin_index, clin, visits, n_start_list, manager, routing, solution):
+def solution_table(clins, visits, plan):
     """
-    Prints the solution to the route optimisation problem to the console.
-    :param clin_index: Index of the clinician whose route is being optimized
-    :param clin: Clinician whose route is being optimized
+    Builds a table of every visit in the solution, with the visits that could not be seen first. Visits that could not
+    be seen have no driving time or slack.
+    :param clins: Clinicians whose routes were optimized
     :param visits: List of visits in optimisation problem
-    :param n_start_list: number of starting locations in address list
-    :param manager: Index manager - parses details from distance matrix
-    :param routing: Routing Model - sets parameters for solution
-    :param solution: Solution from routing model
+    :param plan: RouteSolution extracted from the solver
+    :return: Data frame indexed by visit ID
+    """
+    # Only visit locations are shown, so remove each clinician's start and end location
+    routed = plan.visit_stops
+    dropped = np.array([index for index, _ in plan.dropped_visits], dtype=np.int64)
+    table_visits = [visits[index] for index in np.concatenate([dropped, plan.node[routed] - plan.num_clinicians])]
+
+    clin_names = np.array([clin.name for clin in clins], dtype=object)
+    unassigned = np.full(len(dropped), "UNASSIGNED", dtype=object)
+    not_routed = [pd.NA] * len(dropped)
+
+    solution_df = pd.DataFrame({
+        "Clinician": np.concatenate([unassigned, clin_names[plan.vehicle[routed]]]),
+        "Patient Name": [visit.pat._name for visit in table_visits],
+        "Start By": [visit.time_earliest for visit in table_visits[:len(dropped)]] +
+                    minutes_to_hhmm(plan.arrival[routed]).tolist(),
+        "Leave By": [visit.time_latest for visit in table_visits[:len(dropped)]] +
+                    minutes_to_hhmm(plan.latest[routed]).tolist(),
+        "Priority": [visit.visit_priority for visit in table_visits],
+        "Complexity": [visit.visit_complexity for visit in table_visits],
+        "Skills Required": [visit.skill_list for visit in table_visits],
+        "Discipline Requested": [visit.discipline for visit in table_visits],
+        "Address": [visit.address for visit in table_visits],
+        "Driving Time": pd.array(not_routed + plan.leg_time[routed].tolist(), dtype="Int64"),
+        "Slack": pd.array(not_routed + plan.slack[routed].tolist(), dtype="Int64"),
+        "Disjunction Reason": np.concatenate([plan.dropped["reason"].astype(object),
+                                              np.full(routed.sum(), "N/A", dtype=object)])
+    }, index=pd.Index([visit.id for visit in table_visits], name="Visit ID"))
+
+    return solution_df
+
+
+def save_table(solution_df, path):
+    """
+    Saves a solution table as csv, or as Parquet if the path ends in .parquet. Parquet keeps column types and is much
+    smaller for large multi-team reports, but requires pyarrow.
+    :param solution_df: Data frame from solution_table
+    :param path: File path
     :return: None
+    :raises ImportError: If saving to Parquet and pyarrow is not installed
+    :raises ValueError: If pyarrow cannot convert a column to Parquet
     """
-    print(f"Objective: {solution.ObjectiveValue()} minutes.")
+    if str(path).lower().endswith(".parquet"):
+        solution_df.to_parquet(path)
 
-    # Get time dimension
-    time_dimension = routing.GetDimensionOrDie('Time')
+    else:
+        solution_df.to_csv(path, na_rep="N/A")
 
-    # Start routing for clinician
-    index = routing.Start(clin_index)
-    plan_output = f"\nOptimal route for {clin.name}: \n"
-    route_time = 0
 
-    # Start routing output
-    plan_output += f'  Start ->'
-    previous_index = index
-    index = solution.Value(routing.NextVar(index))
-    route_time += routing.GetArcCostForVehicle(previous_index, index, 0)
+def save_solution(clins, visits, plan):
+    """
+    Assigns each visit in the solution to its clinician in route order and saves it. Every visit is written in a single
+    bulk UPDATE keyed by visit ID within the caller's transaction, rather than merged one at a time. The clinician IDs
+    come from the clinicians being optimized, so they are not looked up again for each visit.
+    :param clins: Clinicians whose routes were optimized
+    :param visits: List of visits in optimisation problem
+    :param plan: RouteSolution extracted from the solver
+    :return: Number of visits assigned
+    """
+    with metrics.span("save_solution"):
+        mappings = [{"_id": visits[visit_index].id, "_clin_id": clin.id, "_order": order, "_sched_status": "assigned"}
+                    for clin_index, clin in enumerate(clins)
+                    for order, visit_index in enumerate(plan.route(clin_index))]
 
-    # Add each index to plan_output
-    while not routing.IsEnd(index):
-        # Subtract number of items in start list from node to match with visits in visit list
-        visit = visits[manager.IndexToNode(index) - n_start_list]
-        # Get time window for each location
-        time_var = time_dimension.CumulVar(index)
-        start_hours, start_min = divmod(solution.Min(time_var), 60)
-        end_hours, end_min = divmod(solution.Max(time_var), 60)
-        plan_output += f'  {visit.pat._name} ' \
-                       f'(Start by: {datetime.time(hour=start_hours, minute=start_min).strftime("%H%M")}, ' \
-                       f'Leave by: {datetime.time(hour=end_hours, minute=end_min).strftime("%H%M")}) ->'
-        index = solution.Value(routing.NextVar(index))
+        if not mappings:
+            return 0
 
-    # Add final index
-    time_var = time_dimension.CumulVar(index)
-    plan_output += f' Return'
-    plan_output += f'\nRoute Time: {int(solution.Min(time_var) / 60)} minutes.'
+        # Loaded visits are refreshed when the transaction is committed, as the session expires them
+        session = object_session(visits[0])
+        session.bulk_update_mappings(classes.visits.Visit, mappings)
 
-    print(plan_output)
+    metrics.increment("visits_assigned", len(mappings))
+    return len(mappings)
 
 
-def print_to_table(clin_index, clin, visits, n_start_list, manager, routing, solution):
+def print_to_screen(clin_index, clin, visits, plan):
     """
-    Prints the solution to the route optimisation problem to a table using Pandas.
+    Prints the solution to the route optimisation problem to the console.
     :param clin_index: Index of the clinician whose route is being optimized
     :param clin: Clinician whose route is being optimized
     :param visits: List of visits in optimisation problem
-    :param n_start_list: number of starting locations in address list
-    :param manager: Index manager - parses details from distance matrix
-    :param routing: Routing Model - sets parameters for solution
-    :param solution: Solution from routing model
+    :param plan: RouteSolution extracted from the solver
     :return: None
     """
-    # Create a solutions dict
-    solutions_dict = {}
-
-    # Get time dimension
-    time_dimension = routing.GetDimensionOrDie('Time')
-
-    # Start routing for clinician
-    index = routing.Start(clin_index)
-    route_time = 0
+    print(f"Objective: {plan.objective} minutes.")
 
     # Start routing output
-    previous_index = index
-    index = solution.Value(routing.NextVar(index))
-    route_time += routing.GetArcCostForVehicle(previous_index, index, 0)
+    plan_output = f"\nOptimal route for {clin.name}: \n"
+    plan_output += f'  Start ->'
 
-    # Add each index to plan_output
-    while not routing.IsEnd(index):
+    # Add each visit with its time window to plan_output
+    stops = (plan.vehicle == clin_index) & plan.visit_stops
+    for node, arrival, latest in zip(plan.node[stops], plan.arrival[stops], plan.latest[stops]):
         # Subtract number of items in start list from node to match with visits in visit list
-        visit = visits[manager.IndexToNode(index) - n_start_list]
-        # Get time window for each location
-        time_var = time_dimension.CumulVar(index)
-        start_hours, start_min = divmod(solution.Min(time_var), 60)
-        end_hours, end_min = divmod(solution.Max(time_var), 60)
-        solutions_dict[visit.id] = {
-            "Clinician": clin.name,
-            "Patient Name": visit.pat._name,
-            "Start By": datetime.time(hour=start_hours, minute=start_min).strftime("%H%M"),
-            "Leave By": datetime.time(hour=end_hours, minute=end_min).strftime("%H%M"),
-            "Priority": visit.visit_priority,
-            "Complexity": visit.visit_complexity,
-            "Skills Required": visit.skill_list,
-            "Discipline Requested": visit.discipline,
-            "Address": visit.address,
-            "Driving Time": int(solution.Min(time_var) / 60),
-            "Disjunction Reason": "N/A"
-        }
-        index = solution.Value(routing.NextVar(index))
-
-    return solutions_dict
-
-
-def return_route(clin_index, manager, routing, solution):
-    """
-    Returns the solution to the route optimisation problem to the console.
-    :param clin_index: Index of the clinician whose route is being optimized
-    :param manager: Index manager - parses details from distance matrix
-    :param routing: Routing Model - sets parameters for solution
-    :param solution: Solution from routing model
-    :return: solution as a list of indices as a list per clinician with the start and end locations removed
-    """
-    index = routing.Start(clin_index)
-    route_order = []
-
-    # Add each index to plan_output
-    while not routing.IsEnd(index):
-        route_order.append(manager.IndexToNode(index))
-        index = solution.Value(routing.NextVar(index))
+        visit = visits[node - plan.num_clinicians]
+        start_hours, start_min = divmod(int(arrival), 60)
+        end_hours, end_min = divmod(int(latest), 60)
+        plan_output += f'  {visit.pat._name} ' \
+                       f'(Start by: {datetime.time(hour=start_hours, minute=start_min).strftime("%H%M")}, ' \
+                       f'Leave by: {datetime.time(hour=end_hours, minute=end_min).strftime("%H%M")}) ->'
 
     # Add final index
-    route_order.append(manager.IndexToNode(index))
+    plan_output += f' Return'
+    plan_output += f'\nRoute Time: {plan.route_time(clin_index)} minutes.'
 
-    return route_order
+    print(plan_output)
 
 
 def coord_average(coord_list):
@@ -904,13 +1161,13 @@ def display_route(obj, val_date=None):
         return 0
 
     # Load list of visits for each clinician as a list of lists. Sort by optmized order.
-    visits = [[visit for visit in clin.visits if visit._exp_date == val_date] for clin in clins]
-    visits = [sorted(visit_group, key=lambda x: x._order) for visit_group in visits]
+    with metrics.span("load_route"):
+        visits = route_visits(clins, val_date)
 
     # Verify that all visits have been given an order. Else: prompt to optimize or quit.
-    visits_missing_order = [visit for visit_group in visits for visit in visit_group if not visit._order]
+    visits_missing_order = [visit for visit_group in visits for visit in visit_group if visit._order is None]
 
-    if not visits_missing_order:
+    if visits_missing_order:
         selection = validate.qu_input("These visits are not yet optimized. Would you like to optimize now?")
 
         if not selection:
@@ -923,30 +1180,77 @@ def display_route(obj, val_date=None):
     # Prompt user for which type of map to load
     print("Please select how you would like to view the route:\n"
           "     1) Map Markers Only (Quick)\n"
-          "     2) Map with Full Route Info\n")
+          "     2) Map with Full Route Info\n"
+          "     3) Export Route (GeoJSON)\n")
 
     selection = -1
-    while selection not in ["1", "2"]:
+    while selection not in ["1", "2", "3"]:
         selection = validate.qu_input("Selection: ")
 
         if not selection:
             return 0
 
-    if selection == "1":
-        map_markers_only(clins, visits)
+    # Export ordered stops, leg geometries and ETAs for lightweight clients
+    if selection == "3":
+        return route_export.export_routes_file(clins, visits, val_date)
 
-    if selection == "2":
-        map_markers_and_polyline(clins, visits)
+    # Load the map from the cache, rendering it first if this route has not been rendered before
+    with metrics.span("render_map", kind="route" if selection == "2" else "markers"):
+        path = render_route_map(clins, visits, val_date, full_route=selection == "2")
 
+    if not path:
+        return 0
+
+    map_cache.open_map(path)
     return 1
 
 
+def route_visits(clins, val_date):
+    """
+    Loads the visits for each clinician on a date, sorted by optimized order.
+    :param clins: Clinicians on the route
+    :param val_date: Date of the route
+    :return: List of lists of visits, one per clinician
+    """
+    visits = [[visit for visit in clin.visits if visit._exp_date == val_date] for clin in clins]
+
+    return [sorted(visit_group, key=lambda x: (x._order is None, x._order or 0)) for visit_group in visits]
+
+
+def render_route_map(clins, visits, val_date, full_route=True, mode=None):
+    """
+    Returns the cached map for a route, building and caching it if the route has changed since it was last rendered.
+    :param clins: Clinicians on the route
+    :param visits: Visits for each clinician on the route, sorted by order
+    :param val_date: Date of the route
+    :param full_route: Flags whether the map shows the full route, or markers only
+    :param mode: Travel mode the route was optimized for. Defaults to each clinician's travel mode.
+    :return: Path to the map, or None if there is nothing to display
+    """
+    key = map_cache.route_key(clins, visits, val_date, "route" if full_route else "markers", mode=mode)
+    path = map_cache.load_map(key)
+
+    if path:
+        return path
+
+    if full_route:
+        route_map = map_markers_and_polyline(clins, visits, mode=mode)
+
+    else:
+        route_map = map_markers_only(clins, visits)
+
+    if route_map is None:
+        return None
+
+    return map_cache.save_map(route_map, key)
+
+
 def map_markers_only(clins, visits):
     """
     Generates a Folium map with markers for each patient. This does not show route details.
     :param clins: Clinicians on the route
     :param visits: Visits for each clinician on the route
-    :return: 1 if successful
+    :return: Folium map, or None if there are no visits
     """
     # Load coordinates for each visit and start and end coords for each clinician
     visit_locations = [[visit.coord for visit in visit_group] for visit_group in visits]
@@ -954,7 +1258,7 @@ def map_markers_only(clins, visits):
 
     if not center_coord:
         print("No visits assigned on this date. Returning...")
-        return 0
+        return None
 
     # Initialize map and set boundaries.
     route_map = folium.Map(location=center_coord)
@@ -968,8 +1272,9 @@ def map_markers_only(clins, visits):
         if not clin.visits:
             continue
 
-        # Add feature group for each clinician so they can be turned on or off
+        # Add feature group for each clinician so they can be turned on or off. Colours repeat for large teams.
         feature_group = folium.FeatureGroup(name=f"{clin.name}").add_to(route_map)
+        color = color_list[clin_index % len(color_list)]
 
         # Create tooltip for clinician end location
         clin_tooltip = f"""
@@ -979,6 +1284,7 @@ def map_markers_only(clins, visits):
                     <p><b>Capacity</b>: {clin.capacity}</p>
                     <p><b>Discipline</b>: {clin.discipline}</p>
                     <p><b>Skills Required</b>: {clin.skill_list}</p>
+                    <p><b>Travel Mode</b>: {clin.travel_mode}</p>
                     """
 
         # Create marker image for start location
@@ -986,7 +1292,7 @@ def map_markers_only(clins, visits):
             folium.Marker(
                 clin.start_coord,
                 tooltip=clin_tooltip,
-                icon=folium.Icon(icon_color='white', icon="glyphicon-home", color=color_list[clin_index]),
+                icon=folium.Icon(icon_color='white', icon="glyphicon-home", color=color),
             ))
 
         # Loop through visit coordinates and mark on map
@@ -1006,7 +1312,7 @@ def map_markers_only(clins, visits):
                 folium.Marker(
                     coord,
                     tooltip=visit_tooltip,
-                    icon=folium.Icon(icon_color='white', color=color_list[clin_index]),
+                    icon=folium.Icon(icon_color='white', color=color),
                 ))
 
             # Add number to marker
@@ -1014,7 +1320,7 @@ def map_markers_only(clins, visits):
                 folium.Marker(
                     coord,
                     tooltip=visit_tooltip,
-                    icon=number_icon(color_list[clin_index], visit_index + 1)
+                    icon=number_icon(color, visit_index + 1)
                 ))
 
         # Create marker image for end location
@@ -1022,42 +1328,36 @@ def map_markers_only(clins, visits):
             folium.Marker(
                 clin.end_coord,
                 tooltip=clin_tooltip,
-                icon=folium.Icon(icon_color='white', icon="glyphicon-home", color=color_list[clin_index]),
+                icon=folium.Icon(icon_color='white', icon="glyphicon-home", color=color),
             ))
 
-    # Add layer control to map and display in browser
+    # Add layer control to map
     folium.LayerControl().add_to(route_map)
-    route_map.show_in_browser()
 
+    return route_map
 
-def find_shortest_route(graph, start_coord, end_coord):
+
+def find_shortest_route(graph, orig_node, dest_node, mode="drive"):
     """
-    Finds the shortest route between two coordinates using nodes from OpenStreetMaps
+    Finds the shortest route between two nodes from OpenStreetMaps. Legs are cached by the leg routing engine.
     :param graph: NetworkX Graph providing nodes and edges
-    :param start_coord: Starting coordinates
-    :param end_coord: Ending coordinates
-    :return:
+    :param orig_node: Starting node, as snapped by road_graph.snap_coords
+    :param dest_node: Ending node, as snapped by road_graph.snap_coords
+    :param mode: Travel mode of the graph
+    :return: List of nodes along the route
     """
-    # find the nearest node to the start location
-    orig_node = ox.nearest_nodes(graph, start_coord[1], start_coord[0])
-    # find the nearest node to the end location
-    dest_node = ox.nearest_nodes(graph, end_coord[1], end_coord[0])
-    #  find the shortest path
-    shortest_route = nx.shortest_path(graph,
-                                      orig_node,
-                                      dest_node,
-                                      weight='time')
-
-    return shortest_route
+    return leg_routing.route_stops(graph, [orig_node, dest_node], mode, csr=road_graph.csr_graph(graph))[0]
 
 
-def map_markers_and_polyline(clins, visits):
+def map_markers_and_polyline(clins, visits, encode=False, mode=None):
     """
     Generates a Folium map with markers for each patient and a Polyline outlining the route.
     Route is calculated via NetworkX using nodes from OpenStreetMaps.
     :param clins: Clinicians on the route
     :param visits: Visits for each clinician on the route
-    :return: 1 if successful
+    :param encode: Flags whether routes are added to the map as encoded polylines, which makes the page smaller
+    :param mode: Travel mode the route was optimized for. Defaults to each clinician's travel mode.
+    :return: Folium map, or None if there are no visits
     """
     # Load coordinates for each visit and start and end coords for each clinician
     visit_locations = [[visit.coord for visit in visit_group] for visit_group in visits]
@@ -1066,7 +1366,7 @@ def map_markers_and_polyline(clins, visits):
 
     if not center_coord:
         print("No visits assigned on this date. Returning...")
-        return 0
+        return None
 
     # Get coordinates for bounding box
     start_locations = [clin.start_coord for clin in clins]
@@ -1080,12 +1380,30 @@ def map_markers_and_polyline(clins, visits):
     east_bbox_lim = np.max(all_lng)
     west_bbox_lim = np.min(all_lng)
 
-    # TODO: Add a preferred travel mode by clinician
-    # Set mode of transit and define optmisation method
-    mode = 'drive'  # "all_private", "all", "bike", "drive", "drive_service", "walk"
-    graph = ox.graph_from_bbox(north_bbox_lim, south_bbox_lim, east_bbox_lim, west_bbox_lim, network_type=mode)
-
+    # Draw each clinician's route on the network for their travel mode
+    network_types = [matrix_providers.map_network_type(mode or clin._travel_mode) for clin in clins]
+    networks = {}
+
+    for network_type in set(network_types):
+        # Load the road graph for the service region covering the bounding box from the graph store
+        graph = road_graph.get_graph(north_bbox_lim, south_bbox_lim, east_bbox_lim, west_bbox_lim,
+                                     mode=network_type)
+
+        # Snap every stop to its nearest graph node in a single query, then store the node for each clinician and
+        # visit. The preprocessed CSR arrays are loaded for A* leg queries.
+        all_nodes = road_graph.snap_coords(graph, all_locations)
+        networks[network_type] = {
+            "graph": graph,
+            "csr": road_graph.csr_graph(graph),
+            "start_nodes": all_nodes[:len(clins)],
+            "end_nodes": all_nodes[len(all_nodes) - len(clins):],
+            "visit_nodes": dict(zip([visit.id for visit_group in visits for visit in visit_group],
+                                    all_nodes[len(clins):len(all_nodes) - len(clins)]))
+        }
 
+    # Remove route points that would not be visible a few zoom levels in from the zoom that fits every stop
+    zoom = geometry.zoom_for_bounds(north_bbox_lim, south_bbox_lim, east_bbox_lim, west_bbox_lim)
+    tolerance = geometry.tolerance_for_zoom(zoom + geometry.ZOOM_MARGIN)
 
     # Initialize map and set boundaries.
     route_map = folium.Map(location=center_coord)
@@ -1098,10 +1416,12 @@ def map_markers_and_polyline(clins, visits):
         'darkblue', 'purple', 'orange', 'green', 'beige', 'lightgreen', 'blue', 'pink', 'lightred', 'red', 'lightgray')
 
     for clin_index, clin in enumerate(clins):
-        # Create subgroups for each clinician in group
-        if not clin.visits:
+        # Create subgroups for each clinician in group. Colours repeat for large teams.
+        if not visits[clin_index]:
             continue
 
+        color = color_list[clin_index % len(color_list)]
+
         sub_marker_group = plugins.FeatureGroupSubGroup(marker_group,
                                                                name=f"Markers - {clins[clin_index].name}").add_to(
             route_map)
@@ -1117,6 +1437,7 @@ def map_markers_and_polyline(clins, visits):
                     <p><b>Capacity</b>: {clin.capacity}</p>
                     <p><b>Discipline</b>: {clin.discipline}</p>
                     <p><b>Skills Required</b>: {clin.skill_list}</p>
+                    <p><b>Travel Mode</b>: {(mode or clin.travel_mode).capitalize()}</p>
                     """
 
         # Create marker image for start location
@@ -1124,67 +1445,67 @@ def map_markers_and_polyline(clins, visits):
             folium.Marker(
                 clin.start_coord,
                 tooltip=clin_tooltip,
-                icon=folium.Icon(icon_color='white', icon="glyphicon-home", color=color_list[clin_index]),
+                icon=folium.Icon(icon_color='white', icon="glyphicon-home", color=color),
             ))
 
-        shortest_route = find_shortest_route(graph, clin.start_coord, visits[clin_index][0].coord)
+        # Route every leg for the clinician at once on their network, reusing cached legs where possible
+        network_type = network_types[clin_index]
+        network = networks[network_type]
+        graph = network["graph"]
+        stop_nodes = [network["start_nodes"][clin_index]] + \
+                     [network["visit_nodes"][visit.id] for visit in visits[clin_index]] + \
+                     [network["end_nodes"][clin_index]]
+        legs = leg_routing.route_stops(graph, stop_nodes, network_type, csr=network["csr"])
+
+        # Join the legs into one path and simplify it, then add it to the map as a single line. Each coordinate is a
+        # node and is a point at which directions will change.
+        coords = geometry.merge_legs([[(graph.nodes[node]["y"], graph.nodes[node]["x"]) for node in leg]
+                                      for leg in legs])
+        coords = geometry.simplify_path(coords, tolerance)
+
+        if encode:
+            sub_route_group.add_child(plugins.PolyLineFromEncoded(geometry.encode_polyline(coords), weight=3,
+                                                                  color=color))
 
-        # Add route to map. Each coordinate is a node and is a point at which directions will change
-        coords = [(graph.nodes[node]["y"], graph.nodes[node]["x"]) for node in shortest_route]
-        sub_route_group.add_child(folium.PolyLine(coords, weight=3, color=color_list[clin_index]))
+        else:
+            sub_route_group.add_child(folium.PolyLine(coords, weight=3, color=color))
 
-        # Create routes for each visit for the clinician
+        # Create markers for each visit for the clinician
         for visit_index, visit in enumerate(visits[clin_index]):
-            # Find the shortest route between coordinates
-            if visit_index != len(visits[clin_index])-1:
-                shortest_route = find_shortest_route(graph,
-                                                     visit_locations[clin_index][visit_index],
-                                                     visit_locations[clin_index][visit_index+1])
-            # Add route to map
-            if shortest_route:
-                coords = [(graph.nodes[node]["y"], graph.nodes[node]["x"]) for node in shortest_route]
-                sub_route_group.add_child(folium.PolyLine(coords, weight=3, color=color_list[clin_index]))
-
-                visit_tooltip = f"""
-                            <center><h4>{visit_index + 1}. {visit.pat._name}</h4></center>
-                            <p><b>Address</b>: {visit.address}</p>
-                            <p><b>Time Window</b>: {visit.time_earliest} - {visit.time_latest}</p>
-                            <p><b>Priority</b>: {visit.visit_priority}</p>
-                            <p><b>Complexity</b>: {visit.visit_complexity}</p>
-                            <p><b>Skills Required</b>: {visit.skill_list}</p>
-                            <p><b>Discipline Requested</b>: {visit.discipline}</p>
-                            """
-
-                # Create marker image
-                sub_marker_group.add_child(
-                    folium.Marker(
-                        visit.coord,
-                        tooltip=visit_tooltip,
-                        icon=folium.Icon(icon_color='white', color=color_list[clin_index]),
-                    ))
-
-                # Add number to marker
-                sub_marker_group.add_child(
-                    folium.Marker(
-                        visit.coord,
-                        tooltip=visit_tooltip,
-                        icon=number_icon(color_list[clin_index], visit_index + 1)
-                    ))
-
-        # Add Polyline for end coordinates
-        shortest_route = find_shortest_route(graph, visits[clin_index][len(visits[clin_index])-1].coord, clin.end_coord)
-
-        # Add route to map. Each coordinate is a node and is a point at which directions will change
-        coords = [(graph.nodes[node]["y"], graph.nodes[node]["x"]) for node in shortest_route]
-        sub_route_group.add_child(folium.PolyLine(coords, weight=3, color=color_list[clin_index]))
+            visit_tooltip = f"""
+                        <center><h4>{visit_index + 1}. {visit.pat._name}</h4></center>
+                        <p><b>Address</b>: {visit.address}</p>
+                        <p><b>Time Window</b>: {visit.time_earliest} - {visit.time_latest}</p>
+                        <p><b>Priority</b>: {visit.visit_priority}</p>
+                        <p><b>Complexity</b>: {visit.visit_complexity}</p>
+                        <p><b>Skills Required</b>: {visit.skill_list}</p>
+                        <p><b>Discipline Requested</b>: {visit.discipline}</p>
+                        """
+
+            # Create marker image
+            sub_marker_group.add_child(
+                folium.Marker(
+                    visit.coord,
+                    tooltip=visit_tooltip,
+                    icon=folium.Icon(icon_color='white', color=color),
+                ))
+
+            # Add number to marker
+            sub_marker_group.add_child(
+                folium.Marker(
+                    visit.coord,
+                    tooltip=visit_tooltip,
+                    icon=number_icon(color, visit_index + 1)
+                ))
 
         # Create marker image for end location
         sub_marker_group.add_child(
             folium.Marker(
                 clin.end_coord,
                 tooltip=clin_tooltip,
-                icon=folium.Icon(icon_color='white', icon="glyphicon-home", color=color_list[clin_index]),
+                icon=folium.Icon(icon_color='white', icon="glyphicon-home", color=color),
             ))
 
     folium.LayerControl().add_to(route_map)
-    route_map.show_in_browser()
+
+    return route_map
@@ -0,0 +1,127 @@
+# This file contains functions for preparing route geometry for display. Routes are simplified before they are added to
+# a map so that pages stay small without any visible change to the route.
+import math
+import numpy as np
+
+# Map width in pixels assumed when choosing a zoom level to fit a route
+MAP_WIDTH = 1024
+
+# Number of zoom levels beyond the fitted zoom at which the simplified route should still look unchanged
+ZOOM_MARGIN = 2
+
+
+def zoom_for_bounds(north, south, east, west, width=MAP_WIDTH):
+    """
+    Estimates the web map zoom level at which the bounding box fills the map.
+    :param north: Northern latitude limit
+    :param south: Southern latitude limit
+    :param east: Eastern longitude limit
+    :param west: Western longitude limit
+    :param width: Map width in pixels
+    :return: Zoom level
+    """
+    span = max(east - west, (north - south) / max(math.cos(math.radians((north + south) / 2)), 0.01), 1e-6)
+
+    return max(0, min(19, int(math.log2(360 * width / (256 * span)))))
+
+
+def tolerance_for_zoom(zoom):
+    """
+    Returns a simplification tolerance in degrees of half a pixel at the given zoom level.
+    :param zoom: Zoom level
+    :return: Tolerance in degrees
+    """
+    return 360 / (256 * 2 ** zoom) / 2
+
+
+def merge_legs(legs):
+    """
+    Joins the legs of a route into a single path, dropping the repeated point where each leg meets the next.
+    :param legs: List of legs, each a list of (latitude, longitude) tuples
+    :return: List of (latitude, longitude) tuples
+    """
+    path = []
+
+    for leg in legs:
+        path.extend(leg[1:] if path and leg and path[-1] == leg[0] else leg)
+
+    return path
+
+
+def simplify_path(coords, tolerance):
+    """
+    Simplifies a path with the Douglas-Peucker algorithm, removing points that lie within the tolerance of the line
+    between the points kept either side of them. Longitude is scaled by the cosine of latitude so the tolerance is
+    the same in every direction.
+    :param coords: List of (latitude, longitude) tuples
+    :param tolerance: Tolerance in degrees of latitude
+    :return: List of (latitude, longitude) tuples
+    """
+    if len(coords) < 3:
+        return list(coords)
+
+    points = np.asarray(coords, dtype=float)
+    scaled = np.column_stack((points[:, 0], points[:, 1] * math.cos(math.radians(points[:, 0].mean()))))
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    # Work through segments with a stack rather than recursion, as routes can have thousands of points
+    stack = [(0, len(points) - 1)]
+
+    while stack:
+        start, end = stack.pop()
+
+        if end - start < 2:
+            continue
+
+        # Perpendicular distance of every point in the segment from the line between its ends
+        segment = scaled[start + 1:end]
+        line = scaled[end] - scaled[start]
+        line_length = np.hypot(*line)
+
+        if line_length == 0:
+            distances = np.hypot(*(segment - scaled[start]).T)
+
+        else:
+            distances = np.abs(line[0] * (segment[:, 1] - scaled[start, 1])
+                               - line[1] * (segment[:, 0] - scaled[start, 0])) / line_length
+
+        furthest = int(np.argmax(distances))
+
+        if distances[furthest] > tolerance:
+            index = start + 1 + furthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return [tuple(point) for point in points[keep]]
+
+
+def encode_polyline(coords, precision=5):
+    """
+    Encodes a path using Google's encoded polyline algorithm.
+    :param coords: List of (latitude, longitude) tuples
+    :param precision: Number of decimal places to keep
+    :return: Encoded polyline string
+    """
+    factor = 10 ** precision
+    output = []
+    prev_lat, prev_lng = 0, 0
+
+    for lat, lng in coords:
+        lat, lng = int(round(lat * factor)), int(round(lng * factor))
+
+        # Each coordinate is stored as the difference from the previous one
+        for value in (lat - prev_lat, lng - prev_lng):
+            value = ~(value << 1) if value < 0 else value << 1
+
+            while value >= 0x20:
+                output.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+
+            output.append(chr(value + 63))
+
+        prev_lat, prev_lng = lat, lng
+
+    return "".join(output)
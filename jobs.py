@@ -0,0 +1,400 @@
+# This file contains the background job queue. Optimisation and map rendering jobs are stored in the SQLite database so
+# that several users can submit work at once, and are run by worker processes started from main.py or the TUI. Each job
+# is claimed with a conditional update so that only one worker can run it.
+import datetime
+import json
+import multiprocessing
+import os
+import socket
+from time import sleep
+import validate
+import classes
+import geolocation
+import matrix_providers
+import metrics
+import route_export
+from sqlalchemy import Column, String, Integer, Date, DateTime, Index, func
+from data_manager import DataManagerMixin
+
+# Seconds a worker waits between checks of an empty queue
+POLL_INTERVAL = 1
+
+# Jobs left running for longer than this are assumed to belong to a worker that has died
+JOB_TIMEOUT = datetime.timedelta(hours=1)
+
+# Worker processes started from the TUI
+_session_workers = []
+
+
+class Job(DataManagerMixin.Base):
+    # Initialise table details
+    __tablename__ = "Job"
+    _id = Column(Integer, primary_key=True)
+    _kind = Column(String, nullable=False)
+    _obj_type = Column(String, nullable=False)
+    _obj_id = Column(Integer, nullable=False)
+    _date = Column(Date, nullable=False)
+    _params = Column(String, nullable=True)
+    _job_status = Column(String, nullable=False)
+    _result = Column(String, nullable=True)
+    _worker = Column(String, nullable=True)
+    # Job times are all local, so they can be compared with each other and with the current time. SQLite's
+    # CURRENT_TIMESTAMP is UTC, so the creation time is set by Python rather than the database.
+    created_instant = Column(DateTime, default=datetime.datetime.now)
+    started_instant = Column(DateTime, nullable=True)
+    finished_instant = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_Job_status", "_job_status", "_id"),
+    )
+
+    # Category values
+    _c_kind = ("optimize", "render_map")
+    _c_job_status = ("queued", "running", "done", "failed")
+
+    def to_dict(self):
+        """Returns the job as a dictionary for display or serialisation."""
+        return {
+            "id": self._id,
+            "kind": self._kind,
+            "obj_type": self._obj_type,
+            "obj_id": self._obj_id,
+            "date": str(self._date),
+            "params": json.loads(self._params) if self._params else {},
+            "status": self._job_status,
+            "result": json.loads(self._result) if self._result else None,
+            "worker": self._worker,
+            "created": self.created_instant,
+            "started": self.started_instant,
+            "finished": self.finished_instant
+        }
+
+
+def submit(kind, obj_type, obj_id, val_date, **params):
+    """
+    Adds a job to the queue.
+    :param kind: Type of job, either "optimize" or "render_map"
+    :param obj_type: "Team" or "Clinician"
+    :param obj_id: ID of the team or clinician
+    :param val_date: Date of the route
+    :param params: Additional parameters for the job, eg mode and provider for optimisation
+    :return: ID of the job
+    """
+    if kind not in Job._c_kind:
+        raise ValueError(f"Unknown job type: {kind}")
+
+    if obj_type not in ("Team", "Clinician"):
+        raise ValueError(f"Jobs can only be run for a team or clinician, not {obj_type}.")
+
+    with DataManagerMixin.class_session_scope() as session:
+        job = Job(_kind=kind, _obj_type=obj_type, _obj_id=obj_id, _date=val_date,
+                  _params=json.dumps(params) if params else None, _job_status="queued")
+        session.add(job)
+        session.flush()
+
+        return job._id
+
+
+def poll(job_id):
+    """
+    Returns the current state of a job.
+    :param job_id: ID of the job
+    :return: Dictionary of job details, or None if the job does not exist
+    """
+    with DataManagerMixin.class_session_scope() as session:
+        job = session.get(Job, job_id)
+
+        return job.to_dict() if job else None
+
+
+def list_jobs(limit=20, statuses=None):
+    """
+    Returns the most recently submitted jobs.
+    :param limit: Maximum number of jobs to return
+    :param statuses: Optional list of statuses to filter by
+    :return: List of job dictionaries, newest first
+    """
+    with DataManagerMixin.class_session_scope() as session:
+        query = session.query(Job)
+
+        if statuses:
+            query = query.filter(Job._job_status.in_(statuses))
+
+        return [job.to_dict() for job in query.order_by(Job._id.desc()).limit(limit)]
+
+
+def queue_counts():
+    """Returns the number of jobs in each status."""
+    with DataManagerMixin.class_session_scope() as session:
+        counts = dict(session.query(Job._job_status, func.count(Job._id)).group_by(Job._job_status).all())
+
+    return {status: counts.get(status, 0) for status in Job._c_job_status}
+
+
+def claim(session, job_id, worker):
+    """
+    Marks a job as running. The status is only changed if the job is still queued, so if two workers try to claim the
+    same job only one succeeds.
+    :param session: Session for querying database
+    :param job_id: ID of the job
+    :param worker: Name of the worker claiming the job
+    :return: True if the job was claimed
+    """
+    return bool(session.query(Job)
+                .filter(Job._id == job_id, Job._job_status == "queued")
+                .update({Job._job_status: "running", Job._worker: worker,
+                         Job.started_instant: datetime.datetime.now()}, synchronize_session=False))
+
+
+def claim_job(worker):
+    """
+    Claims the oldest queued job. If another worker claims it first, the next oldest is tried.
+    :param worker: Name of the worker claiming the job
+    :return: ID of the claimed job, or None if the queue is empty
+    """
+    with DataManagerMixin.class_session_scope() as session:
+        while True:
+            job_id = session.query(Job._id).filter(Job._job_status == "queued").order_by(Job._id).limit(1).scalar()
+
+            if job_id is None:
+                return None
+
+            if claim(session, job_id, worker):
+                return job_id
+
+
+def finish_job(job_id, status, result):
+    """Records the outcome of a job."""
+    with DataManagerMixin.class_session_scope() as session:
+        session.query(Job).filter(Job._id == job_id).update(
+            {Job._job_status: status, Job._result: json.dumps(result, default=str),
+             Job.finished_instant: datetime.datetime.now()}, synchronize_session=False)
+
+
+def fail_stale_jobs(timeout=JOB_TIMEOUT):
+    """
+    Marks jobs that have been running for longer than the timeout as failed, as their worker is assumed to have died.
+    :param timeout: Timedelta after which a running job is considered stale
+    :return: Number of jobs failed
+    """
+    with DataManagerMixin.class_session_scope() as session:
+        return session.query(Job) \
+            .filter(Job._job_status == "running", Job.started_instant < datetime.datetime.now() - timeout) \
+            .update({Job._job_status: "failed", Job._result: json.dumps({"error": "Worker timed out."}),
+                     Job.finished_instant: datetime.datetime.now()}, synchronize_session=False)
+
+
+def run_job(job_id):
+    """
+    Runs a claimed job. Optimisation jobs queue a map rendering job for the same route when they succeed, drawn with the
+    travel mode the route was optimized for.
+    :param job_id: ID of the job
+    :return: Dictionary describing the result
+    """
+    job = poll(job_id)
+    cls = classes.team.Team if job["obj_type"] == "Team" else classes.person.Clinician
+    val_date = datetime.date.fromisoformat(job["date"])
+
+    with cls.class_session_scope() as session:
+        obj = session.get(cls, job["obj_id"])
+
+        if not obj:
+            raise ValueError(f"{job['obj_type']} {job['obj_id']} does not exist.")
+
+        if job["kind"] == "optimize":
+            result = geolocation.solve_day(obj, val_date, **job["params"])
+            result["render_job"] = submit("render_map", job["obj_type"], job["obj_id"], val_date,
+                                          mode=job["params"].get("mode"))
+            return result
+
+        # Render the full route map and each clinician's GeoJSON export into the map cache
+        mode = job["params"].get("mode")
+        clins = obj.clins if job["obj_type"] == "Team" else [obj]
+        visits = geolocation.route_visits(clins, val_date)
+        path = geolocation.render_route_map(clins, visits, val_date, mode=mode)
+
+        for clin_index, clin in enumerate(clins):
+            route_export.export_route(clin, visits[clin_index], val_date,
+                                      mode=matrix_providers.map_network_type(mode) if mode else None)
+
+        return {"map": str(path) if path else None}
+
+
+def worker_loop(max_jobs=None, poll_interval=POLL_INTERVAL):
+    """
+    Claims and runs jobs until interrupted. This is the target of each worker process.
+    :param max_jobs: Optional number of jobs to run before exiting
+    :param poll_interval: Seconds to wait between checks of an empty queue
+    :return: Number of jobs run
+    """
+    # Connections inherited from the parent process cannot be shared, so start with a fresh pool
+    DataManagerMixin.engine.dispose()
+
+    metrics.configure_logging()
+
+    worker = worker_name()
+    completed = 0
+
+    while max_jobs is None or completed < max_jobs:
+        job_id = claim_job(worker)
+
+        if job_id is None:
+            sleep(poll_interval)
+            continue
+
+        execute_job(job_id)
+        completed += 1
+
+        # Update this worker's metrics after each job, as workers are usually stopped rather than exiting
+        metrics.dump()
+
+    return completed
+
+
+def worker_name():
+    """Returns a name identifying the current process."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def execute_job(job_id, worker=None):
+    """
+    Runs a job and records its outcome. If a worker name is passed, the job is claimed first and is skipped if another
+    worker has already claimed it.
+    :param job_id: ID of the job
+    :param worker: Optional name of the worker claiming the job
+    :return: Dictionary of job details after it has run
+    """
+    if worker:
+        with DataManagerMixin.class_session_scope() as session:
+            if not claim(session, job_id, worker):
+                return poll(job_id)
+
+    try:
+        with metrics.span("job", kind=poll(job_id)["kind"]):
+            result = run_job(job_id)
+
+        finish_job(job_id, "done", result)
+        metrics.increment("jobs", status="done")
+
+    except Exception as err:
+        finish_job(job_id, "failed", {"error": str(err)})
+        metrics.increment("jobs", status="failed")
+
+    return poll(job_id)
+
+
+def start_workers(num_workers=None):
+    """
+    Starts background worker processes.
+    :param num_workers: Number of workers. Defaults to the number of cores.
+    :return: List of processes
+    """
+    fail_stale_jobs()
+
+    workers = []
+    for _ in range(num_workers or os.cpu_count()):
+        process = multiprocessing.Process(target=worker_loop, name="route-worker", daemon=True)
+        process.start()
+        workers.append(process)
+
+    return workers
+
+
+def ensure_workers(num_workers=1):
+    """
+    Starts worker processes for this session if none are running, so that jobs queued from the TUI are picked up
+    without a separate worker command.
+    :param num_workers: Number of workers to start
+    :return: Number of workers running
+    """
+    global _session_workers
+
+    _session_workers = [process for process in _session_workers if process.is_alive()]
+
+    if not _session_workers:
+        _session_workers = start_workers(num_workers)
+
+    return len(_session_workers)
+
+
+def run_workers(num_workers=None):
+    """
+    Runs worker processes in the foreground until interrupted.
+    :param num_workers: Number of workers. Defaults to the number of cores.
+    :return: None
+    """
+    workers = start_workers(num_workers)
+    print(f"Started {len(workers)} worker(s). Press Ctrl+C to stop.")
+
+    try:
+        for process in workers:
+            process.join()
+
+    except KeyboardInterrupt:
+        for process in workers:
+            process.terminate()
+
+
+def print_jobs(limit=20):
+    """
+    Prints the most recently submitted jobs and their status.
+    :param limit: Maximum number of jobs to show
+    :return: None
+    """
+    job_list = list_jobs(limit=limit)
+
+    if not job_list:
+        print("There are no jobs in the queue.")
+        return None
+
+    for job in job_list:
+        result = job["result"] or {}
+        detail = result.get("error") or ", ".join(f"{key}: {value}" for key, value in result.items())
+
+        print(f"{job['id']:>6}) {job['kind']:<10} {job['obj_type']} {job['obj_id']} on {job['date']} - "
+              f"{job['status'].capitalize()}{f' ({detail})' if detail else ''}")
+
+    return None
+
+
+def submit_optimize(obj):
+    """
+    Prompts the user for a date and travel time provider, then queues an optimisation job. Each clinician's travel mode
+    is used.
+    :param obj: Clinician or team to optimize
+    :return: ID of the job, or 0 if cancelled
+    """
+    while True:
+        inp_date = validate.qu_input("Please select a date to optimize the route: ")
+
+        if not inp_date:
+            return 0
+
+        try:
+            val_date = validate.valid_date(inp_date).date()
+            break
+
+        except AttributeError:
+            print("Invalid date format.")
+
+    # Settings are chosen now as the worker cannot prompt the user
+    settings = {}
+    options = (("provider", ["google", "local", "hybrid", "estimate"], "Please select a travel time provider."),)
+
+    for setting, cat_list, prompt in options:
+        while setting not in settings:
+            validate.print_cat_value(cat_list, prompt)
+            inp_value = validate.qu_input(f"{setting.capitalize()}: ")
+
+            if not inp_value:
+                return 0
+
+            value = validate.valid_cat_list(inp_value, cat_list)
+
+            if isinstance(value, str):
+                settings[setting] = value
+
+    job_id = submit("optimize", type(obj).__name__, obj.id, val_date, **settings)
+    print(f"Queued optimisation job {job_id}. Check its progress from View Jobs.")
+
+    return job_id
@@ -0,0 +1,49 @@
+# This file contains the lazy module loader. Heavy dependencies (mapping, routing, data frame and AWS libraries) are
+# bound at module level as placeholders and only imported the first time one of their attributes is used, so that
+# editing records or running the batch does not pay to load libraries it never uses.
+import importlib
+import sys
+
+
+class LazyModule:
+    """
+    Stands in for a module until one of its attributes is first accessed, at which point the module is imported and
+    all further attribute access is passed through to it.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        """Imports the module on first use."""
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_import(name):
+    """
+    Returns a placeholder for a module that is imported on first use. Modules that have already been imported are
+    returned directly.
+    :param name: Full dotted name of the module, eg "folium.plugins"
+    :return: Module or LazyModule
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    return LazyModule(name)
@@ -0,0 +1,326 @@
+# This file contains the leg routing engine used to draw routes on the map. Each stop is searched once to all of the
+# stops after it, and every leg found is cached by (origin node, destination node, mode) so that legs shared between
+# clinicians or re-displayed on later days are not searched again. Road graphs can also be preprocessed into compressed
+# sparse row arrays, which are queried with A* using a straight-line travel time heuristic.
+import heapq
+import math
+import threading
+from collections import OrderedDict
+import numpy as np
+import metrics
+from lazy_import import lazy_import
+
+# NetworkX is only needed to report missing paths, so it is imported when first used
+nx = lazy_import("networkx")
+
+# Mean radius of the earth in metres, used for the A* heuristic
+EARTH_RADIUS = 6371008.8
+
+# Maximum number of legs held in the cache. The least recently used legs are dropped first.
+LEG_CACHE_SIZE = 20000
+
+_leg_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def clear_cache():
+    """
+    Empties the leg cache. Called when a road graph is rebuilt, as its legs may no longer be the shortest.
+    :return: None
+    """
+    with _lock:
+        _leg_cache.clear()
+
+
+def cache_leg(orig_node, dest_node, mode, path):
+    """Adds a leg to the cache, dropping the least recently used leg if the cache is full."""
+    with _lock:
+        _leg_cache[(orig_node, dest_node, mode)] = path
+        _leg_cache.move_to_end((orig_node, dest_node, mode))
+
+        while len(_leg_cache) > LEG_CACHE_SIZE:
+            _leg_cache.popitem(last=False)
+
+
+def cached_leg(orig_node, dest_node, mode):
+    """Returns a cached leg, or None if it has not been routed."""
+    with _lock:
+        path = _leg_cache.get((orig_node, dest_node, mode))
+
+        if path is not None:
+            _leg_cache.move_to_end((orig_node, dest_node, mode))
+
+    metrics.cache_lookup("leg", path is not None)
+    return path
+
+
+def edge_weight(graph, weight):
+    """
+    Returns a function giving the weight of the edge between two nodes. For multigraphs the lightest parallel edge is
+    used. Edges missing the weight attribute count as 1.
+    :param graph: Graph
+    :param weight: Name of edge attribute to use as weight
+    :return: Function of (edge data) returning the weight
+    """
+    if graph.is_multigraph():
+        return lambda data: min(edge.get(weight, 1) for edge in data.values())
+
+    return lambda data: data.get(weight, 1)
+
+
+def multi_target_dijkstra(graph, source, targets, weight="travel_time"):
+    """
+    Runs a single Dijkstra search from the source that stops as soon as every target has been reached.
+    :param graph: Graph
+    :param source: Source node
+    :param targets: Iterable of target nodes
+    :param weight: Name of edge attribute to use as weight
+    :return: Dictionary of target node to list of nodes on the shortest path. Unreachable targets are omitted.
+    """
+    get_weight = edge_weight(graph, weight)
+    remaining = set(targets) - {source}
+    paths = {source: [source]} if source in set(targets) else {}
+
+    dist = {source: 0}
+    pred = {source: None}
+    heap = [(0, 0, source)]
+    counter = 1
+    settled = set()
+
+    while heap and remaining:
+        node_dist, _, node = heapq.heappop(heap)
+
+        if node in settled:
+            continue
+
+        settled.add(node)
+        remaining.discard(node)
+
+        for neighbour, data in graph.succ[node].items():
+            new_dist = node_dist + get_weight(data)
+
+            if neighbour not in dist or new_dist < dist[neighbour]:
+                dist[neighbour] = new_dist
+                pred[neighbour] = node
+                heapq.heappush(heap, (new_dist, counter, neighbour))
+                counter += 1
+
+    # Walk back from each reached target to rebuild its path
+    for target in set(targets) - {source}:
+        if target not in settled:
+            continue
+
+        path = [target]
+        while pred[path[-1]] is not None:
+            path.append(pred[path[-1]])
+
+        paths[target] = path[::-1]
+
+    return paths
+
+
+def route_stops(graph, stop_nodes, mode, weight="travel_time", csr=None):
+    """
+    Routes every leg between consecutive stops. If a CSR graph is passed, each uncached leg is found with A*.
+    Otherwise each stop whose onward legs are not all cached is searched once to all of the remaining stops, and every
+    leg found is cached.
+    :param graph: Graph
+    :param stop_nodes: List of nodes in the order they are visited
+    :param mode: Travel mode, used as part of the cache key
+    :param weight: Name of edge attribute to use as weight
+    :param csr: Optional CSRGraph built from the graph
+    :return: List of paths, one per leg
+    """
+    legs = []
+
+    for index, orig_node in enumerate(stop_nodes[:-1]):
+        dest_node = stop_nodes[index + 1]
+        path = cached_leg(orig_node, dest_node, mode)
+
+        if path is None and csr is not None:
+            path = csr.astar(orig_node, dest_node)
+
+            if path is not None:
+                cache_leg(orig_node, dest_node, mode, path)
+
+        elif path is None:
+            # Search once to every remaining stop so that later legs from this stop are also cached
+            remaining = [node for node in stop_nodes[index + 1:] if cached_leg(orig_node, node, mode) is None]
+
+            for node, found in multi_target_dijkstra(graph, orig_node, remaining, weight=weight).items():
+                cache_leg(orig_node, node, mode, found)
+
+            path = cached_leg(orig_node, dest_node, mode)
+
+        if path is None:
+            raise nx.NetworkXNoPath(f"No path between {orig_node} and {dest_node}.")
+
+        legs.append(path)
+
+    return legs
+
+
+class CSRGraph:
+    """
+    A road graph held as compressed sparse row arrays. Edges leaving node i are indices[indptr[i]:indptr[i + 1]] with
+    matching weights. Parallel edges are reduced to the lightest. Node positions are kept so that A* can use the
+    straight-line distance at the fastest speed on the graph as an admissible travel time heuristic.
+    """
+
+    def __init__(self, node_ids, indptr, indices, weights, lats, lngs, max_speed):
+        self.node_ids = np.asarray(node_ids)
+        self.indptr = np.asarray(indptr)
+        self.indices = np.asarray(indices)
+        self.weights = np.asarray(weights)
+        self.lats = np.asarray(lats)
+        self.lngs = np.asarray(lngs)
+        self.max_speed = float(max_speed)
+
+        # Lookups used in the search loop are held as lists, which are much faster to index from Python than arrays
+        self._index = {node: i for i, node in enumerate(self.node_ids.tolist())}
+        self._indptr = self.indptr.tolist()
+        self._indices = self.indices.tolist()
+        self._weights = self.weights.tolist()
+        self._lat_rad = np.radians(self.lats).tolist()
+        self._lng_rad = np.radians(self.lngs).tolist()
+        self._cos_lat = np.cos(np.radians(self.lats)).tolist()
+
+    @classmethod
+    def from_graph(cls, graph, weight="travel_time"):
+        """
+        Builds a CSR graph from a NetworkX graph.
+        :param graph: Graph with "x" and "y" node attributes
+        :param weight: Name of edge attribute to use as weight
+        :return: CSRGraph
+        """
+        node_ids = list(graph.nodes)
+        index = {node: i for i, node in enumerate(node_ids)}
+
+        # Keep the lightest of any parallel edges, along with its length for the heuristic
+        best = {}
+        for u, v, data in graph.edges(data=True):
+            key = (index[u], index[v])
+            value = data.get(weight, 1)
+
+            if key not in best or value < best[key][0]:
+                best[key] = (value, data.get("length"))
+
+        keys = sorted(best)
+        sources = np.array([key[0] for key in keys], dtype=np.int64)
+        indices = np.array([key[1] for key in keys], dtype=np.int64)
+        weights = np.array([best[key][0] for key in keys], dtype=np.float64)
+
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(node_ids)), out=indptr[1:])
+
+        # The fastest speed on the graph bounds how quickly any remaining straight-line distance can be covered
+        speeds = [length / value for value, length in best.values() if length and value > 0]
+        max_speed = max(speeds) if speeds else 0
+
+        lats = np.array([graph.nodes[node]["y"] for node in node_ids], dtype=np.float64)
+        lngs = np.array([graph.nodes[node]["x"] for node in node_ids], dtype=np.float64)
+
+        return cls(node_ids, indptr, indices, weights, lats, lngs, max_speed)
+
+    def save(self, path):
+        """Saves the arrays to a NumPy .npz file."""
+        np.savez(path, node_ids=self.node_ids, indptr=self.indptr, indices=self.indices, weights=self.weights,
+                 lats=self.lats, lngs=self.lngs, max_speed=self.max_speed)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a CSR graph saved with save()."""
+        with np.load(path) as arrays:
+            return cls(arrays["node_ids"], arrays["indptr"], arrays["indices"], arrays["weights"],
+                       arrays["lats"], arrays["lngs"], arrays["max_speed"])
+
+    def heuristic(self, i, target):
+        """Lower bound on the travel time from node index i to the target node index."""
+        if not self.max_speed:
+            return 0
+
+        lat_1, lat_2 = self._lat_rad[i], self._lat_rad[target]
+        d_lat = lat_2 - lat_1
+        d_lng = self._lng_rad[target] - self._lng_rad[i]
+        a = math.sin(d_lat / 2) ** 2 + self._cos_lat[i] * self._cos_lat[target] * math.sin(d_lng / 2) ** 2
+
+        return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a))) / self.max_speed
+
+    def path_to(self, pred, target):
+        """Rebuilds the list of node ids on the path ending at the target node index."""
+        path = [target]
+        while pred[path[-1]] != -1:
+            path.append(pred[path[-1]])
+
+        return [self.node_ids[i].item() for i in reversed(path)]
+
+    def astar(self, orig_node, dest_node):
+        """
+        Finds the shortest path between two nodes using A*.
+        :param orig_node: Starting node id
+        :param dest_node: Ending node id
+        :return: List of node ids along the path, or None if the destination cannot be reached
+        """
+        source, target = self._index[orig_node], self._index[dest_node]
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+
+        dist = {source: 0}
+        pred = {source: -1}
+        heap = [(self.heuristic(source, target), 0, source)]
+
+        while heap:
+            _, node_dist, i = heapq.heappop(heap)
+
+            if i == target:
+                return self.path_to(pred, target)
+
+            # Skip stale heap entries
+            if node_dist > dist[i]:
+                continue
+
+            for k in range(indptr[i], indptr[i + 1]):
+                j = indices[k]
+                new_dist = node_dist + weights[k]
+
+                if new_dist < dist.get(j, math.inf):
+                    dist[j] = new_dist
+                    pred[j] = i
+                    heapq.heappush(heap, (new_dist + self.heuristic(j, target), new_dist, j))
+
+        return None
+
+    def distances(self, orig_node, dest_nodes):
+        """
+        Finds the shortest travel time from one node to many using a single Dijkstra search, which stops as soon as
+        every destination has been reached.
+        :param orig_node: Starting node id
+        :param dest_nodes: List of destination node ids
+        :return: Array of travel times in the order of dest_nodes. Unreachable destinations are infinite.
+        """
+        source = self._index[orig_node]
+        targets = [self._index[node] for node in dest_nodes]
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+
+        remaining = set(targets)
+        dist = {source: 0}
+        settled = set()
+        heap = [(0, source)]
+
+        while heap and remaining:
+            node_dist, i = heapq.heappop(heap)
+
+            if i in settled:
+                continue
+
+            settled.add(i)
+            remaining.discard(i)
+
+            for k in range(indptr[i], indptr[i + 1]):
+                j = indices[k]
+                new_dist = node_dist + weights[k]
+
+                if new_dist < dist.get(j, math.inf):
+                    dist[j] = new_dist
+                    heapq.heappush(heap, (new_dist, j))
+
+        return np.array([dist[i] if i in settled else math.inf for i in targets])
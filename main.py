@@ -7,7 +7,14 @@ from classes.visits import Visit
 from classes.team import Team
 from data_manager import DataManagerMixin
 from time import sleep
+import argparse
 import logging
+import batch
+import jobs
+import metrics
+import problem_snapshot
+import road_graph
+import search_index
 
 """
 Primary stream - sequence of events:
@@ -26,15 +33,45 @@ Secondary actions available:
 """
 
 # TODO: Determine how to create an audit log
-# TODO: Investigate how to automatically batch and run nightly
 # TODO: Determine how to deploy to a server
 
 
+def parse_args():
+    """
+    Parses command line arguments. With no arguments the TUI is launched.
+    :return: Namespace of parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Clinician Route Optimiser")
+    parser.add_argument("--batch", action="store_true", help="Run the nightly batch once and exit.")
+    parser.add_argument("--schedule", metavar="HHMM", help="Run the nightly batch every day at the given time.")
+    parser.add_argument("--worker", metavar="N", type=int, nargs="?", const=0,
+                        help="Run N background job workers (default: one per core).")
+    parser.add_argument("--api", metavar="PORT", type=int, nargs="?", const=8080,
+                        help="Serve the HTTP API on the given port (default: 8080).")
+    parser.add_argument("--metrics", metavar="DIR", nargs="?", const=str(metrics.METRICS_DIR),
+                        help="Write Prometheus metrics for each process to DIR on exit (default: ./data/metrics).")
+    parser.add_argument("--snapshots", metavar="DIR", nargs="?", const=str(problem_snapshot.SNAPSHOT_DIR),
+                        help="Save each optimisation problem to DIR for offline replay (default: ./data/snapshots).")
+
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
+
     sqla_logger = logging.getLogger('sqlalchemy')
     sqla_logger.setLevel(logging.DEBUG)
     sqla_logger.addHandler(logging.FileHandler('./data/sqla.log'))
 
+    # Stage timings, API calls, cache lookups and solver statistics are logged as JSON lines
+    metrics.configure_logging()
+
+    if args.metrics:
+        metrics.enable_dump(args.metrics)
+
+    if args.snapshots:
+        problem_snapshot.enable(args.snapshots)
+
     # Create database tables if not already present
     DataManagerMixin.create_tables()
 
@@ -44,6 +81,31 @@ def main():
     for cls in _class_list:
         cls.update_id_counter()
 
+    # Build the name search index if this database predates it
+    search_index.ensure_indexes()
+
+    # Run batch jobs without launching the TUI if requested
+    if args.batch:
+        batch.run_nightly()
+        return None
+
+    if args.schedule:
+        batch.schedule_nightly(args.schedule)
+        return None
+
+    if args.worker is not None:
+        jobs.run_workers(args.worker or None)
+        return None
+
+    if args.api:
+        # Imported here so that aiohttp is only required when serving the API
+        import api
+        api.run_api(port=args.api)
+        return None
+
+    # Keep cached road graphs fresh while the TUI is open
+    road_graph.start_background_refresh()
+
     sleep(0.5)
 
     navigation.main_menu(_class_list)
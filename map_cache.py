@@ -0,0 +1,128 @@
+# This file contains the route map cache. Maps are saved as HTML files and route exports as GeoJSON, named by a hash of
+# the route they show, so that viewing a route that has already been rendered is a file read. Any change to the
+# clinicians, visits, visit order, time windows or locations on a route gives it a new key, so stale maps are never
+# served and are removed by the nightly batch.
+import datetime
+import hashlib
+import json
+import os
+import webbrowser
+import metrics
+from data_manager import DataManagerMixin
+
+MAP_DIR = DataManagerMixin.BASE_DIR / "data" / "maps"
+
+# Maps not read or written for this long are removed by prune_maps
+MAX_MAP_AGE = datetime.timedelta(days=14)
+
+
+def route_key(clins, visits, val_date, kind, mode=None):
+    """
+    Generates the cache key for a route map from everything that is drawn on it. Shift times and visit time windows are
+    included, as they are shown on maps and set the ETAs in exports.
+    :param clins: Clinicians on the route
+    :param visits: Visits for each clinician on the route, sorted by order
+    :param val_date: Date of the route
+    :param kind: Type of map, eg "markers" or "route"
+    :param mode: Travel mode the route was optimized for. Defaults to each clinician's travel mode.
+    :return: Hex digest
+    """
+    content = {
+        "kind": kind,
+        "date": str(val_date),
+        "clins": [
+            {
+                "id": clin.id,
+                "mode": mode or clin._travel_mode,
+                "start": list(clin.start_coord),
+                "end": list(clin.end_coord),
+                "shift": [clin._start_time, clin._end_time],
+                "visits": [[visit.id, visit._order, list(visit.coord), visit._time_earliest, visit._time_latest]
+                           for visit in visits[clin_index]]
+            }
+            for clin_index, clin in enumerate(clins)
+        ]
+    }
+
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+def map_path(key, suffix=".html"):
+    """Returns the path of a cached file."""
+    return MAP_DIR / f"{key}{suffix}"
+
+
+def load_map(key, suffix=".html"):
+    """
+    Finds a cached file and marks it as recently used.
+    :param key: Cache key from route_key
+    :param suffix: File extension
+    :return: Path to the file, or None if it has not been rendered
+    """
+    path = map_path(key, suffix)
+    metrics.cache_lookup("map" if suffix == ".html" else suffix.lstrip("."), path.exists())
+
+    if not path.exists():
+        return None
+
+    os.utime(path)
+    return path
+
+
+def save_map(route_map, key):
+    """
+    Saves a Folium map to the cache. The file is written to a temporary path first so readers never see a partial map.
+    :param route_map: Folium map
+    :param key: Cache key from route_key
+    :return: Path to the saved map
+    """
+    MAP_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = map_path(key, ".tmp.html")
+    route_map.save(str(tmp_path))
+    os.replace(tmp_path, map_path(key))
+
+    return map_path(key)
+
+
+def save_json(data, key, suffix=".json"):
+    """
+    Saves a JSON document, such as a GeoJSON route export, to the cache.
+    :param data: JSON serialisable data
+    :param key: Cache key from route_key
+    :param suffix: File extension
+    :return: Path to the saved file
+    """
+    MAP_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = map_path(key, f".tmp{suffix}")
+
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, separators=(",", ":"))
+
+    os.replace(tmp_path, map_path(key, suffix))
+
+    return map_path(key, suffix)
+
+
+def open_map(path):
+    """Opens a cached map in the default browser."""
+    webbrowser.open(path.as_uri())
+
+
+def prune_maps(max_age=MAX_MAP_AGE):
+    """
+    Removes cached files that have not been used within the maximum age.
+    :param max_age: Timedelta after which an unused file is removed
+    :return: Number of files removed
+    """
+    if not MAP_DIR.exists():
+        return 0
+
+    cutoff = (datetime.datetime.now() - max_age).timestamp()
+    removed = 0
+
+    for path in MAP_DIR.iterdir():
+        if path.is_file() and path.stat().st_mtime < cutoff:
+            path.unlink()
+            removed += 1
+
+    return removed
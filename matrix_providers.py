@@ -0,0 +1,100 @@
+# This file contains travel time matrix providers that do not depend on Google's Distance Matrix API. Matrices are
+# computed locally from the cached OpenStreetMaps road graphs, or estimated from straight-line distance.
+import numpy as np
+import road_graph
+
+# Google Distance Matrix travel modes and the matching OSMnx network types. Transit cannot be modelled locally.
+OSM_NETWORK_TYPES = {
+    "driving": "drive",
+    "walking": "walk",
+    "bicycling": "bike",
+    "transit": None
+}
+
+# Average door-to-door speeds in km/h used for estimates, including stops at junctions and lights. Walking and cycling
+# use the same speeds as their road graphs.
+ESTIMATE_SPEEDS = {
+    "driving": 35,
+    "walking": road_graph.NETWORK_SPEEDS["walk"],
+    "bicycling": road_graph.NETWORK_SPEEDS["bike"],
+    "transit": 18
+}
+
+# Ratio of road distance to straight-line distance for estimates
+DETOUR_FACTOR = 1.3
+
+# Mean radius of the earth in kilometres
+EARTH_RADIUS_KM = 6371.0088
+
+# Padding in degrees added around the stops so that the graph includes roads just outside them
+BBOX_BUFFER = 0.01
+
+
+def map_network_type(mode):
+    """
+    Returns the OSMnx network type to draw a route on for a travel mode. Transit cannot be modelled, so its routes are
+    drawn along roads.
+    """
+    return OSM_NETWORK_TYPES.get(mode) or "drive"
+
+
+def osm_dist_matrix(coord_list, mode):
+    """
+    Computes a travel time matrix from the cached road graph covering the coordinates. Each location is searched once
+    to every other location.
+    :param coord_list: List of (latitude, longitude) tuples
+    :param mode: Google travel mode, eg "driving"
+    :return: Matrix of travel times in minutes as floats. Unreachable pairs are infinite. None if the mode cannot be
+        modelled locally.
+    """
+    network_type = OSM_NETWORK_TYPES.get(mode)
+
+    if not network_type:
+        return None
+
+    lats = [coord[0] for coord in coord_list]
+    lngs = [coord[1] for coord in coord_list]
+    graph = road_graph.get_graph(max(lats) + BBOX_BUFFER, min(lats) - BBOX_BUFFER,
+                                 max(lngs) + BBOX_BUFFER, min(lngs) - BBOX_BUFFER, mode=network_type)
+    csr = road_graph.csr_graph(graph)
+
+    # Snap every location once, then search from each distinct node to all distinct nodes
+    nodes = road_graph.snap_coords(graph, coord_list)
+    unique_nodes = list(dict.fromkeys(nodes))
+    node_index = [unique_nodes.index(node) for node in nodes]
+
+    unique_matrix = np.vstack([csr.distances(node, unique_nodes) for node in unique_nodes])
+
+    # Expand back out to one row and column per location and convert travel time from seconds to minutes
+    return unique_matrix[np.ix_(node_index, node_index)] / 60
+
+
+def estimate_dist_matrix(coord_list, mode):
+    """
+    Estimates a travel time matrix from straight-line (haversine) distance, a detour factor and an average speed for
+    the travel mode. This needs no network access and runs in milliseconds, so it suits what-if planning where exact
+    drive times are not needed.
+    :param coord_list: List of (latitude, longitude) tuples
+    :param mode: Google travel mode, eg "driving"
+    :return: Matrix of travel times in minutes as floats
+    """
+    coords = np.radians(np.asarray(coord_list, dtype=float))
+    lats, lngs = coords[:, 0], coords[:, 1]
+
+    # Haversine distance between every pair of locations
+    d_lat = lats[:, None] - lats[None, :]
+    d_lng = lngs[:, None] - lngs[None, :]
+    a = np.sin(d_lat / 2) ** 2 + np.cos(lats)[:, None] * np.cos(lats)[None, :] * np.sin(d_lng / 2) ** 2
+    distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1, np.sqrt(a)))
+
+    return distance * DETOUR_FACTOR / ESTIMATE_SPEEDS[mode] * 60
+
+
+def finalise_matrix(matrix, unreachable):
+    """
+    Converts a float matrix of minutes into the integer matrix expected by the route optimizer.
+    :param matrix: Matrix of travel times in minutes
+    :param unreachable: Value to use for pairs that cannot be reached
+    :return: Integer matrix
+    """
+    return np.where(np.isfinite(matrix), matrix, unreachable).astype("int")
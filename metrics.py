@@ -0,0 +1,265 @@
+# This file contains lightweight instrumentation for the optimisation pipeline. Stages are timed with spans, and API
+# calls, cache lookups and solver statistics are counted. Each event is written as a structured (JSON) log line, and the
+# totals for the current process can be dumped in the Prometheus text format for a node exporter's textfile collector.
+import atexit
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from contextlib import contextmanager
+
+# Structured log of every span and solver run, and directory of Prometheus dumps (one file per process). Paths are
+# relative to the working directory like the database, but data_manager is not imported so that any module can be
+# instrumented without affecting import order.
+BASE_DIR = pathlib.Path().absolute()
+LOG_PATH = BASE_DIR / "data" / "metrics.log"
+METRICS_DIR = BASE_DIR / "data" / "metrics"
+
+# Prefix applied to every metric name in the Prometheus dump
+PREFIX = "route_optimisation_"
+
+logger = logging.getLogger("route_optimisation.metrics")
+
+# Totals for this process, keyed by (metric name, sorted label items)
+_counters = {}
+_timers = {}
+_gauges = {}
+_lock = threading.Lock()
+
+# Directory the Prometheus dump is written to, or None if dumps are disabled. Worker processes forked after dumps are
+# enabled inherit this and write their own file.
+_dump_dir = None
+
+
+def label_key(name, labels):
+    """Returns the registry key for a metric and its labels."""
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def log_event(event, **fields):
+    """Writes a structured log line for an event."""
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({"ts": round(time.time(), 3), "pid": os.getpid(), "event": event, **fields},
+                               default=str))
+
+
+def increment(name, value=1, **labels):
+    """
+    Adds to a counter.
+    :param name: Name of the counter, eg "google_api_requests"
+    :param value: Amount to add
+    :param labels: Labels distinguishing series of the counter, eg mode="driving"
+    :return: None
+    """
+    with _lock:
+        key = label_key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Sets a gauge to its latest value, eg the objective of the last solution."""
+    with _lock:
+        _gauges[label_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    """Records a duration against a timer, keeping its count, total and maximum."""
+    with _lock:
+        key = label_key(name, labels)
+        count, total, maximum = _timers.get(key, (0, 0.0, 0.0))
+        _timers[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+
+@contextmanager
+def span(name, **labels):
+    """
+    Times a stage of work. The duration is added to the stage's timer and written to the structured log, along with
+    whether the stage raised an error.
+    :param name: Name of the stage, eg "dist_matrix"
+    :param labels: Labels for the stage, eg provider="google"
+    :return: None
+    """
+    start = time.perf_counter()
+    status = "ok"
+
+    try:
+        yield
+
+    except BaseException:
+        status = "error"
+        raise
+
+    finally:
+        seconds = time.perf_counter() - start
+        observe("stage_seconds", seconds, stage=name, status=status, **labels)
+        log_event("span", stage=name, status=status, seconds=round(seconds, 6), **labels)
+
+
+def cache_lookup(cache, hit):
+    """
+    Counts a cache lookup as a hit or miss.
+    :param cache: Name of the cache, eg "map"
+    :param hit: Whether the lookup found an entry
+    :return: None
+    """
+    increment("cache_lookups", cache=cache, result="hit" if hit else "miss")
+
+
+def cache_hit_ratio(cache):
+    """Returns the proportion of lookups on a cache that were hits, or None if it has not been used."""
+    with _lock:
+        hits = _counters.get(label_key("cache_lookups", {"cache": cache, "result": "hit"}), 0)
+        misses = _counters.get(label_key("cache_lookups", {"cache": cache, "result": "miss"}), 0)
+
+    return hits / (hits + misses) if hits + misses else None
+
+
+def record_solver(routing, solution, num_visits, dropped, **labels):
+    """
+    Records statistics for a solver run.
+    :param routing: Routing Model
+    :param solution: Solution from routing model, or None if none was found
+    :param num_visits: Number of visits in the problem
+    :param dropped: Number of visits that could not be assigned
+    :param labels: Labels for the run, eg provider="estimate"
+    :return: Dictionary of the statistics recorded
+    """
+    solver = routing.solver()
+    stats = {
+        "status": routing.status(),
+        "objective": solution.ObjectiveValue() if solution else None,
+        "visits": num_visits,
+        "dropped": dropped,
+        "solutions": solver.Solutions(),
+        "branches": solver.Branches(),
+        "failures": solver.Failures(),
+        "accepted_neighbors": solver.AcceptedNeighbors(),
+        "wall_ms": solver.WallTime()
+    }
+
+    increment("solver_runs", found="yes" if solution else "no", **labels)
+    increment("solver_branches", stats["branches"], **labels)
+    increment("solver_visits", num_visits, **labels)
+    increment("solver_dropped_visits", dropped, **labels)
+
+    if solution:
+        set_gauge("solver_last_objective", stats["objective"], **labels)
+
+    set_gauge("solver_last_dropped_visits", dropped, **labels)
+    log_event("solver", **stats, **labels)
+
+    return stats
+
+
+def snapshot():
+    """Returns a copy of the counters, gauges and timers recorded in this process."""
+    with _lock:
+        return {"counters": dict(_counters), "gauges": dict(_gauges), "timers": dict(_timers)}
+
+
+def reset():
+    """Clears every metric recorded in this process."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timers.clear()
+
+
+def format_labels(labels):
+    """Formats label items as a Prometheus label set, escaping quotes and backslashes in values."""
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{key}="{json.dumps(value)[1:-1]}"' for key, value in labels) + "}"
+
+
+def prometheus_text():
+    """
+    Formats the metrics recorded in this process in the Prometheus text exposition format. Counters have a _total
+    suffix, and each timer is exported as a summary (count and sum) with its maximum as a separate gauge.
+    :return: String
+    """
+    data = snapshot()
+    lines = []
+
+    # Group series of the same metric under a single TYPE line
+    for kind, suffix, series in (("counter", "_total", data["counters"]), ("gauge", "", data["gauges"])):
+        for name in sorted({name for name, _ in series}):
+            lines.append(f"# TYPE {PREFIX}{name}{suffix} {kind}")
+            lines += [f"{PREFIX}{name}{suffix}{format_labels(labels)} {value}"
+                      for (series_name, labels), value in sorted(series.items()) if series_name == name]
+
+    for name in sorted({name for name, _ in data["timers"]}):
+        timers = [(labels, values) for (series_name, labels), values in sorted(data["timers"].items())
+                  if series_name == name]
+
+        lines.append(f"# TYPE {PREFIX}{name} summary")
+        for labels, (count, total, _) in timers:
+            lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {count}")
+            lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {total:.6f}")
+
+        lines.append(f"# TYPE {PREFIX}{name}_max gauge")
+        lines += [f"{PREFIX}{name}_max{format_labels(labels)} {maximum:.6f}" for labels, (_, _, maximum) in timers]
+
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path=None):
+    """
+    Writes the Prometheus dump for this process. The file is replaced atomically so a collector never reads a partial
+    dump.
+    :param path: Path to write to. Defaults to a file named after this process in the metrics directory.
+    :return: Path written
+    """
+    path = pathlib.Path(path) if path else METRICS_DIR / f"{os.getpid()}.prom"
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    tmp_path.write_text(prometheus_text())
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def enable_dump(directory=METRICS_DIR):
+    """
+    Enables the Prometheus dump for this process and any workers it starts. The dump is written when the process exits
+    and by workers after each job.
+    :param directory: Directory to write dumps to
+    :return: None
+    """
+    global _dump_dir
+
+    _dump_dir = pathlib.Path(directory)
+    atexit.register(dump)
+
+
+def dump():
+    """Writes the Prometheus dump for this process if dumps are enabled."""
+    if _dump_dir is None:
+        return None
+
+    return write_prometheus(_dump_dir / f"{os.getpid()}.prom")
+
+
+def configure_logging(path=LOG_PATH):
+    """
+    Sends the structured metrics log to a file. Safe to call more than once, eg in each worker process.
+    :param path: Path of the log file
+    :return: None
+    """
+    path = pathlib.Path(path)
+
+    if any(getattr(handler, "baseFilename", None) == str(path.absolute()) for handler in logger.handlers):
+        return None
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    return None
@@ -2,9 +2,12 @@
 # Stick with TUI for now, but launch completed map into web-browser or GUI
 import validate
 import geolocation
+import reconcile
+import jobs
 import os
 import classes
 from data_manager import DataManagerMixin
+from time import sleep
 
 
 def clear():
@@ -187,7 +190,8 @@ def import_export_menu(cls):
         print("Please select an option from the list below:\n"
               "    1) Create Flat File\n"
               "    2) Export Records\n"
-              "    3) Import Records\n")
+              "    3) Import Records\n"
+              "    4) Reconcile Roster\n")
 
         selection = validate.qu_input("Selection: ")
 
@@ -208,6 +212,16 @@ def import_export_menu(cls):
                 cls.import_csv(session)
                 continue
 
+        # Roster reconciliation matches incoming names against patients or clinicians
+        elif selection == "4":
+            if not issubclass(cls, classes.person.Human):
+                print("Rosters can only be reconciled against patients or clinicians.")
+                continue
+
+            with cls.class_session_scope() as session:
+                reconcile.reconcile_csv(cls, session)
+                continue
+
         else:
             print("Invalid selection.")
 
@@ -223,7 +237,10 @@ def geo_feat():
         print("Please select an option from the list below:\n"
               "    1) Clinician Optimizer\n"
               "    2) Team Optimizer\n"
-              "    3) Display Route\n")
+              "    3) Display Route\n"
+              "    4) What-If Scenario (Estimate)\n"
+              "    5) Queue Optimizer (Background)\n"
+              "    6) View Jobs\n")
 
         selection = validate.qu_input("Selection: ")
 
@@ -273,6 +290,43 @@ def geo_feat():
 
             continue
 
+        # Plan a team day with estimated travel times, optionally adding clinicians. Nothing is saved.
+        elif selection == "4":
+            with classes.team.Team.class_session_scope() as session:
+                obj = classes.team.Team.get_obj(session)
+                if not obj:
+                    continue
+                geolocation.what_if_scenario(obj)
+
+        # Queue an optimisation to run in a background worker so the menu is not blocked while it runs
+        elif selection == "5":
+            print("For which of the following would you like to queue an optimisation?:\n"
+                  "     1) Clinician\n"
+                  "     2) Team\n")
+
+            selection = -1
+            while selection not in ["1", "2"]:
+                selection = validate.qu_input("Selection: ")
+
+                if not selection:
+                    return 0
+
+            cls = classes.person.Clinician if selection == "1" else classes.team.Team
+
+            with cls.class_session_scope() as session:
+                obj = cls.get_obj(session)
+                if not obj:
+                    continue
+
+                if jobs.submit_optimize(obj):
+                    jobs.ensure_workers()
+                    sleep(1.5)
+
+        # Show the status of recently submitted jobs
+        elif selection == "6":
+            jobs.print_jobs()
+            validate.qu_input("Press enter to continue.")
+
         else:
             print("Invalid selection.")
 
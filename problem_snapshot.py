@@ -0,0 +1,114 @@
+# This file contains problem snapshots. When enabled, each optimisation saves the problem it solved (the travel time
+# matrix and every input built by generate_data) to a compressed NumPy archive, so that a slow or poor quality solve can
+# be replayed offline without the database or any API calls. Snapshots are replayed with benchmarks/replay.py.
+import datetime
+import json
+import pathlib
+import numpy as np
+import metrics
+import search_trace
+
+SNAPSHOT_DIR = metrics.BASE_DIR / "data" / "snapshots"
+
+# Inputs stored as numeric arrays. Skill lists vary in length, disciplines may be missing and travel time slices mix
+# modes and hours, so these are stored as JSON. The travel time matrix is an array with one matrix per slice when
+# clinicians use more than one slice. Snapshots saved before slices were added have no slice keys.
+_ARRAY_KEYS = ("coord_list", "start_list", "end_list", "time_windows", "capacities", "weights", "priorities",
+               "vehicle_slices")
+_JSON_KEYS = ("skills", "disc", "slices")
+
+# Directory snapshots are saved to, or None if snapshots are disabled
+_snapshot_dir = None
+
+
+def enable(directory=SNAPSHOT_DIR):
+    """
+    Saves a snapshot of every problem optimised by this process and any workers it starts.
+    :param directory: Directory to save snapshots to
+    :return: None
+    """
+    global _snapshot_dir
+
+    _snapshot_dir = pathlib.Path(directory)
+
+
+def save_snapshot(dist_matrix, data_dict, path=None, **details):
+    """
+    Saves a problem to a compressed archive. No pickled objects are stored, so snapshots can be loaded safely.
+    :param dist_matrix: Travel time matrix
+    :param data_dict: Inputs from generate_data
+    :param path: Path to save to. Defaults to the snapshot directory, named by date and problem fingerprint.
+    :param details: Details of the problem for reference, eg the team, date, mode and provider
+    :return: Path saved to
+    """
+    fingerprint = search_trace.problem_fingerprint(
+        dist_matrix, len(data_dict["start_list"]), *(data_dict[key] for key in
+                                                     ("start_list", "end_list", "time_windows", "capacities",
+                                                      "weights", "priorities", "skills", "disc")),
+        *([data_dict["vehicle_slices"]] if np.ndim(dist_matrix) == 3 else []))
+
+    if not path:
+        path = (_snapshot_dir or SNAPSHOT_DIR) / f"{datetime.date.today():%Y%m%d}_{fingerprint}.npz"
+
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    details = {"fingerprint": fingerprint, "created": datetime.datetime.now().isoformat(timespec="seconds"),
+               **details}
+
+    np.savez_compressed(
+        path,
+        dist_matrix=np.asarray(dist_matrix, dtype=np.int64),
+        plus_code_list=np.array(data_dict["plus_code_list"], dtype=str),
+        **{key: np.array(data_dict[key]) for key in _ARRAY_KEYS if key in data_dict},
+        skills=np.array(json.dumps([list(skill_list) if skill_list else skill_list
+                                    for skill_list in data_dict["skills"]])),
+        disc=np.array(json.dumps(data_dict["disc"])),
+        **({"slices": np.array(json.dumps(data_dict["slices"]))} if "slices" in data_dict else {}),
+        details=np.array(json.dumps(details, default=str))
+    )
+
+    return path
+
+
+def snapshot_problem(dist_matrix, data_dict, **details):
+    """
+    Saves a snapshot of a problem if snapshots are enabled. A snapshot that cannot be saved does not stop the solve.
+    :param dist_matrix: Travel time matrix
+    :param data_dict: Inputs from generate_data
+    :param details: Details of the problem for reference
+    :return: Path saved to, or None
+    """
+    if _snapshot_dir is None:
+        return None
+
+    try:
+        return save_snapshot(dist_matrix, data_dict, **details)
+
+    except OSError as err:
+        metrics.log_event("snapshot_failed", error=str(err))
+        return None
+
+
+def load_snapshot(path):
+    """
+    Loads a problem snapshot.
+    :param path: Path of the snapshot
+    :return: Tuple of (travel time matrix, data dictionary in the same form as generate_data, details)
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        dist_matrix = archive["dist_matrix"]
+
+        data_dict = {
+            "plus_code_list": archive["plus_code_list"].tolist(),
+            **{key: archive[key].tolist() for key in _ARRAY_KEYS if key in archive},
+            **{key: json.loads(archive[key].item()) for key in _JSON_KEYS if key in archive}
+        }
+
+        details = json.loads(archive["details"].item())
+
+    # Restore coordinates and time windows as tuples, as built by generate_data
+    data_dict["coord_list"] = [tuple(coord) for coord in data_dict["coord_list"]]
+    data_dict["time_windows"] = [tuple(window) for window in data_dict["time_windows"]]
+
+    return dist_matrix, data_dict, details
@@ -0,0 +1,243 @@
+# This file contains bulk name reconciliation, used to match rosters from partner agencies against existing records.
+# Names are scored many-to-many as sparse trigram vectors, blocked by date of birth or zip code, across all cores.
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import validate
+import search_index
+from lazy_import import lazy_import
+
+# Pandas and SciPy are only imported when a roster is first reconciled
+pd = lazy_import("pandas")
+sparse = lazy_import("scipy.sparse")
+
+_block_columns = {"dob": "_dob", "zip_code": "_zip_code"}
+
+# Maximum number of incoming and candidate name pairs scored at once, which bounds the memory used by each chunk
+MAX_CHUNK_PAIRS = 2 ** 22
+
+# Candidate trigram matrix shared by every block scored in this process, set by init_candidates
+_candidates = {}
+
+
+def trigram_matrix(names, vocab):
+    """
+    Converts a list of names into a sparse binary matrix of trigrams. Trigrams not in the vocabulary are ignored.
+    :param names: List of names
+    :param vocab: Dictionary of trigram to column index
+    :return: Sparse CSR matrix with one row per name
+    """
+    rows, cols = [], []
+
+    for row, name in enumerate(names):
+        for trigram in search_index.trigrams(name):
+            col = vocab.get(trigram)
+
+            if col is not None:
+                rows.append(row)
+                cols.append(col)
+
+    data = np.ones(len(rows), dtype=np.float32)
+    return sparse.csr_matrix((data, (rows, cols)), shape=(len(names), len(vocab)))
+
+
+def init_candidates(vocab, cand_matrix, cand_ids):
+    """
+    Stores the candidate trigram matrix for score_block. Used as the initializer of each worker process, so that the
+    candidates are sent to each worker once rather than with every block.
+    :param vocab: Dictionary of trigram to column index
+    :param cand_matrix: Sparse CSR trigram matrix with one row per candidate
+    :param cand_ids: List of candidate ids, one for each row
+    :return: None
+    """
+    _candidates.update(vocab=vocab, matrix=cand_matrix, ids=cand_ids,
+                       sizes=np.asarray(cand_matrix.sum(axis=1), dtype=np.float32).ravel())
+
+
+def score_block(block):
+    """
+    Scores every incoming name in a block against every candidate in the block using the Dice coefficient of their
+    trigram sets, then keeps the best matches for each incoming name. The overlap of each pair is kept sparse, so only
+    pairs sharing a trigram are scored. This is run in a worker process set up by init_candidates.
+    :param block: Tuple of (incoming indices, incoming names, candidate rows or None for every candidate, top_n,
+        threshold)
+    :return: List of (incoming index, rank, candidate id, score) tuples
+    """
+    in_index, in_names, cand_rows, top_n, threshold = block
+    cand_matrix = _candidates["matrix"] if cand_rows is None else _candidates["matrix"][cand_rows]
+    cand_sizes = _candidates["sizes"] if cand_rows is None else _candidates["sizes"][cand_rows]
+    cand_ids = _candidates["ids"] if cand_rows is None else [_candidates["ids"][row] for row in cand_rows]
+
+    if not cand_matrix.shape[0]:
+        return []
+
+    # Intersection sizes for every pair that shares a trigram, then Dice = 2|A n B| / (|A| + |B|)
+    overlap = (trigram_matrix(in_names, _candidates["vocab"]) @ cand_matrix.T).tocsr()
+    in_sizes = np.array([len(search_index.trigrams(name)) for name in in_names], dtype=np.float32)
+
+    matches = []
+    for row, index in enumerate(in_index):
+        cols = overlap.indices[overlap.indptr[row]:overlap.indptr[row + 1]]
+        scores = 2 * overlap.data[overlap.indptr[row]:overlap.indptr[row + 1]] / (in_sizes[row] + cand_sizes[cols])
+
+        # Rank the top candidates above the threshold, best score first
+        keep = scores >= threshold
+        cols, scores = cols[keep], scores[keep]
+        best = np.lexsort((cols, -scores))[:top_n]
+
+        matches.extend((index, rank + 1, cand_ids[cols[pos]], float(scores[pos])) for rank, pos in enumerate(best))
+
+    return matches
+
+
+def reconcile(cls, session, names, dobs=None, zip_codes=None, block_by="dob", top_n=3, threshold=0.6,
+              inc_inac=0, processes=None):
+    """
+    Matches a list of incoming names against existing records of a class.
+    Incoming names are only compared with records sharing their block key (date of birth or zip code). Any incoming
+    name without a block key is compared with every record.
+    :param cls: Class of object being matched (Patient or Clinician)
+    :param session: Session for querying database
+    :param names: List of incoming names
+    :param dobs: Optional list of incoming dates of birth in the format DD/MM/YYYY
+    :param zip_codes: Optional list of incoming zip codes
+    :param block_by: "dob", "zip_code" or None to compare every name with every record
+    :param top_n: Number of ranked matches to keep for each incoming name
+    :param threshold: Minimum similarity score for a match
+    :param inc_inac: Flags whether inactive records should be included
+    :param processes: Number of worker processes. Defaults to the number of cores.
+    :return: Dataframe of ranked matches
+    """
+    # Load only the columns needed for matching rather than hydrating every record
+    columns = [cls._id, cls._name, cls._status]
+    if block_by:
+        columns.append(getattr(cls, _block_columns[block_by]))
+
+    records = [record for record in session.query(*columns).all() if inc_inac or str(record[2]) == "1"]
+
+    # Work out the block key of each incoming name
+    if block_by == "dob":
+        in_keys = [None if not dobs or not dobs[i] else validate.valid_date(str(dobs[i])) for i in range(len(names))]
+        in_keys = [None if isinstance(key, Exception) or key is None else key.date() for key in in_keys]
+
+    elif block_by == "zip_code":
+        in_keys = [None if not zip_codes or not zip_codes[i] else str(zip_codes[i]) for i in range(len(names))]
+
+    else:
+        in_keys = [None] * len(names)
+
+    # Build one trigram matrix over every candidate. Incoming trigrams not seen in any candidate cannot add overlap.
+    all_ids = [record[0] for record in records]
+    all_names = [record[1] for record in records]
+
+    vocab = {}
+    for name in all_names:
+        for trigram in search_index.trigrams(name):
+            vocab.setdefault(trigram, len(vocab))
+
+    cand_matrix = trigram_matrix(all_names, vocab)
+
+    # Group candidates by block key, as rows of the candidate matrix
+    cand_blocks = {}
+    for row, record in enumerate(records):
+        cand_blocks.setdefault(record[3] if block_by else None, []).append(row)
+
+    # Group incoming names by block key, pairing each with its candidate block
+    in_blocks = {}
+    for index, key in enumerate(in_keys):
+        in_blocks.setdefault(key, ([], []))
+        in_blocks[key][0].append(index)
+        in_blocks[key][1].append(names[index])
+
+    # Large blocks are split into chunks of incoming names to bound the number of pairs scored at once. Names without a
+    # block key are compared with every candidate, so are scored in smaller chunks.
+    blocks = []
+    for key, (in_index, in_names) in in_blocks.items():
+        cand_rows = np.array(cand_blocks.get(key, []), dtype=np.int64) if key is not None else None
+        num_cands = len(all_ids) if cand_rows is None else len(cand_rows)
+        chunk_size = max(1, min(256, MAX_CHUNK_PAIRS // max(1, num_cands)))
+
+        for start in range(0, len(in_index), chunk_size):
+            blocks.append((in_index[start:start + chunk_size], in_names[start:start + chunk_size],
+                           cand_rows, top_n, threshold))
+
+    # Score blocks in parallel. Small jobs are scored in process to avoid the cost of starting workers.
+    processes = processes or os.cpu_count()
+
+    if processes > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_candidates,
+                                 initargs=(vocab, cand_matrix, all_ids)) as executor:
+            results = list(executor.map(score_block, blocks, chunksize=max(1, len(blocks) // (processes * 4))))
+
+    else:
+        init_candidates(vocab, cand_matrix, all_ids)
+        results = [score_block(block) for block in blocks]
+
+    name_lookup = dict(zip(all_ids, all_names))
+    matches = [
+        {
+            "Input Index": index,
+            "Input Name": names[index],
+            "Rank": rank,
+            f"{cls.__name__} ID": obj_id,
+            f"{cls.__name__} Name": name_lookup[obj_id],
+            "Score": round(score, 3)
+        }
+        for block_matches in results for index, rank, obj_id, score in block_matches
+    ]
+
+    match_df = pd.DataFrame(matches, columns=["Input Index", "Input Name", "Rank", f"{cls.__name__} ID",
+                                              f"{cls.__name__} Name", "Score"])
+
+    return match_df.sort_values(["Input Index", "Rank"]).reset_index(drop=True)
+
+
+def reconcile_csv(cls, session):
+    """
+    Prompts the user for a roster csv with a "name" column and optional "dob" and "zip_code" columns, then writes the
+    ranked matches to a csv.
+    :param cls: Class of object being matched (Patient or Clinician)
+    :param session: Session for querying database
+    :return: 1 if successful
+    """
+    while True:
+        try:
+            filepath = validate.qu_input("Enter a roster csv file location to reconcile: ")
+
+            if not filepath:
+                return 0
+
+            roster = pd.read_csv(filepath, dtype=str).fillna("")
+            break
+
+        except (FileNotFoundError, OSError):
+            print("File not found. Ensure the input file contains '.csv' at the end.")
+
+    if "name" not in roster.columns:
+        print('The roster must contain a "name" column.')
+        return 0
+
+    # Block by date of birth if provided, else zip code, else compare every name with every record
+    block_by = "dob" if "dob" in roster.columns else "zip_code" if "zip_code" in roster.columns else None
+
+    match_df = reconcile(cls, session, roster["name"].tolist(),
+                         dobs=roster["dob"].tolist() if "dob" in roster.columns else None,
+                         zip_codes=roster["zip_code"].tolist() if "zip_code" in roster.columns else None,
+                         block_by=block_by)
+
+    print(f"Found matches for {match_df['Input Index'].nunique()} of {len(roster)} names.")
+
+    while True:
+        try:
+            filepath = validate.qu_input("Enter a file location to export the matches to: ")
+
+            if not filepath:
+                return 0
+
+            match_df.to_csv(filepath, index=False)
+            print("Export successful.")
+
+            return 1
+
+        except (FileNotFoundError, OSError):
+            print("File not found. Ensure the input file contains '.csv' at the end.")
@@ -0,0 +1,353 @@
+# This file contains the road graph store. Pre-built OpenStreetMaps graphs are kept on disk per service region so that
+# route display does not need to download and build a fresh graph for every bounding box.
+import datetime
+import json
+import os
+import threading
+import weakref
+import numpy as np
+import leg_routing
+import metrics
+from data_manager import DataManagerMixin
+from lazy_import import lazy_import
+
+# OSMnx and SciPy are only imported when a graph is first built, loaded or snapped to
+ox = lazy_import("osmnx")
+spatial = lazy_import("scipy.spatial")
+
+GRAPH_DIR = DataManagerMixin.BASE_DIR / "data" / "graphs"
+REGION_INDEX = GRAPH_DIR / "regions.json"
+
+# Padding in degrees (~5km) added around a new region so that nearby routes can be served from the same graph
+REGION_BUFFER = 0.05
+
+# Graphs older than this are rebuilt by the refresh job
+MAX_GRAPH_AGE = datetime.timedelta(days=7)
+
+# Average speeds in km/h for networks that are not travelled at motor-vehicle speeds. OSMnx fills in edge speeds from
+# speed limits, so every edge on these networks is given the speed for the mode instead.
+NETWORK_SPEEDS = {
+    "walk": 4.5,
+    "bike": 14
+}
+
+# Loaded graphs by (region, mode). The lock guards both the cache and the region index.
+_graphs = {}
+_lock = threading.RLock()
+
+# KD-trees and CSR arrays for each loaded graph. Entries are dropped when their graph is garbage collected.
+_node_trees = weakref.WeakKeyDictionary()
+_csr_graphs = weakref.WeakKeyDictionary()
+
+
+def load_regions():
+    """
+    Loads the index of service regions from disk.
+    :return: Dictionary of region name to {"bbox": [north, south, east, west], "built": {mode: ISO timestamp}}
+    """
+    try:
+        with open(REGION_INDEX) as file:
+            return json.load(file)
+
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_regions(regions):
+    """
+    Writes the index of service regions to disk. The file is replaced atomically so readers never see a partial file.
+    :param regions: Dictionary of regions as returned by load_regions
+    :return: None
+    """
+    GRAPH_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = REGION_INDEX.with_suffix(".tmp")
+
+    with open(tmp_path, "w") as file:
+        json.dump(regions, file, indent=2)
+
+    os.replace(tmp_path, REGION_INDEX)
+
+
+def register_region(name, north, south, east, west):
+    """
+    Adds or resizes a service region. Graphs for the region are built the next time they are requested.
+    :param name: Name of the region
+    :param north: Northern latitude limit
+    :param south: Southern latitude limit
+    :param east: Eastern longitude limit
+    :param west: Western longitude limit
+    :return: Name of the region
+    """
+    with _lock:
+        regions = load_regions()
+        regions[name] = {"bbox": [north, south, east, west], "built": {}}
+        save_regions(regions)
+
+        # Drop any loaded graphs for the region as they no longer cover the same area
+        for key in [key for key in _graphs if key[0] == name]:
+            del _graphs[key]
+
+    return name
+
+
+def find_region(north, south, east, west):
+    """
+    Finds a service region that fully contains the bounding box. The smallest containing region is preferred.
+    :return: Name of the region, or None if no region contains the bounding box
+    """
+    containing = [
+        (abs((bbox[0] - bbox[1]) * (bbox[2] - bbox[3])), name)
+        for name, region in load_regions().items()
+        for bbox in [region["bbox"]]
+        if bbox[0] >= north and bbox[1] <= south and bbox[2] >= east and bbox[3] <= west
+    ]
+
+    return min(containing)[1] if containing else None
+
+
+def graph_path(region, mode):
+    """Returns the GraphML path for a region and mode."""
+    return GRAPH_DIR / f"{region}_{mode}.graphml"
+
+
+def csr_path(region, mode):
+    """Returns the path of the preprocessed CSR arrays for a region and mode."""
+    return GRAPH_DIR / f"{region}_{mode}.npz"
+
+
+def build_graph(region, mode):
+    """
+    Downloads and builds the graph for a region, annotates each edge with a travel time in seconds and saves it to disk.
+    Walking and cycling networks are travelled at the fixed speed for the mode. The file is written to a temporary path
+    first so that a failed build leaves the previous graph in place.
+    :param region: Name of the region
+    :param mode: OSMnx network type, eg "drive", "walk" or "bike"
+    :return: Graph
+    """
+    north, south, east, west = load_regions()[region]["bbox"]
+
+    graph = ox.graph_from_bbox(north, south, east, west, network_type=mode)
+
+    # Set the speed of each edge, then its travel time from its length
+    if mode in NETWORK_SPEEDS:
+        for _, _, data in graph.edges(data=True):
+            data["speed_kph"] = NETWORK_SPEEDS[mode]
+
+        graph.graph["speed_kph"] = NETWORK_SPEEDS[mode]
+
+    else:
+        graph = ox.add_edge_speeds(graph)
+
+    graph = ox.add_edge_travel_times(graph)
+    graph.graph["region"] = region
+    graph.graph["mode"] = mode
+
+    GRAPH_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = graph_path(region, mode).with_suffix(".tmp")
+    ox.save_graphml(graph, tmp_path)
+    os.replace(tmp_path, graph_path(region, mode))
+
+    # Preprocess the graph into CSR arrays for fast leg queries
+    build_csr(graph)
+
+    with _lock:
+        regions = load_regions()
+        regions[region]["built"][mode] = datetime.datetime.now().isoformat()
+        save_regions(regions)
+        _graphs[(region, mode)] = graph
+
+    # Cached legs may no longer be the shortest on the rebuilt graph
+    leg_routing.clear_cache()
+
+    return graph
+
+
+def load_graph(region, mode):
+    """
+    Returns the graph for a region, loading it from memory or disk if available and building it otherwise.
+    :param region: Name of the region
+    :param mode: OSMnx network type
+    :return: Graph
+    """
+    with _lock:
+        graph = _graphs.get((region, mode))
+
+    metrics.cache_lookup("road_graph", graph is not None)
+
+    if graph is not None:
+        return graph
+
+    if graph_path(region, mode).exists():
+        metrics.increment("road_graph_loads", source="disk", mode=mode)
+        graph = ox.load_graphml(graph_path(region, mode))
+
+        # Graphs saved before their network had a fixed speed have motor-vehicle travel times, so are rebuilt
+        if mode in NETWORK_SPEEDS and float(graph.graph.get("speed_kph", 0)) != NETWORK_SPEEDS[mode]:
+            return build_graph(region, mode)
+
+        graph.graph["region"] = region
+        graph.graph["mode"] = mode
+
+        with _lock:
+            _graphs[(region, mode)] = graph
+
+        return graph
+
+    return build_graph(region, mode)
+
+
+def get_graph(north, south, east, west, mode="drive"):
+    """
+    Returns a road graph covering the bounding box. If no service region covers it, a new region is registered around
+    the bounding box with a buffer so that later routes nearby can reuse it.
+    :param north: Northern latitude limit
+    :param south: Southern latitude limit
+    :param east: Eastern longitude limit
+    :param west: Western longitude limit
+    :param mode: OSMnx network type
+    :return: Graph
+    """
+    with _lock:
+        region = find_region(north, south, east, west)
+
+        if not region:
+            region = register_region(f"region_{len(load_regions()) + 1}",
+                                     north + REGION_BUFFER, south - REGION_BUFFER,
+                                     east + REGION_BUFFER, west - REGION_BUFFER)
+
+    return load_graph(region, mode)
+
+
+def refresh_graphs(max_age=MAX_GRAPH_AGE):
+    """
+    Rebuilds any graph that is older than the maximum age. Graphs continue to be served from the previous build while
+    the refresh is running.
+    :param max_age: Timedelta after which a graph is rebuilt
+    :return: Number of graphs rebuilt
+    """
+    now = datetime.datetime.now()
+    rebuilt = 0
+
+    for region, details in load_regions().items():
+        for mode, built in details["built"].items():
+            if now - datetime.datetime.fromisoformat(built) < max_age:
+                continue
+
+            try:
+                build_graph(region, mode)
+                rebuilt += 1
+
+            except Exception as err:
+                print(f"Unable to refresh graph for {region} ({mode}): {err}")
+
+    return rebuilt
+
+
+def start_background_refresh(interval_hours=6):
+    """
+    Starts a daemon thread that periodically rebuilds stale graphs.
+    :param interval_hours: Hours between refresh checks
+    :return: Thread
+    """
+    stop_event = threading.Event()
+
+    def refresh_loop():
+        while not stop_event.wait(interval_hours * 3600):
+            refresh_graphs()
+
+    thread = threading.Thread(target=refresh_loop, name="road-graph-refresh", daemon=True)
+    thread.stop_event = stop_event
+    thread.start()
+
+    return thread
+
+
+def to_unit_sphere(lats, lngs):
+    """
+    Converts latitudes and longitudes to points on a unit sphere. Straight-line distance between these points increases
+    with great-circle distance, so a KD-tree over them finds the nearest node on the globe.
+    :param lats: Array of latitudes
+    :param lngs: Array of longitudes
+    :return: Array of shape (n, 3)
+    """
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lngs = np.radians(np.asarray(lngs, dtype=float))
+
+    return np.column_stack((np.cos(lats) * np.cos(lngs), np.cos(lats) * np.sin(lngs), np.sin(lats)))
+
+
+def node_tree(graph):
+    """
+    Returns a KD-tree over the nodes of a graph, building and caching it on first use.
+    :param graph: Graph
+    :return: Tuple of (KD-tree, array of node ids in tree order)
+    """
+    with _lock:
+        if graph not in _node_trees:
+            node_ids = np.array(list(graph.nodes))
+            lats = [graph.nodes[node]["y"] for node in node_ids]
+            lngs = [graph.nodes[node]["x"] for node in node_ids]
+            _node_trees[graph] = (spatial.cKDTree(to_unit_sphere(lats, lngs)), node_ids)
+
+        return _node_trees[graph]
+
+
+def snap_coords(graph, coords):
+    """
+    Snaps a list of coordinates to their nearest graph nodes in a single vectorised query.
+    :param graph: Graph
+    :param coords: List of (latitude, longitude) tuples
+    :return: List of node ids in the same order as coords
+    """
+    if not coords:
+        return []
+
+    tree, node_ids = node_tree(graph)
+    _, indices = tree.query(to_unit_sphere([coord[0] for coord in coords], [coord[1] for coord in coords]))
+
+    return node_ids[indices].tolist()
+
+
+def build_csr(graph):
+    """
+    Preprocesses a graph into CSR arrays and saves them alongside its GraphML file.
+    :param graph: Graph loaded from the store
+    :return: CSRGraph
+    """
+    csr = leg_routing.CSRGraph.from_graph(graph)
+
+    with _lock:
+        _csr_graphs[graph] = csr
+
+    if "region" in graph.graph:
+        tmp_path = csr_path(graph.graph["region"], graph.graph["mode"]).with_suffix(".tmp.npz")
+        csr.save(tmp_path)
+        os.replace(tmp_path, csr_path(graph.graph["region"], graph.graph["mode"]))
+
+    return csr
+
+
+def csr_graph(graph):
+    """
+    Returns the CSR arrays for a graph, loading them from disk if they were built from the current GraphML file and
+    building them otherwise.
+    :param graph: Graph loaded from the store
+    :return: CSRGraph
+    """
+    with _lock:
+        if graph in _csr_graphs:
+            return _csr_graphs[graph]
+
+    if "region" in graph.graph:
+        path = csr_path(graph.graph["region"], graph.graph["mode"])
+        source = graph_path(graph.graph["region"], graph.graph["mode"])
+
+        if path.exists() and source.exists() and path.stat().st_mtime >= source.stat().st_mtime:
+            csr = leg_routing.CSRGraph.load(path)
+
+            with _lock:
+                _csr_graphs[graph] = csr
+
+            return csr
+
+    return build_csr(graph)
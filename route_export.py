@@ -0,0 +1,192 @@
+# This file contains the GeoJSON route export. Each clinician's route for a day is exported as a small FeatureCollection
+# of ordered stops and leg geometries with ETAs and time windows, so that lightweight clients do not need to load a
+# rendered map. Exports are built from the stored visit order and saved in the map cache alongside rendered maps.
+import datetime
+import json
+import validate
+import geometry
+import leg_routing
+import map_cache
+import matrix_providers
+import road_graph
+
+# Leg geometries are simplified to what is visible at this zoom level, which is close enough for street-level display
+EXPORT_ZOOM = 17
+
+
+def leg_travel_time(graph, path, weight="travel_time"):
+    """
+    Adds up the travel time along a path. For multigraphs the lightest parallel edge is used.
+    :param graph: Graph
+    :param path: List of nodes along the path
+    :param weight: Name of edge attribute to use as weight
+    :return: Travel time in seconds
+    """
+    get_weight = leg_routing.edge_weight(graph, weight)
+
+    return sum(get_weight(graph.succ[u][v]) for u, v in zip(path[:-1], path[1:]))
+
+
+def point_feature(coord, properties):
+    """Returns a GeoJSON point feature. GeoJSON coordinates are ordered longitude, latitude."""
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [coord[1], coord[0]]},
+            "properties": properties}
+
+
+def route_geojson(clin, visits, val_date, mode=None):
+    """
+    Builds the GeoJSON export of a clinician's route. ETAs follow the optimizer's model: the clinician leaves at their
+    start time, travels each leg and waits at a stop until its time window opens.
+    :param clin: Clinician
+    :param visits: Visits for the clinician, sorted by order
+    :param val_date: Date of the route
+    :param mode: OSMnx network type used to route legs. Defaults to the network for the clinician's travel mode.
+    :return: GeoJSON FeatureCollection as a dictionary
+    """
+    mode = mode or matrix_providers.map_network_type(clin._travel_mode)
+    coords = [clin.start_coord] + [visit.coord for visit in visits] + [clin.end_coord]
+
+    # Route every leg on the cached road graph for the area covering the stops
+    lats = [coord[0] for coord in coords]
+    lngs = [coord[1] for coord in coords]
+    graph = road_graph.get_graph(max(lats), min(lats), max(lngs), min(lngs), mode=mode)
+    stop_nodes = road_graph.snap_coords(graph, coords)
+    legs = leg_routing.route_stops(graph, stop_nodes, mode, csr=road_graph.csr_graph(graph))
+
+    tolerance = geometry.tolerance_for_zoom(EXPORT_ZOOM)
+    eta = datetime.datetime.combine(val_date, clin._start_time)
+    base = {"clinician_id": clin.id}
+
+    features = [point_feature(clin.start_coord, {**base, "role": "start", "address": clin.address,
+                                                 "departure": eta.strftime("%H%M")})]
+    leg_features = []
+
+    for leg_index, leg in enumerate(legs):
+        travel_time = leg_travel_time(graph, leg)
+        eta += datetime.timedelta(seconds=travel_time)
+
+        leg_coords = geometry.simplify_path([(graph.nodes[node]["y"], graph.nodes[node]["x"]) for node in leg],
+                                            tolerance)
+        leg_features.append({
+            "type": "Feature",
+            "geometry": {"type": "LineString", "coordinates": [[lng, lat] for lat, lng in leg_coords]},
+            "properties": {**base, "role": "leg", "leg": leg_index, "travel_time": round(travel_time / 60, 1)}
+        })
+
+        # The last leg returns the clinician to their end location
+        if leg_index == len(visits):
+            features.append(point_feature(clin.end_coord, {**base, "role": "end", "address": clin.end_address,
+                                                           "eta": eta.strftime("%H%M")}))
+            break
+
+        # Wait at the visit if the clinician arrives before its time window opens
+        visit = visits[leg_index]
+        eta = max(eta, datetime.datetime.combine(val_date, visit._time_earliest))
+
+        features.append(point_feature(visit.coord, {
+            **base,
+            "role": "visit",
+            "visit_id": visit.id,
+            "order": visit._order,
+            "address": visit.address,
+            "time_earliest": visit.time_earliest,
+            "time_latest": visit.time_latest,
+            "eta": eta.strftime("%H%M"),
+            "late": eta.time() > visit._time_latest
+        }))
+
+    return {
+        "type": "FeatureCollection",
+        "properties": {
+            "clinician_id": clin.id,
+            "clinician": clin.name,
+            "date": str(val_date),
+            "mode": mode,
+            "travel_time": round(sum(feature["properties"]["travel_time"] for feature in leg_features), 1)
+        },
+        "features": features + leg_features
+    }
+
+
+def export_route(clin, visits, val_date, mode=None):
+    """
+    Returns the GeoJSON export of a clinician's route from the map cache, building and caching it if the route has
+    changed since it was last exported.
+    :param clin: Clinician
+    :param visits: Visits for the clinician, sorted by order
+    :param val_date: Date of the route
+    :param mode: OSMnx network type used to route legs. Defaults to the network for the clinician's travel mode.
+    :return: GeoJSON FeatureCollection as a dictionary, or None if the clinician has no ordered visits
+    """
+    mode = mode or matrix_providers.map_network_type(clin._travel_mode)
+
+    if not visits or any(visit._order is None for visit in visits):
+        return None
+
+    key = map_cache.route_key([clin], [visits], val_date, f"geojson_{mode}", mode=mode)
+    path = map_cache.load_map(key, ".geojson")
+
+    if path:
+        with open(path) as file:
+            return json.load(file)
+
+    route = route_geojson(clin, visits, val_date, mode=mode)
+    map_cache.save_json(route, key, ".geojson")
+
+    return route
+
+
+def export_routes(clins, visits, val_date):
+    """
+    Returns the GeoJSON export for each clinician with ordered visits. Routes for several clinicians are combined into
+    one FeatureCollection.
+    :param clins: Clinicians on the route
+    :param visits: Visits for each clinician on the route, sorted by order
+    :param val_date: Date of the route
+    :return: GeoJSON FeatureCollection as a dictionary, or None if no clinician has ordered visits
+    """
+    routes = [export_route(clin, visits[clin_index], val_date) for clin_index, clin in enumerate(clins)]
+    routes = [route for route in routes if route]
+
+    if not routes:
+        return None
+
+    if len(routes) == 1:
+        return routes[0]
+
+    return {
+        "type": "FeatureCollection",
+        "properties": {"date": str(val_date), "clinicians": [route["properties"] for route in routes]},
+        "features": [feature for route in routes for feature in route["features"]]
+    }
+
+
+def export_routes_file(clins, visits, val_date):
+    """
+    Prompts the user for a file location and writes the GeoJSON export of the route.
+    :param clins: Clinicians on the route
+    :param visits: Visits for each clinician on the route, sorted by order
+    :param val_date: Date of the route
+    :return: 1 if successful
+    """
+    export = export_routes(clins, visits, val_date)
+
+    if not export:
+        print("No optimized visits on this date. Returning...")
+        return 0
+
+    while True:
+        filepath = validate.qu_input("Enter a file location to export the route to (*.geojson): ")
+
+        if not filepath:
+            return 0
+
+        try:
+            with open(filepath, "w") as file:
+                json.dump(export, file)
+
+            print("Export successful.")
+            return 1
+
+        except (FileNotFoundError, OSError):
+            print("Invalid path.")
@@ -0,0 +1,133 @@
+# This file contains the route solution. A solver solution is walked once to extract every clinician's route, with the
+# arrival time, leg time and waiting time at each stop and the visits that could not be seen. The result cannot be
+# changed, so it can be shared by everything that displays, saves or reports on a solution without querying the solver
+# again.
+import numpy as np
+import solution_analysis
+
+# Arrays holding one entry per stop, including each clinician's start and end location
+STOP_FIELDS = ("vehicle", "position", "node", "arrival", "latest", "leg_time", "slack")
+
+
+class RouteSolution:
+    """
+    Immutable summary of a solved routing problem. Stops are held as read-only arrays, one entry per stop:
+        - vehicle: Index of the clinician
+        - position: Position of the stop in the clinician's route, starting at 0 for the start location
+        - node: Index of the location in the distance matrix
+        - arrival: Earliest arrival time in minutes from midnight
+        - latest: Latest arrival time in minutes from midnight that keeps the rest of the route feasible
+        - leg_time: Travel time in minutes from the previous stop
+        - slack: Minutes spent waiting at the stop before leaving for the next one
+    """
+
+    def __init__(self, objective, num_clinicians, num_visits, stops, dropped):
+        """
+        :param objective: Objective value of the solution
+        :param num_clinicians: Number of clinicians, which is also the number of start locations in the matrix
+        :param num_visits: Number of visits in the problem
+        :param stops: Dictionary of stop arrays, keyed by STOP_FIELDS
+        :param dropped: Table of dropped visits from solution_analysis.dropped_visits
+        """
+        dropped = dropped.copy()
+        dropped.setflags(write=False)
+
+        for field in STOP_FIELDS:
+            array = np.array(stops[field], dtype=np.int64)
+            array.setflags(write=False)
+            self.__dict__[field] = array
+
+        self.__dict__.update(objective=objective, num_clinicians=num_clinicians, num_visits=num_visits,
+                             dropped=dropped)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("Route solutions cannot be changed.")
+
+    def __repr__(self):
+        return f"<RouteSolution objective={self.objective} assigned={self.num_assigned} dropped={len(self.dropped)}>"
+
+    @classmethod
+    def from_solver(cls, manager, routing, solution, num_clinicians, num_visits, dropped):
+        """
+        Walks every clinician's route once and extracts each stop.
+        :param manager: Index manager - parses details from distance matrix
+        :param routing: Routing Model - sets parameters for solution
+        :param solution: Solution from routing model
+        :param num_clinicians: Number of clinicians in the problem
+        :param num_visits: Number of visits in the problem
+        :param dropped: Table of dropped visits from solution_analysis.dropped_visits
+        :return: RouteSolution
+        """
+        time_dimension = routing.GetDimensionOrDie("Time")
+        rows = []
+
+        for vehicle in range(num_clinicians):
+            index = routing.Start(vehicle)
+            previous_index = None
+            position = 0
+
+            while True:
+                time_var = time_dimension.CumulVar(index)
+                rows.append((vehicle, position, manager.IndexToNode(index), solution.Min(time_var),
+                             solution.Max(time_var),
+                             0 if previous_index is None else
+                             routing.GetArcCostForVehicle(previous_index, index, vehicle)))
+
+                if routing.IsEnd(index):
+                    break
+
+                previous_index, index = index, solution.Value(routing.NextVar(index))
+                position += 1
+
+        table = np.array(rows, dtype=np.int64).reshape(-1, 6)
+        stops = {field: table[:, column] for column, field in enumerate(STOP_FIELDS[:-1])}
+
+        # Waiting time is the gap between arriving at the next stop and leaving this one with no waiting. Slack
+        # variables are not stored in the solution, so this is calculated from the arrival times. End locations have
+        # no slack.
+        slack = np.zeros(len(table), dtype=np.int64)
+        slack[:-1] = np.diff(stops["arrival"]) - stops["leg_time"][1:]
+        slack[np.r_[stops["position"][1:] == 0, True]] = 0
+        stops["slack"] = slack
+
+        return cls(solution.ObjectiveValue(), num_clinicians, num_visits, stops, dropped)
+
+    @property
+    def visit_stops(self):
+        """Boolean mask of the stops that are visits, rather than a clinician's start or end location."""
+        return (self.node >= self.num_clinicians) & (self.node < self.num_clinicians + self.num_visits)
+
+    @property
+    def num_assigned(self):
+        """Number of visits assigned to a clinician."""
+        return int(self.visit_stops.sum())
+
+    @property
+    def dropped_visits(self):
+        """Indices in the visit list of the visits that could not be seen, with the reason for each."""
+        return list(zip(self.dropped["visit"].tolist(), self.dropped["reason"].tolist()))
+
+    def route(self, vehicle):
+        """
+        Returns the visits on a clinician's route in order.
+        :param vehicle: Index of the clinician
+        :return: Array of indices in the visit list
+        """
+        return self.node[(self.vehicle == vehicle) & self.visit_stops] - self.num_clinicians
+
+    def route_time(self, vehicle):
+        """
+        Returns the minutes a clinician spends travelling on their route. Arrival at the end location is pushed to the
+        end of their shift by the solver, so the time between leaving and returning is not used.
+        """
+        return int(self.leg_time[self.vehicle == vehicle].sum())
+
+    def summary(self):
+        """Returns a dictionary summarising the solution."""
+        return {
+            "visits": self.num_visits,
+            "assigned": self.num_assigned,
+            "dropped": len(self.dropped),
+            "dropped_reasons": solution_analysis.reason_counts(self.dropped),
+            "objective": self.objective
+        }
@@ -0,0 +1,166 @@
+# This file contains a trigram index over record names. It narrows fuzzy name searches to a small set of candidates so
+# that Levenshtein scoring does not need to load every row of a table.
+import re
+from sqlalchemy import Column, String, Integer, Index, event, exists, func, inspect
+from data_manager import DataManagerMixin
+
+# Tables that have been registered for indexing, mapped to their class
+_indexed_classes = {}
+
+
+class NameTrigram(DataManagerMixin.Base):
+    # Initialise table details. Each row links one trigram of a record's name back to the record.
+    __tablename__ = "NameTrigram"
+    _id = Column(Integer, primary_key=True)
+    _table = Column(String, nullable=False)
+    _obj_id = Column(Integer, nullable=False)
+    _trigram = Column(String, nullable=False)
+
+    __table_args__ = (
+        Index("ix_NameTrigram_lookup", "_table", "_trigram"),
+        Index("ix_NameTrigram_obj", "_table", "_obj_id"),
+    )
+
+
+def trigrams(value):
+    """
+    Splits a name into the set of trigrams for each word. Words are padded so that the start and end of each word carry
+    more weight. As the set is order independent, "LAST, FIRST MIDDLE" and "FIRST MIDDLE LAST" share the same trigrams.
+    :param value: Name to split
+    :return: Set of trigrams
+    """
+    if not value:
+        return set()
+
+    words = re.findall(r"[a-z0-9]+", str(value).lower())
+
+    return {f"  {word} "[i:i + 3] for word in words for i in range(len(word) + 1)}
+
+
+def register(cls):
+    """
+    Registers a class for name indexing. The index is kept in sync with the class table whenever a record is inserted,
+    renamed or deleted.
+    :param cls: Class with an _id and _name column
+    :return: None
+    """
+    _indexed_classes[cls.__tablename__] = cls
+
+    event.listen(cls, "after_insert", _index_obj)
+    event.listen(cls, "after_update", _reindex_obj)
+    event.listen(cls, "after_delete", _remove_obj)
+
+
+def is_indexed(cls):
+    """
+    Checks whether a class has been registered for name indexing.
+    :param cls: Class to check
+    :return: True if indexed
+    """
+    return cls.__tablename__ in _indexed_classes
+
+
+def _index_obj(mapper, connection, target):
+    """Writes the trigrams for a newly inserted record."""
+    rows = [
+        {"_table": target.__tablename__, "_obj_id": target._id, "_trigram": trigram}
+        for trigram in trigrams(target._name)
+    ]
+
+    if rows:
+        connection.execute(NameTrigram.__table__.insert(), rows)
+
+
+def _remove_obj(mapper, connection, target):
+    """Removes the trigrams for a deleted record."""
+    table = NameTrigram.__table__
+    connection.execute(
+        table.delete().where(table.c._table == target.__tablename__, table.c._obj_id == target._id)
+    )
+
+
+def _reindex_obj(mapper, connection, target):
+    """Rewrites the trigrams for an updated record, but only if its name has changed."""
+    if not inspect(target).attrs._name.history.has_changes():
+        return None
+
+    _remove_obj(mapper, connection, target)
+    _index_obj(mapper, connection, target)
+
+
+def candidate_ids(session, cls, name, limit=50, inc_inac=1):
+    """
+    Finds the ids of the records whose names share the most trigrams with the search term.
+    :param session: Session for querying database
+    :param cls: Class of object being searched
+    :param name: Name that is being searched
+    :param limit: Maximum number of candidates to return
+    :param inc_inac: Flags whether inactive records are included. Inactive records are filtered out before the limit is
+        applied, so that they cannot push active matches out of the candidates.
+    :return: List of object ids, best candidates first
+    """
+    search_trigrams = trigrams(name)
+
+    if not search_trigrams:
+        return []
+
+    query = session.query(NameTrigram._obj_id) \
+        .filter(NameTrigram._table == cls.__tablename__, NameTrigram._trigram.in_(search_trigrams))
+
+    # Records are active if their status is 1, which SQLite stores as text in the status column
+    if not inc_inac:
+        query = query.join(cls, cls._id == NameTrigram._obj_id).filter(cls._status == "1")
+
+    rows = query \
+        .group_by(NameTrigram._obj_id) \
+        .order_by(func.count().desc()) \
+        .limit(limit) \
+        .all()
+
+    return [row[0] for row in rows]
+
+
+def rebuild_index(session, cls):
+    """
+    Rebuilds the index for a class from its table. Only the id and name columns are loaded.
+    :param session: Session for querying database
+    :param cls: Class to reindex
+    :return: Number of records indexed
+    """
+    session.query(NameTrigram).filter(NameTrigram._table == cls.__tablename__).delete(synchronize_session=False)
+
+    records = session.query(cls._id, cls._name).all()
+
+    rows = [
+        {"_table": cls.__tablename__, "_obj_id": obj_id, "_trigram": trigram}
+        for obj_id, name in records for trigram in trigrams(name)
+    ]
+
+    if rows:
+        session.execute(NameTrigram.__table__.insert(), rows)
+
+    return len(records)
+
+
+def ensure_indexes():
+    """
+    Rebuilds the index for any registered class whose records are out of step with it. This covers an existing
+    database from before the index was introduced, and records written or deleted while the index events were not
+    listening, such as by an interrupted earlier run.
+    :return: None
+    """
+    with DataManagerMixin.class_session_scope() as session:
+        for table, cls in _indexed_classes.items():
+            # Records with no index entries. Names without any letters or digits have no trigrams, so are not missing.
+            unindexed = session.query(cls._id, cls._name) \
+                .filter(~exists().where(NameTrigram._table == table, NameTrigram._obj_id == cls._id)) \
+                .all()
+
+            # Index entries left behind by deleted records
+            orphaned = session.query(NameTrigram._id) \
+                .filter(NameTrigram._table == table, ~exists().where(cls._id == NameTrigram._obj_id)) \
+                .first()
+
+            if orphaned or any(trigrams(name) for _, name in unindexed):
+                print(f"Building name search index for {table}...")
+                rebuild_index(session, cls)
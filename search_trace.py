@@ -0,0 +1,145 @@
+# This file contains solver search telemetry. Each solution the routing solver finds is recorded with its objective and
+# the wall time at which it was found, and the trace for each run is appended to a JSON lines file with a fingerprint of
+# the problem solved. Traces show how quickly the search converges, so time limits can be chosen from evidence.
+import datetime
+import hashlib
+import json
+import pathlib
+import time
+import numpy as np
+import metrics
+
+TRACE_PATH = metrics.BASE_DIR / "data" / "solver_traces.jsonl"
+
+
+def problem_fingerprint(dist_matrix, num_clinicians, *constraints):
+    """
+    Returns a hash identifying an optimisation problem, so that runs of the same problem can be compared.
+    :param dist_matrix: Travel time matrix
+    :param num_clinicians: Number of clinicians
+    :param constraints: Remaining inputs to the solver, eg time windows, capacities and skills
+    :return: Hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(dist_matrix, dtype=np.int64).tobytes())
+    digest.update(json.dumps([num_clinicians, *constraints], default=str).encode())
+
+    return digest.hexdigest()[:32]
+
+
+class SearchTrace:
+    """
+    Records each solution found during a solve. Register it with the routing model before solving, then call finish
+    once the solve returns.
+    """
+
+    def __init__(self, routing, fingerprint, **details):
+        self.routing = routing
+        self.fingerprint = fingerprint
+        self.details = details
+        self.solutions = []
+        self.start = time.perf_counter()
+        self.elapsed = None
+
+        routing.AddAtSolutionCallback(self.on_solution)
+
+    def on_solution(self):
+        """Called by the solver each time it finds a solution."""
+        self.solutions.append((round(time.perf_counter() - self.start, 4), self.routing.CostVar().Max()))
+
+    def improvements(self):
+        """Returns the solutions that improved on the best objective found before them."""
+        best = None
+        improving = []
+
+        for seconds, objective in self.solutions:
+            if best is None or objective < best:
+                best = objective
+                improving.append((seconds, objective))
+
+        return improving
+
+    def summary(self):
+        """
+        Summarises the search. Time to best is when the final best objective was first found; any search after it did
+        not improve the solution.
+        :return: Dictionary
+        """
+        improving = self.improvements()
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.start
+
+        return {
+            "solutions": len(self.solutions),
+            "improving_solutions": len(improving),
+            "first_objective": improving[0][1] if improving else None,
+            "best_objective": improving[-1][1] if improving else None,
+            "time_to_first": improving[0][0] if improving else None,
+            "time_to_best": improving[-1][0] if improving else None,
+            "elapsed": round(elapsed, 4)
+        }
+
+    def finish(self, solution):
+        """
+        Records the end of the solve and saves the trace.
+        :param solution: Solution from routing model, or None if none was found
+        :return: Trace as a dictionary
+        """
+        self.elapsed = time.perf_counter() - self.start
+
+        trace = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "fingerprint": self.fingerprint,
+            **self.details,
+            "status": self.routing.status(),
+            "objective": solution.ObjectiveValue() if solution else None,
+            **self.summary(),
+            # Only improving solutions are kept in full, as the metaheuristic may find thousands that are not
+            "trace": self.improvements()
+        }
+
+        metrics.log_event("search", **{key: value for key, value in trace.items() if key != "trace"})
+        save_trace(trace)
+
+        return trace
+
+
+def save_trace(trace, path=None):
+    """Appends a trace to the trace file. The path is looked up when called so that replays can redirect it."""
+    path = pathlib.Path(path or TRACE_PATH)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(path, "a") as file:
+        file.write(json.dumps(trace, default=str) + "\n")
+
+
+def load_traces(path=None, fingerprint=None):
+    """
+    Loads saved traces.
+    :param path: Path of the trace file
+    :param fingerprint: Optional problem fingerprint to filter by
+    :return: List of traces, oldest first
+    """
+    path = pathlib.Path(path or TRACE_PATH)
+
+    if not path.exists():
+        return []
+
+    with open(path) as file:
+        traces = [json.loads(line) for line in file if line.strip()]
+
+    return [trace for trace in traces if not fingerprint or trace["fingerprint"] == fingerprint]
+
+
+def time_to_quality(trace, tolerance=0.01):
+    """
+    Returns the time at which a run first came within a tolerance of its best objective.
+    :param trace: Trace dictionary
+    :param tolerance: Proportion of the best objective, eg 0.01 for within 1%
+    :return: Seconds, or None if no solution was found
+    """
+    if not trace["trace"]:
+        return None
+
+    best = trace["trace"][-1][1]
+
+    return next(seconds for seconds, objective in trace["trace"] if objective <= best * (1 + tolerance))
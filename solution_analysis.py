@@ -0,0 +1,128 @@
+# This file contains analysis of a solver solution. The solver's next variables are read in a single pass to find the
+# visits that were dropped, and each dropped visit is classified by the reason it could not be seen using the
+# compatibility of clinicians and visits, the time windows and the capacity left on each route.
+import numpy as np
+
+# Reasons a visit is dropped, checked in this order
+SKILL_MISMATCH = "Skill/Discipline Mismatch"
+TIME_WINDOW_MISMATCH = "Time Window Mismatch"
+CAPACITY_REACHED = "Capacity Reached"
+LOWER_PRIORITY = "Lower Priority"
+DROP_REASONS = (SKILL_MISMATCH, TIME_WINDOW_MISMATCH, CAPACITY_REACHED, LOWER_PRIORITY)
+
+# Row of the dropped visit table
+#   - node: Index of the visit in the distance matrix
+#   - visit: Index of the visit in the visit list
+#   - compatible: Number of clinicians with the skills and discipline for the visit
+#   - reachable: Number of compatible clinicians who could reach the visit within its time window and their shift
+#   - reason: Reason the visit was dropped, one of DROP_REASONS
+DROPPED_DTYPE = np.dtype([("node", np.int64), ("visit", np.int64), ("priority", np.int64), ("weight", np.int64),
+                          ("compatible", np.int64), ("reachable", np.int64),
+                          ("reason", f"U{max(len(reason) for reason in DROP_REASONS)}")])
+
+
+def compatibility_matrix(num_clinicians, skills, discipline):
+    """
+    Works out which clinicians may see each visit. A clinician may see a visit if the visit's discipline is "any" or
+    matches theirs, and they have every skill the visit requires. Missing skill lists are treated as no skills.
+    :param num_clinicians: Number of clinicians, whose skills and disciplines come first in the lists
+    :param skills: Skills posessed by clinicians and skills required for visits
+    :param discipline: The discipline of the clinician and the discipline required for visits
+    :return: Boolean array with a row for each visit and a column for each clinician
+    """
+    clin_skills = [set(skill_list or ()) for skill_list in skills[:num_clinicians]]
+    clin_disc = discipline[:num_clinicians]
+
+    return np.array([[(visit_disc == "any" or visit_disc == disc) and set(visit_skills or ()) <= clin_skill_set
+                      for clin_skill_set, disc in zip(clin_skills, clin_disc)]
+                     for visit_skills, visit_disc in zip(skills[num_clinicians:], discipline[num_clinicians:])],
+                    dtype=bool).reshape(-1, num_clinicians)
+
+
+def index_to_node(manager):
+    """Returns an array mapping every routing variable index, including end indices, to its distance matrix node."""
+    num_indices = manager.GetNumberOfIndices()
+
+    return np.fromiter((manager.IndexToNode(index) for index in range(num_indices)), dtype=np.int64, count=num_indices)
+
+
+def next_indices(routing, solution):
+    """Returns an array of the next index of every non-end index in a solution, read in a single pass."""
+    return np.fromiter((solution.Value(routing.NextVar(index)) for index in range(routing.Size())), dtype=np.int64,
+                       count=routing.Size())
+
+
+def dropped_visits(manager, routing, solution, dist_matrix, data_dict, compatible=None):
+    """
+    Finds the visits that could not be seen in a solution and classifies why. A visit is dropped if:
+        - No clinician has the skills and discipline for it
+        - No compatible clinician can reach it within its time window and still return by the end of their shift
+        - Every compatible clinician who could reach it has no capacity left for it
+        - Otherwise, it was skipped in favour of higher priority or better placed visits
+    :param manager: Index manager - parses details from distance matrix
+    :param routing: Routing Model
+    :param solution: Solution from routing model
+    :param dist_matrix: Travel time matrix, or array of matrix slices selected by data_dict["vehicle_slices"]
+    :param data_dict: Inputs from generate_data
+    :param compatible: Compatibility matrix, if already calculated
+    :return: Structured array of DROPPED_DTYPE, in node order
+    """
+    num_clinicians = len(data_dict["start_list"])
+
+    if compatible is None:
+        compatible = compatibility_matrix(num_clinicians, data_dict["skills"], data_dict["disc"])
+
+    # An index whose next variable points to itself is inactive. Start indices always point onwards.
+    nodes = index_to_node(manager)
+    indices = np.flatnonzero(next_indices(routing, solution) == np.arange(routing.Size()))
+    dropped = nodes[indices]
+    visit = dropped - num_clinicians
+
+    table = np.zeros(len(dropped), dtype=DROPPED_DTYPE)
+    table["node"] = dropped
+    table["visit"] = visit
+    table["priority"] = np.asarray(data_dict["priorities"], dtype=np.int64)[dropped]
+    table["weight"] = np.asarray(data_dict["weights"], dtype=np.int64)[dropped]
+
+    if not len(table):
+        return table
+
+    # Travel times from each clinician's start to the dropped visits and from the visits to their end, using the
+    # matrix slice each clinician travels by. Rows are dropped visits and columns are clinicians.
+    dist_matrix = np.asarray(dist_matrix)
+    vehicles = np.arange(num_clinicians)[None, :]
+
+    if dist_matrix.ndim == 3:
+        vehicle_slices = np.asarray(data_dict["vehicle_slices"])[None, :]
+    else:
+        dist_matrix, vehicle_slices = dist_matrix[None], np.zeros_like(vehicles)
+
+    to_visit = dist_matrix[vehicle_slices, np.asarray(data_dict["start_list"])[vehicles], dropped[:, None]]
+    from_visit = dist_matrix[vehicle_slices, dropped[:, None], np.asarray(data_dict["end_list"])[vehicles]]
+
+    # Earliest arrival of each clinician travelling straight from their start, and whether they could still reach
+    # their end in time
+    windows = np.asarray(data_dict["time_windows"], dtype=np.int64)
+    shift_start, shift_end = windows[:num_clinicians, 0], windows[:num_clinicians, 1]
+    arrival = np.maximum(shift_start + to_visit, windows[dropped, :1])
+    reachable = compatible[visit] & (arrival <= windows[dropped, 1:]) & (arrival + from_visit <= shift_end)
+
+    # Capacity left on each clinician's route once the solution's visits are assigned
+    capacity_dimension = routing.GetDimensionOrDie("Capacity")
+    load = np.array([solution.Value(capacity_dimension.CumulVar(routing.End(vehicle)))
+                     for vehicle in range(num_clinicians)], dtype=np.int64)
+    has_capacity = reachable & (load + table["weight"][:, None] <= np.asarray(data_dict["capacities"]))
+
+    table["compatible"] = compatible[visit].sum(axis=1)
+    table["reachable"] = reachable.sum(axis=1)
+    table["reason"] = np.select([table["compatible"] == 0, table["reachable"] == 0, ~has_capacity.any(axis=1)],
+                                DROP_REASONS[:-1], LOWER_PRIORITY)
+
+    return table
+
+
+def reason_counts(table):
+    """Returns the number of dropped visits for each reason."""
+    reasons, counts = np.unique(table["reason"], return_counts=True)
+
+    return dict(zip(reasons.tolist(), counts.tolist()))
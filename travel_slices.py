@@ -0,0 +1,228 @@
+# This file contains the time-sliced travel time store. Travel times change through the day and clinicians travel by
+# different modes, so a matrix is built for each mode and departure hour that clinicians start their shifts in, and the
+# route optimizer uses the slice matching each clinician's mode and shift start. Slices are cached on disk by the
+# locations, mode, provider and weekday they cover, so that they can be built offline by the nightly batch and read back
+# when the day is optimized. Each slice records when it was sampled. Traffic from Google is a sample of a single day, so
+# it is resampled each week rather than reused for the full cache age.
+import datetime
+import hashlib
+import json
+import os
+import numpy as np
+import metrics
+
+SLICE_DIR = metrics.BASE_DIR / "data" / "travel_slices"
+
+# Slices older than this are rebuilt, and are removed by prune_slices
+MAX_SLICE_AGE = datetime.timedelta(days=28)
+
+# Providers whose slices include sampled traffic, and the age after which they are resampled. This is under a week, so
+# the nightly batch samples each weekday's traffic again when that weekday next comes round.
+TRAFFIC_PROVIDERS = ("google", "hybrid")
+TRAFFIC_SLICE_AGE = datetime.timedelta(days=6)
+
+# Travel modes whose travel times depend on the time of day. Other modes use a single matrix for any departure hour.
+TIME_DEPENDENT_MODES = ("driving", "transit")
+
+# Hour stored in the cache for a matrix that applies at any departure hour
+ANY_HOUR = -1
+
+# Travel time multipliers for driving at each hour of the day, used by providers that have no traffic data (local and
+# estimate). Hours not listed are free flowing.
+CONGESTION_FACTORS = {
+    7: 1.25,
+    8: 1.4,
+    9: 1.2,
+    12: 1.05,
+    15: 1.1,
+    16: 1.25,
+    17: 1.4,
+    18: 1.2
+}
+
+
+def vehicle_slices(clin_windows, clin_modes):
+    """
+    Works out the travel time slices needed for a set of clinicians. Each clinician travels by their own mode, and modes
+    that depend on the time of day are sliced by the hour the clinician's shift starts.
+    :param clin_windows: Each clinician's (start, end) time window in minutes from midnight
+    :param clin_modes: Each clinician's travel mode
+    :return: Tuple of (sorted list of distinct [mode, departure hour] slices, index of each clinician's slice in that
+        list). The hour is None for modes that do not depend on the time of day.
+    """
+    clin_slices = [(mode, window[0] // 60 if is_time_dependent(mode) else None)
+                   for window, mode in zip(clin_windows, clin_modes)]
+    slices = sorted(set(clin_slices), key=lambda mode_hour: (mode_hour[0], mode_hour[1] or 0))
+
+    return [list(mode_hour) for mode_hour in slices], [slices.index(mode_hour) for mode_hour in clin_slices]
+
+
+def is_time_dependent(mode):
+    """Returns whether travel times for a mode depend on the time of day."""
+    return mode in TIME_DEPENDENT_MODES
+
+
+def max_slice_age(provider):
+    """Returns the age after which slices from a provider are rebuilt."""
+    return TRAFFIC_SLICE_AGE if provider in TRAFFIC_PROVIDERS else MAX_SLICE_AGE
+
+
+def congestion_factor(mode, hour):
+    """Returns the travel time multiplier for a mode and departure hour, for providers without traffic data."""
+    if mode != "driving" or hour is None:
+        return 1
+
+    return CONGESTION_FACTORS.get(hour, 1)
+
+
+def departure_time(hour, val_date=None):
+    """
+    Returns the departure time to request traffic for. Google only accepts departure times in the future, so this is
+    the next occurrence of the hour on the same weekday as the date.
+    :param hour: Departure hour
+    :param val_date: Date of the route. Defaults to today.
+    :return: Unix timestamp in seconds
+    """
+    departure = datetime.datetime.combine(val_date or datetime.date.today(), datetime.time(hour))
+
+    while departure <= datetime.datetime.now():
+        departure += datetime.timedelta(days=7)
+
+    return int(departure.timestamp())
+
+
+def slice_key(plus_code_list, mode, provider, val_date=None):
+    """
+    Generates the cache key for the slices covering a set of locations. The order of the locations does not matter.
+    :param plus_code_list: List of plus codes covered by the matrix
+    :param mode: Transportation mode
+    :param provider: Matrix provider
+    :param val_date: Date of the route, which sets the weekday of the traffic
+    :return: Hex digest
+    """
+    content = {
+        "locations": sorted(plus_code_list),
+        "mode": mode,
+        "provider": provider,
+        "weekday": (val_date or datetime.date.today()).weekday()
+    }
+
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def slice_path(key):
+    """Returns the path of a cached set of slices."""
+    return SLICE_DIR / f"{key}.npz"
+
+
+def load_slices(key, max_age=MAX_SLICE_AGE):
+    """
+    Loads the cached slices for a key. Matrices are stored with their rows and columns in plus code order.
+    :param key: Cache key from slice_key
+    :param max_age: Timedelta after which a slice is treated as missing, counted from when it was sampled
+    :return: Tuple of (dictionary of departure hour (None for any hour) to matrix, dictionary of departure hour to the
+        Unix timestamp it was sampled at)
+    """
+    path = slice_path(key)
+
+    if not path.exists():
+        return {}, {}
+
+    with np.load(path, allow_pickle=False) as archive:
+        hours = [None if hour == ANY_HOUR else hour for hour in archive["hours"].tolist()]
+        matrices = archive["matrices"]
+
+        # Slices saved before sample times were recorded are dated by the file
+        sampled = archive["sampled"].tolist() if "sampled" in archive else [path.stat().st_mtime] * len(hours)
+        cutoff = (datetime.datetime.now() - max_age).timestamp()
+        fresh = [index for index, sample_time in enumerate(sampled) if sample_time >= cutoff]
+
+        return ({hours[index]: matrices[index] for index in fresh},
+                {hours[index]: sampled[index] for index in fresh})
+
+
+def save_slices(key, slices, sampled):
+    """
+    Saves a set of slices to the cache. The file is written to a temporary path first so readers never see a partial
+    file.
+    :param key: Cache key from slice_key
+    :param slices: Dictionary of departure hour (None for any hour) to matrix, in plus code order
+    :param sampled: Dictionary of departure hour to the Unix timestamp its slice was sampled at
+    :return: Path to the saved file
+    """
+    SLICE_DIR.mkdir(parents=True, exist_ok=True)
+    hours = list(slices)
+    tmp_path = SLICE_DIR / f"{key}.tmp.npz"
+
+    np.savez_compressed(tmp_path,
+                        hours=np.array([ANY_HOUR if hour is None else hour for hour in hours], dtype=np.int64),
+                        matrices=np.stack([slices[hour] for hour in hours]).astype(np.int64),
+                        sampled=np.array([sampled[hour] for hour in hours], dtype=np.float64))
+    os.replace(tmp_path, slice_path(key))
+
+    return slice_path(key)
+
+
+def time_sliced_matrix(plus_code_list, mode, provider, hours, build, val_date=None):
+    """
+    Returns a travel time matrix for each departure hour, reading slices from the cache and building any that are
+    missing or older than the provider's maximum age. Google traffic is sampled for the next occurrence of the weekday
+    when a slice is built, and that sample is reused on the same weekday until it is resampled a week later. Estimates
+    take milliseconds, so they are not cached.
+    :param plus_code_list: List of plus codes to calculate into a distance matrix
+    :param mode: Transportation mode
+    :param provider: Matrix provider
+    :param hours: Departure hours to return slices for. None is a slice for any departure hour.
+    :param build: Function taking a departure hour and returning the matrix for it, or 0 if it cannot be built
+    :param val_date: Date of the route
+    :return: Array of matrices, one for each hour in order, or 0 if a slice could not be built
+    """
+    cache = provider != "estimate"
+    key = slice_key(plus_code_list, mode, provider, val_date)
+    slices, sampled = load_slices(key, max_slice_age(provider)) if cache else ({}, {})
+
+    # Cached matrices are held in plus code order, so map between that and the order of the list
+    order = np.argsort(plus_code_list, kind="stable")
+    restore = np.argsort(order)
+    built = False
+
+    for hour in hours:
+        if cache:
+            metrics.cache_lookup("travel_slice", hour in slices)
+
+        if hour in slices:
+            continue
+
+        matrix = build(hour)
+
+        if not isinstance(matrix, np.ndarray):
+            return 0
+
+        slices[hour] = np.asarray(matrix)[np.ix_(order, order)]
+        sampled[hour] = datetime.datetime.now().timestamp()
+        built = True
+
+    if cache and built:
+        save_slices(key, slices, sampled)
+
+    return np.stack([slices[hour][np.ix_(restore, restore)] for hour in hours])
+
+
+def prune_slices(max_age=MAX_SLICE_AGE):
+    """
+    Removes cached slices older than the maximum age.
+    :param max_age: Timedelta after which slices are removed
+    :return: Number of files removed
+    """
+    if not SLICE_DIR.exists():
+        return 0
+
+    cutoff = (datetime.datetime.now() - max_age).timestamp()
+    removed = 0
+
+    for path in SLICE_DIR.iterdir():
+        if path.is_file() and path.stat().st_mtime < cutoff:
+            path.unlink()
+            removed += 1
+
+    return removed
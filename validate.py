@@ -3,10 +3,15 @@ from datetime import datetime
 from Levenshtein import ratio as levratio
 import re
 import usaddress
-import requests
 import classes.person
+import search_index
 import navigation
-import boto3
+from lazy_import import lazy_import
+import metrics
+
+# HTTP and AWS clients are only imported when an address is first geocoded
+requests = lazy_import("requests")
+boto3 = lazy_import("boto3")
 
 
 def qu_input(prompt):
@@ -133,9 +138,12 @@ def valid_address(value):
         )
 
     except requests.exceptions.RequestException:
+        metrics.increment("google_api_requests", api="geocode", result="error")
         print("Unable to validate address. Please try again.")
         return 0
 
+    metrics.increment("google_api_requests", api="geocode", result=response.status_code)
+
     # Save and return relevant address information - Address, zip code, place_id, and coordinates.
     if response.status_code == 200:
         # Prepare coordinate details
@@ -309,6 +317,7 @@ def confirm_info(detail_dict):
 def validate_obj_by_name(cls, name, session, inc_inac=0):
     """
     Uses levenshtein distance to determine a ratio of distance.
+    Indexed classes are first narrowed to a small candidate set using the trigram name index.
     If a perfect match is found, it will return the id of the object.
     If it is not a perfect match, adds to the match_list and displays to user to select the correct record.
     :param cls: Class of object being searched.
@@ -320,7 +329,15 @@ def validate_obj_by_name(cls, name, session, inc_inac=0):
     navigation.clear()
     match_list = []
 
-    for obj in session.query(cls).distinct().all():
+    # Narrow indexed classes to the records sharing the most trigrams with the search term before scoring
+    if search_index.is_indexed(cls):
+        obj_ids = search_index.candidate_ids(session, cls, name, inc_inac=inc_inac)
+        candidates = session.query(cls).filter(cls._id.in_(obj_ids)).all() if obj_ids else []
+
+    else:
+        candidates = session.query(cls).distinct().all()
+
+    for obj in candidates:
         # If flag set for hiding inactive and record is inactive, ignore
         if not inc_inac and not obj.status:
             continue
@@ -368,15 +385,15 @@ def validate_obj_by_name(cls, name, session, inc_inac=0):
 
     if issubclass(cls, classes.person.Human):
         for count, match in enumerate(match_list):
-            print(f"{count + 1}) ID: {obj.id}, "
-                  f"Name: {obj.name} "
-                  f"DOB: {obj.dob} "
-                  f"Sex: {obj.sex.capitalize()}"
+            print(f"{count + 1}) ID: {match.id}, "
+                  f"Name: {match.name} "
+                  f"DOB: {match.dob} "
+                  f"Sex: {match.sex.capitalize()}"
                   )
 
     else:
         for count, match in enumerate(match_list):
-            print(f"{count + 1}) ID: {obj.id}, Name: {obj.name}")
+            print(f"{count + 1}) ID: {match.id}, Name: {match.name}")
 
     # Prompt user to select option from above
     while True: